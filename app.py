@@ -3,6 +3,10 @@ import networkx as nx
 import json
 import os
 from modules.backend import GraphManager
+from modules.clustering import ClusterIndex
+from modules.focus import NeighborhoodIndex
+from modules.paths import RELATION_COLORS, PathIndex, highlight_path
+from modules.timeline import TimelineIndex
 from modules.visualization import render_interactive_graph
 from modules.ui import render_sidebar, render_main_tabs
 
@@ -81,35 +85,92 @@ render_main_tabs()
 st.divider()
 
 graph = st.session_state['graph']
-max_chapter = 1
-for _, data in graph.nodes(data=True):
-    max_chapter = max(max_chapter, data.get('chapter', 1))
-for _, _, data in graph.edges(data=True):
-    max_chapter = max(max_chapter, data.get('chapter', 1))
+# 尚未排版的角色在伺服器端先算好座標，瀏覽器只需直接繪製
+st.session_state['manager'].ensure_layout(graph)
+if 'timeline_index' not in st.session_state:
+    st.session_state['timeline_index'] = TimelineIndex()
+    st.session_state['manager'].subscribe(st.session_state['timeline_index'].apply_change)
+timeline_index = st.session_state['timeline_index']
+timeline_index.sync(graph, st.session_state['manager'].graph_version(graph))
+max_chapter = timeline_index.max_chapter
 
 # 通用版時間拉桿
 selected_chapter = st.slider("⏳ 時間演進 (可為年份、章節或自訂階段)", min_value=1, max_value=max(2, max_chapter), value=max_chapter)
 
-# 打造帶有記憶功能的時間軸視角
-timeline_graph = nx.DiGraph()
+# 聚焦模式：只取出搜尋角色 k 步內的鄰域，不必建出整張圖
+focus_target = st.session_state.get('search_target', "顯示全部")
+focused = focus_target != "顯示全部" and graph.has_node(focus_target)
+if 'neighborhood_index' not in st.session_state:
+    st.session_state['neighborhood_index'] = NeighborhoodIndex(timeline_index)
+neighborhood_index = st.session_state['neighborhood_index']
+neighborhood_index.sync(graph, st.session_state['manager'].graph_version(graph))
+if focused:
+    f1, f2 = st.columns([3, 1])
+    hops = f1.slider(f"🎯 聚焦「{focus_target}」的範圍 (步數)", min_value=1, max_value=5, value=2, key="focus_hops")
+    focus_at_chapter = f2.toggle("只看此章節", value=True, key="focus_at_chapter")
+    timeline_graph = neighborhood_index.subgraph(focus_target, hops, selected_chapter if focus_at_chapter else None)
+    st.caption(f"顯示 {timeline_graph.number_of_nodes()} 個角色、{timeline_graph.number_of_edges()} 條關係")
+else:
+    # 打造帶有記憶功能的時間軸視角：各關係的章節已排序建立索引，同一版本的圖會直接沿用快取
+    timeline_graph = timeline_index.graph_at(selected_chapter)
 
-# 1. 篩選符合時間的節點
-for n, data in graph.nodes(data=True):
-    if data.get('chapter', 1) <= selected_chapter:
-        timeline_graph.add_node(n, **data)
+# 大型圖自動收合社群，分群結果依版本快取，可挑選群組展開
+if 'cluster_index' not in st.session_state:
+    st.session_state['cluster_index'] = ClusterIndex()
+    st.session_state['manager'].subscribe(st.session_state['cluster_index'].apply_change)
+cluster_index = st.session_state['cluster_index']
+cluster_index.threshold = st.session_state.get('lod_threshold', cluster_index.threshold)
+cluster_index.sync(graph, st.session_state['manager'].graph_version(graph))
+expanded = []
+lod = not focused and cluster_index.active(timeline_graph)
+if lod:
+    clusters = {cid: label for cid, _, label, _ in cluster_index.clusters()}
+    if 'expanded_clusters' in st.session_state:
+        # 圖變動後群組可能重新編號，移除已不存在的選項
+        st.session_state['expanded_clusters'] = [c for c in st.session_state['expanded_clusters'] if c in clusters]
+    expanded = st.multiselect(
+        "🧩 圖譜較大，已將社群收合為群組節點；選擇要展開的群組",
+        options=list(clusters), format_func=clusters.get, key="expanded_clusters"
+    )
+    timeline_graph = cluster_index.collapse(timeline_graph, expanded, key=selected_chapter)
 
-# 2. 篩選連線，並重現「當時的顏色與標籤」
-for u, v, data in graph.edges(data=True):
-    orig_chap = data.get('chapter', 1)
-    timeline = data.get('timeline', {str(orig_chap): {'label': data.get('label'), 'color': data.get('color', '#9E9E9E')}})
-    
-    # 找出該時間點之前，所有的歷史紀錄
-    valid_chapters = [int(c) for c in timeline.keys() if int(c) <= selected_chapter]
-    
-    if valid_chapters:
-        latest_valid_chapter = max(valid_chapters)
-        state = timeline[str(latest_valid_chapter)]
-        timeline_graph.add_edge(u, v, label=state.get('label', ''), color=state.get('color', '#9E9E9E'))
+# 關係路徑查詢：找出兩個角色之間前 k 短的路徑，並在圖上標示選取的路徑
+if 'path_index' not in st.session_state:
+    st.session_state['path_index'] = PathIndex(timeline_index)
+path_index = st.session_state['path_index']
+path_index.sync(graph, st.session_state['manager'].graph_version(graph))
+highlight = None
+with st.expander("🧭 關係路徑查詢", expanded=False):
+    p1, p2 = st.columns(2)
+    path_source = p1.text_input("起點角色", key="path_source")
+    path_target = p2.text_input("終點角色", key="path_target")
+    p3, p4, p5 = st.columns(3)
+    path_k = p3.number_input("路徑數", min_value=1, max_value=10, value=3, key="path_k")
+    path_colors = p4.multiselect("只走這些關係", options=list(RELATION_COLORS), format_func=RELATION_COLORS.get, key="path_colors")
+    path_directed = p5.toggle("依關係方向", key="path_directed")
+    path_at_chapter = p5.toggle("只看此章節", value=True, key="path_at_chapter")
+    if path_source and path_target:
+        # 名稱經過實體解析，輸入別名或大小寫、全半形不同的名稱也能找到角色
+        entities = st.session_state['manager'].entities
+        entities.sync(graph, st.session_state['manager'].graph_version(graph))
+        source, target = entities.resolve(path_source), entities.resolve(path_target)
+        if source is None or target is None:
+            st.warning(f"找不到角色 '{path_source if source is None else path_target}'。")
+        else:
+            found = path_index.paths(source, target, k=path_k, chapter=selected_chapter if path_at_chapter else None,
+                                     colors=path_colors, directed=path_directed)
+            if not found:
+                st.info("在目前的條件下，兩人之間沒有關係路徑。")
+            else:
+                chapter = selected_chapter if path_at_chapter else None
+                choice = st.radio(f"找到 {len(found)} 條路徑 (由短到長)", range(len(found)),
+                                  format_func=lambda i: path_index.describe(found[i], chapter), key="path_choice")
+                highlight = found[choice] if choice is not None and choice < len(found) else found[0]
+if highlight:
+    timeline_graph = highlight_path(timeline_graph, highlight)
 
-# 繪製圖表
-render_interactive_graph(timeline_graph)
\ No newline at end of file
+# 繪製圖表：同一版本、章節、群組展開、聚焦與路徑狀態的圖表 HTML 直接沿用快取
+focus_key = (focus_target, hops, focus_at_chapter) if focused else None
+view_key = (st.session_state['manager'].graph_version(graph), selected_chapter, lod, tuple(sorted(expanded)), focus_key,
+            tuple(highlight) if highlight else None)
+render_interactive_graph(timeline_graph, cache_key=view_key)
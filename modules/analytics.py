@@ -0,0 +1,135 @@
+import heapq
+import networkx as nx
+from modules import sparse
+
+METRICS = {
+    "degree": "連結數 (Degree)",
+    "in_degree": "被指向 (In-Degree)",
+    "out_degree": "指向他人 (Out-Degree)",
+    "pagerank": "影響力 (PageRank)",
+    "eigenvector": "核心程度 (Eigenvector)",
+    "betweenness": "橋樑角色 (Betweenness)",
+}
+
+DEGREE_METRICS = ("degree", "in_degree", "out_degree")
+
+
+class CentralityEngine:
+    """中心性分析：依圖的版本快取各項指標，連結數類指標隨變更增量更新。"""
+
+    def __init__(self, sparse_threshold=5000, betweenness_epsilon=0.05, betweenness_time_budget=5.0):
+        # 關係數超過 sparse_threshold 時改用 NumPy/SciPy 稀疏矩陣計算，中介中心性改為抽樣近似
+        self.sparse_threshold = sparse_threshold
+        self.betweenness_epsilon = betweenness_epsilon
+        self.betweenness_time_budget = betweenness_time_budget
+        self._matrix = None
+        self._graph = None
+        self._version = None
+        self._in = {}
+        self._out = {}
+        self._scores = {}
+        self._top = {}
+
+    # --- 同步 ---
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self.rebuild(graph)
+        self._version = version
+
+    def rebuild(self, graph):
+        self._graph = graph
+        self._in = dict(graph.in_degree())
+        self._out = dict(graph.out_degree())
+        self._matrix = None
+        self._scores.clear()
+        self._top.clear()
+
+    def apply_change(self, change):
+        # 供 GraphManager.subscribe 使用：只調整受影響角色的連結數，其餘指標等到需要時再重算
+        if change.graph is not self._graph or self._version != change.version - 1:
+            return
+        if change.reset:
+            self.rebuild(change.graph)
+        else:
+            for op in change.ops:
+                if op[0] == "node":
+                    _, name, before, after = op
+                    if after is None:
+                        self._in.pop(name, None)
+                        self._out.pop(name, None)
+                    elif before is None:
+                        self._in.setdefault(name, 0)
+                        self._out.setdefault(name, 0)
+                elif op[0] == "edge":
+                    _, u, v, before, after = op
+                    delta = (before is None) - (after is None)
+                    if delta:
+                        self._out[u] = self._out.get(u, 0) + delta
+                        self._in[v] = self._in.get(v, 0) + delta
+            self._matrix = None
+            self._scores.clear()
+            self._top.clear()
+        self._version = change.version
+
+    # --- 指標 ---
+
+    def _degree_scores(self, metric):
+        n = len(self._in)
+        if n <= 1:
+            return {name: 1 for name in self._in}
+        scale = 1.0 / (n - 1)
+        if metric == "in_degree":
+            return {name: d * scale for name, d in self._in.items()}
+        if metric == "out_degree":
+            return {name: d * scale for name, d in self._out.items()}
+        return {name: (d + self._out[name]) * scale for name, d in self._in.items()}
+
+    def matrix(self):
+        # 同一版本的圖只匯出一次 CSR 矩陣
+        if self._matrix is None:
+            self._matrix = sparse.SparseGraph(self._graph)
+        return self._matrix
+
+    def _compute_sparse(self, metric):
+        sg = self.matrix()
+        if metric == "pagerank":
+            return sg.to_dict(sparse.pagerank(sg))
+        if metric == "eigenvector":
+            try:
+                return sg.to_dict(sparse.eigenvector(sg))
+            except nx.PowerIterationFailedConvergence:
+                return {}
+        if metric == "betweenness":
+            values = sparse.betweenness(sg, epsilon=self.betweenness_epsilon, time_budget=self.betweenness_time_budget)
+            return sg.to_dict(values)
+        raise ValueError(f"未知的指標：{metric}")
+
+    def _compute(self, metric):
+        graph = self._graph
+        if metric in DEGREE_METRICS:
+            return self._degree_scores(metric)
+        if graph.number_of_edges() >= self.sparse_threshold:
+            return self._compute_sparse(metric)
+        if metric == "pagerank":
+            return nx.pagerank(graph)
+        if metric == "eigenvector":
+            try:
+                return nx.eigenvector_centrality(graph, max_iter=1000)
+            except nx.PowerIterationFailedConvergence:
+                return {}
+        if metric == "betweenness":
+            return nx.betweenness_centrality(graph)
+        raise ValueError(f"未知的指標：{metric}")
+
+    def scores(self, metric="degree"):
+        if metric not in self._scores:
+            self._scores[metric] = self._compute(metric)
+        return self._scores[metric]
+
+    def top(self, metric="degree", k=5):
+        key = (metric, k)
+        if key not in self._top:
+            self._top[key] = heapq.nlargest(k, self.scores(metric).items(), key=lambda x: x[1])
+        return self._top[key]
@@ -0,0 +1,50 @@
+import functools
+import glob
+import hashlib
+import os
+import pyvis
+from modules.autosave import atomic_write
+
+# vis-network 直接取用 pyvis 套件內附的檔案，不需連線到 CDN
+VIS_DIR = os.path.join(os.path.dirname(pyvis.__file__), "lib", "vis-9.1.2")
+VIS_FILES = {"js": "vis-network.min.js", "css": "vis-network.css"}
+
+
+@functools.lru_cache(maxsize=None)
+def read_asset(kind):
+    """回傳 (內容, 內容雜湊)；每個檔案只讀一次。"""
+    with open(os.path.join(VIS_DIR, VIS_FILES[kind]), "rb") as f:
+        data = f.read()
+    return data.decode("utf-8"), hashlib.sha256(data).hexdigest()[:16]
+
+
+def hashed_name(kind):
+    _, digest = read_asset(kind)
+    return f"vis-network.{digest}.{kind}"
+
+
+def publish(directory):
+    """把 vis-network 放進前端元件的目錄，檔名帶內容雜湊，瀏覽器只需下載一次。
+
+    檔案已存在時不再寫入；舊版本留下的檔案會被清除。回傳 {"js": 檔名, "css": 檔名}。
+    """
+    names = {kind: hashed_name(kind) for kind in VIS_FILES}
+    for kind, name in names.items():
+        path = os.path.join(directory, name)
+        if not os.path.exists(path):
+            atomic_write(path, read_asset(kind)[0])
+    for path in glob.glob(os.path.join(directory, "vis-network.*")):
+        if os.path.basename(path) not in names.values():
+            os.remove(path)
+    return names
+
+
+def minify(source):
+    # 只處理我們自己的樣板：去掉縮排、空行與整行註解 (第三方檔案本身已壓縮，不經過這裡)
+    lines = (line.strip() for line in source.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+def inline_json(value):
+    # 嵌入 <script> 內的 JSON 不能出現 "</"，否則會提早結束 script 標籤
+    return value.replace("</", "<\\/")
@@ -0,0 +1,201 @@
+import atexit
+import json
+import os
+import tempfile
+import threading
+import time
+import weakref
+import networkx as nx
+
+# 所有仍存活的 AutosaveWriter；結束程式時統一寫完，atexit 不直接持有任何 writer (也就不會留住它的圖)
+_live_writers = weakref.WeakSet()
+
+
+@atexit.register
+def _close_all():
+    for writer in list(_live_writers):
+        writer.close()
+
+
+def atomic_write(path, payload):
+    # 先寫入同目錄的暫存檔再 rename，中途當機也不會留下寫一半的檔案
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-", suffix=os.path.basename(path))
+    try:
+        mode = "wb" if isinstance(payload, (bytes, bytearray)) else "w"
+        with os.fdopen(fd, mode, **({} if mode == "wb" else {"encoding": "utf-8"})) as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+class AutosaveWriter:
+    """在背景執行緒寫入自動存檔，短時間內的多次變更只會合併成一次寫入。
+
+    閒置超過 idle_timeout 秒後背景執行緒自行結束，下次 schedule 時再啟動，每個工作階段的 writer 才不會常駐。
+    """
+
+    def __init__(self, path, lock=None, delay=0.5, snapshot=None, on_written=None, idle_timeout=30.0):
+        self.path = path
+        self.delay = delay
+        self.idle_timeout = idle_timeout
+        self.lock = lock or threading.RLock()
+        self.snapshot = snapshot or nx.node_link_data
+        self.on_written = on_written
+        self.writes = 0
+        self._io_lock = threading.Lock()
+        self._ticket = 0
+        self._written_ticket = 0
+        self._cond = threading.Condition()
+        self._graph = None
+        self._dirty = False
+        self._urgent = False
+        self._writing = False
+        self._closed = False
+        self._last_request = 0.0
+        self._thread = None
+        _live_writers.add(self)
+
+    def schedule(self, graph):
+        with self._cond:
+            if self._closed:
+                self.write_now(graph)
+                return
+            self._graph = graph
+            self._dirty = True
+            self._last_request = time.monotonic()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="autosave-writer", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def flush(self, timeout=None):
+        with self._cond:
+            self._urgent = True
+            self._cond.notify_all()
+            done = self._cond.wait_for(lambda: not self._dirty and not self._writing, timeout)
+            self._urgent = False
+            return done
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def write_now(self, graph):
+        # 序列化時持有圖的鎖，避免主執行緒同時修改
+        with self.lock:
+            data = self.snapshot(graph)
+            if data is None:
+                return
+            payload = json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+            self._ticket += 1
+            ticket = self._ticket
+        with self._io_lock:
+            # 較晚擷取的快照可能已經先寫入，舊快照不可再蓋過去
+            if ticket < self._written_ticket:
+                return
+            atomic_write(self.path, payload)
+            self._written_ticket = ticket
+            self.writes += 1
+        if self.on_written is not None:
+            self.on_written(data)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._dirty or self._closed, self.idle_timeout)
+                if not self._dirty:
+                    # 閒置或已關閉：結束執行緒，schedule 看到 _thread 為 None 時會再啟動新的
+                    self._thread = None
+                    return
+                while not (self._urgent or self._closed):
+                    remaining = self._last_request + self.delay - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                graph, self._graph = self._graph, None
+                self._dirty = False
+                self._writing = True
+            try:
+                self.write_now(graph)
+            except Exception as e:
+                print(f"Autosave failed: {e}")
+            finally:
+                graph = None
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
+
+
+class Journal:
+    """只會附加 (append-only) 的變更日誌，每行一筆 JSON：{"epoch", "seq", "ops"}。"""
+
+    def __init__(self, path, fsync=True):
+        self.path = path
+        self.fsync = fsync
+        self.size = self.repair()
+
+    def repair(self):
+        """截掉結尾不完整的一行 (當機時只寫了一半)，之後附加的變更才不會接在殘行後面、重播時一併被略過。回傳修復後的大小。"""
+        if not os.path.exists(self.path):
+            return 0
+        valid = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                valid += len(line)
+            size = f.seek(0, os.SEEK_END)
+        if size > valid:
+            with open(self.path, "r+b") as f:
+                f.truncate(valid)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+        return valid
+
+    def append(self, epoch, seq, ops):
+        line = json.dumps({"epoch": epoch, "seq": seq, "ops": ops}, ensure_ascii=False, separators=(",", ":")) + "\n"
+        data = line.encode("utf-8")
+        with open(self.path, "ab") as f:
+            f.write(data)
+            f.flush()
+            if self.fsync:
+                os.fsync(f.fileno())
+        self.size += len(data)
+
+    def read(self, epoch, after_seq=0):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # 最後一行可能在當機時只寫了一半，之後的內容都不可信
+                    break
+                if entry.get("epoch") == epoch and entry.get("seq", 0) > after_seq:
+                    yield entry["seq"], entry["ops"]
+
+    def truncate_through(self, epoch, seq):
+        # 快照已包含 seq 以前的變更，只保留之後追加的部分
+        kept = "".join(
+            json.dumps({"epoch": epoch, "seq": s, "ops": ops}, ensure_ascii=False, separators=(",", ":")) + "\n"
+            for s, ops in self.read(epoch, seq)
+        )
+        atomic_write(self.path, kept)
+        self.size = len(kept.encode("utf-8"))
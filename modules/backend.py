@@ -1,46 +1,228 @@
 import networkx as nx
+import contextlib
+import copy
+import functools
 import json
 import os
-from openai import OpenAI
+import threading
+import uuid
+import weakref
+from modules.analytics import CentralityEngine
+from modules.autosave import AutosaveWriter, Journal
+from modules.extraction import (RESPONSE_TOKENS, SYSTEM_PROMPT, KnownEntities, chunk_size_for_budget,
+                                estimate_tokens, extract_text, iter_extract)
+from modules.history import (GraphChange, HistoryLog, apply_ops, edge_state, graph_state, invert_ops, node_removal_ops,
+                             node_state, touched)
+from modules.ingestion import CHAPTER_PATTERN, IngestCheckpoint, chapter_digest, iter_chapters
+from modules.layout import LayoutIndex, force_layout, place_nodes
+from modules.llm_cache import LLMCache
+from modules.llm_client import CompletionStats, get_client
+from modules.resolution import AliasTable, EntityIndex
+from modules.storage import read_graph, write_graph
+
+def _locked(method):
+    # 所有會修改圖的操作都持有同一把鎖，背景存檔才能安全地讀取圖
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+class Transaction:
+    """一次交易中收集到的變更紀錄；交易結束時才一次存檔、通知並記為單一 Undo 步驟。"""
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.ops = []
+
+    def record(self, ops):
+        self.ops.extend(ops)
+
+def _merge_edge(graph, u, v, data):
+    # 同一對角色已有關係時合併時間軸，較新章節的標籤與顏色為準
+    if not graph.has_edge(u, v):
+        graph.add_edge(u, v, **copy.deepcopy(data))
+        return
+    edge_data = graph[u][v]
+    timeline = copy.deepcopy(edge_data.get('timeline')) or {str(edge_data.get('chapter', 1)): {'label': edge_data.get('label'), 'color': edge_data.get('color')}}
+    incoming = data.get('timeline') or {str(data.get('chapter', 1)): {'label': data.get('label'), 'color': data.get('color')}}
+    for chap, state in incoming.items():
+        timeline.setdefault(chap, copy.deepcopy(state))
+    edge_data['timeline'] = timeline
+    if data.get('chapter', 1) > edge_data.get('chapter', 1):
+        for k in ('chapter', 'label', 'color'):
+            if k in data:
+                edge_data[k] = data[k]
 
 class GraphManager:
-    def __init__(self):
+    def __init__(self, history_limit=200, history_bytes=50_000_000, autosave_delay=0.5, journal_limit=1_000_000):
         if not os.path.exists('data'):
             os.makedirs('data')
-        self.history = []
-        self.history_step = -1
+        self.history = HistoryLog(limit=history_limit, max_bytes=history_bytes)
+        self.journal_limit = journal_limit
+        self._versions = weakref.WeakKeyDictionary()
+        self._subscribers = []
+        self.analytics = CentralityEngine()
+        self.subscribe(self.analytics.apply_change)
+        self.llm_cache = LLMCache("data/llm_cache")
+        self.llm_stats = CompletionStats()
+        self.aliases = AliasTable("data/aliases.json")
+        self.entities = EntityIndex(self.aliases)
+        self.subscribe(self.entities.apply_change)
+        self.layout = LayoutIndex()
+        self.subscribe(self.layout.apply_change)
+        self.checkpoint = IngestCheckpoint("data/ingest_checkpoint.json")
+        self._graph = None
+        self._epoch = None
+        self._seq = 0
+        self._lock = threading.RLock()
+        self._tx = None
+        self._journal = Journal("data/autosave.journal")
+        self._writer = AutosaveWriter(
+            "data/autosave.json", lock=self._lock, delay=autosave_delay,
+            snapshot=self._snapshot, on_written=self._compact_journal
+        )
+
+    def _snapshot(self, graph):
+        if graph is not self._graph:
+            return None
+        graph_data = nx.node_link_data(graph)
+        graph_data["journal"] = {"epoch": self._epoch, "seq": self._seq}
+        return graph_data
+
+    def _compact_journal(self, graph_data):
+        with self._lock:
+            if graph_data["journal"]["epoch"] == self._epoch:
+                self._journal.truncate_through(self._epoch, graph_data["journal"]["seq"])
 
-    def _autosave(self, graph, push_history=True):
+    def _autosave(self, graph):
+        self._writer.schedule(graph)
+
+    def flush(self, timeout=None):
+        return self._writer.flush(timeout)
+
+    def _adopt(self, graph):
+        # 換成另一張圖：舊圖的 Undo 紀錄與日誌都已無法套用，改以新的 epoch 重新寫一份快照
+        self._graph = graph
+        self.history.clear()
+        self.checkpoint.clear()
+        self._epoch = uuid.uuid4().hex
+        self._seq = 0
         try:
-            graph_data = nx.node_link_data(graph)
-            filepath = "data/autosave.json"
-            with open(filepath, "w", encoding="utf-8") as f:
-                json.dump(graph_data, f, ensure_ascii=False, indent=4)
-            if push_history:
-                if self.history_step < len(self.history) - 1:
-                    self.history = self.history[:self.history_step + 1]
-                self.history.append(graph_data)
-                self.history_step += 1
+            self._writer.write_now(graph)
+        except Exception as e:
+            print(f"Autosave failed: {e}")
+
+    def _persist(self, ops):
+        if not ops:
+            return
+        self._seq += 1
+        try:
+            if any(op[0] == "graph" for op in ops):
+                # 整張圖被替換時，直接寫快照比寫日誌更省；先前匯入的章節也不再算完成
+                self.checkpoint.clear()
+                self._writer.write_now(self._graph)
+                return
+            self._journal.append(self._epoch, self._seq, ops)
         except Exception as e:
             print(f"Autosave failed: {e}")
+        if self._journal.size > self.journal_limit:
+            self._autosave(self._graph)
+
+    def graph_version(self, graph):
+        return self._versions.get(graph, 0)
+
+    def subscribe(self, callback):
+        # callback(change: GraphChange) 會在每次變更後被呼叫；回傳取消訂閱的函式
+        self._subscribers.append(callback)
+
+        def unsubscribe():
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+        return unsubscribe
+
+    def _notify(self, graph, ops):
+        version = self._versions.get(graph, 0) + 1
+        self._versions[graph] = version
+        nodes, edges, reset = touched(ops)
+        change = GraphChange(graph, version, frozenset(nodes), frozenset(edges), ops, reset)
+        for callback in list(self._subscribers):
+            try:
+                callback(change)
+            except Exception as e:
+                print(f"Change hook failed: {e}")
+
+    @contextlib.contextmanager
+    def transaction(self, graph):
+        """將多個操作合併為一次變更：
+
+            with manager.transaction(graph):
+                manager.add_character(graph, ...)
+                manager.add_relationship(graph, ...)
+
+        期間的存檔、通知與歷史紀錄都延到結束時一次處理，只留下一個 Undo 步驟；
+        發生例外時已做的變更會全部還原，例外照常拋出。巢狀的交易併入最外層。
+        """
+        with self._lock:
+            if self._tx is not None:
+                if self._tx.graph is not graph:
+                    raise ValueError("交易進行中，不能同時修改另一張圖")
+                yield self._tx
+                return
+            tx = self._tx = Transaction(graph)
+            try:
+                yield tx
+            except BaseException:
+                self._tx = None
+                apply_ops(graph, invert_ops(tx.ops), self.aliases)
+                # 交易中手動加入索引的名稱已隨還原消失，下次使用時重建
+                self.entities.invalidate()
+                raise
+            self._tx = None
+            if tx.ops:
+                self._commit(graph, tx.ops)
+
+    def _commit(self, graph, ops, push_history=True):
+        with self._lock:
+            if self._tx is not None and self._tx.graph is graph:
+                self._tx.record(ops)
+                return
+            if graph is not self._graph:
+                self._adopt(graph)
+            else:
+                self._persist(ops)
+            if push_history:
+                self.history.record(ops)
+            self._notify(graph, ops)
 
+    def _history_status(self):
+        return f"{self.history.cursor}/{len(self.history.steps)}"
+
+    @_locked
     def undo(self):
-        if self.history_step > 0:
-            self.history_step -= 1
-            data = self.history[self.history_step]
-            G = nx.node_link_graph(data, directed=True)
-            self._autosave(G, push_history=False) 
-            return G, f"已復原 (步驟 {self.history_step}/{len(self.history)-1})"
-        return None, "已達最舊紀錄"
+        if self._tx is not None:
+            return None, "交易進行中，無法復原"
+        ops = self.history.undo_ops()
+        if ops is None:
+            return None, "已達最舊紀錄"
+        apply_ops(self._graph, ops, self.aliases)
+        self.checkpoint.clear()  # 復原或重做可能撤掉整本書匯入的章節
+        self._persist(ops)
+        self._notify(self._graph, ops)
+        return self._graph, f"已復原 (步驟 {self._history_status()})"
 
+    @_locked
     def redo(self):
-        if self.history_step < len(self.history) - 1:
-            self.history_step += 1
-            data = self.history[self.history_step]
-            G = nx.node_link_graph(data, directed=True)
-            self._autosave(G, push_history=False)
-            return G, f"已重做 (步驟 {self.history_step}/{len(self.history)-1})"
-        return None, "已是最新紀錄"
+        if self._tx is not None:
+            return None, "交易進行中，無法重做"
+        ops = self.history.redo_ops()
+        if ops is None:
+            return None, "已是最新紀錄"
+        apply_ops(self._graph, ops, self.aliases)
+        self.checkpoint.clear()  # 復原或重做可能撤掉整本書匯入的章節
+        self._persist(ops)
+        self._notify(self._graph, ops)
+        return self._graph, f"已重做 (步驟 {self._history_status()})"
 
     def _load_autosave(self):
         filepath = "data/autosave.json"
@@ -48,10 +230,23 @@ class GraphManager:
             try:
                 with open(filepath, "r", encoding="utf-8") as f:
                     graph_data = json.load(f)
+                journal_info = graph_data.pop("journal", {})
                 G = nx.node_link_graph(graph_data, directed=True)
-                if not self.history:
-                    self.history.append(graph_data)
-                    self.history_step = 0
+
+                # 將快照之後的日誌重播回圖上
+                epoch, seq = journal_info.get("epoch"), journal_info.get("seq", 0)
+                replayed = 0
+                for seq, ops in self._journal.read(epoch, seq):
+                    apply_ops(G, ops)
+                    replayed += 1
+
+                with self._lock:
+                    self._graph = G
+                    self.history.clear()
+                    self._epoch = epoch
+                    self._seq = seq
+                if replayed:
+                    self._autosave(G)
                 return G
             except:
                 return None
@@ -65,160 +260,314 @@ class GraphManager:
         G.add_node("哈利波特", title="存活下來的男孩", type="character", group=1, chapter=1)
         G.add_node("榮恩", title="哈利的好友", type="character", group=1, chapter=1)
         G.add_edge("哈利波特", "榮恩", label="摯友", color="#4CAF50", chapter=1, timeline={"1": {'label': "摯友", 'color': "#4CAF50"}})
-        self._autosave(G, push_history=True)
+        self._commit(G, [], push_history=False)
         return G
 
+    @_locked
     def reset_graph(self, graph):
+        before = graph_state(graph)
         graph.clear()
         graph.add_node("哈利波特", title="存活下來的男孩", type="character", group=1, chapter=1)
         graph.add_node("榮恩", title="哈利的好友", type="character", group=1, chapter=1)
         graph.add_edge("哈利波特", "榮恩", label="摯友", color="#4CAF50", chapter=1, timeline={"1": {'label': "摯友", 'color': "#4CAF50"}})
-        self._autosave(graph, push_history=True)
+        self._commit(graph, [("graph", before, graph_state(graph))])
         return True, "系統已重置為預設狀態"
 
+    @_locked
     def add_character(self, graph, name, description, chapter=1):
         if graph.has_node(name): return False, f"角色 '{name}' 已經存在。"
         graph.add_node(name, title=description, type="character", group=1, chapter=chapter)
-        self._autosave(graph, push_history=True)
+        self._commit(graph, [("node", name, None, node_state(graph, name))])
         return True, f"已新增角色：{name}"
 
+    @_locked
     def add_relationship(self, graph, source, target, relation, chapter=1):
         if graph.has_edge(source, target): return False, f"關係 '{source} -> {target}' 已經存在。"
+        ops = [("node", n, None, {}) for n in dict.fromkeys((source, target)) if not graph.has_node(n)]
         graph.add_edge(source, target, label=relation, chapter=chapter, timeline={str(chapter): {'label': relation, 'color': '#9E9E9E'}})
-        self._autosave(graph, push_history=True)
+        ops.append(("edge", source, target, None, edge_state(graph, source, target)))
+        self._commit(graph, ops)
         return True, f"已連結：{source} --[{relation}]--> {target}"
     
+    @_locked
     def delete_character(self, graph, name):
         if graph.has_node(name):
+            ops = node_removal_ops(graph, name)
             graph.remove_node(name)
-            self._autosave(graph, push_history=True)
+            self._commit(graph, ops)
             return True, f"已刪除角色：{name}"
         return False, f"找不到角色 '{name}'。"
 
+    @_locked
     def delete_relationship(self, graph, source, target):
         if graph.has_edge(source, target):
+            before = edge_state(graph, source, target)
             graph.remove_edge(source, target)
-            self._autosave(graph, push_history=True)
+            self._commit(graph, [("edge", source, target, before, None)])
             return True, f"已移除關係：{source} -> {target}"
         return False, f"找不到關係：{source} -> {target}"
 
+    @_locked
     def edit_character_description(self, graph, name, new_description):
         if graph.has_node(name):
+            before = node_state(graph, name)
             graph.nodes[name]['title'] = new_description
-            self._autosave(graph, push_history=True)
+            self._commit(graph, [("node", name, before, node_state(graph, name))])
             return True, f"已更新 {name} 的描述"
         return False, f"找不到角色 '{name}'。"
         
+    @_locked
     def edit_relationship_label(self, graph, source, target, new_label):
         if graph.has_edge(source, target):
+            before = edge_state(graph, source, target)
             edge_data = graph[source][target]
             edge_data['label'] = new_label
             if 'timeline' in edge_data and edge_data['timeline']:
                 latest_chap = max(edge_data['timeline'].keys())
                 edge_data['timeline'][latest_chap]['label'] = new_label
-            self._autosave(graph, push_history=True)
+            self._commit(graph, [("edge", source, target, before, edge_state(graph, source, target))])
             return True, f"已更新關係：{source} --[{new_label}]--> {target}"
         return False, f"找不到關係：{source} -> {target}"
 
     def save_graph(self, graph, filename):
         try:
-            filepath = f"data/{filename}.json"
-            graph_data = nx.node_link_data(graph)
-            with open(filepath, "w", encoding="utf-8") as f:
-                json.dump(graph_data, f, ensure_ascii=False, indent=4)
+            # 依副檔名決定格式：.nxg 為二進位格式，其餘預設為 JSON
+            if os.path.splitext(filename)[1].lower() not in (".json", ".nxg"):
+                filename = f"{filename}.json"
+            filepath = f"data/{filename}"
+            with self._lock:
+                write_graph(graph, filepath)
             return True, f"專案已儲存至 {filepath}"
         except Exception as e:
             return False, f"存檔失敗：{str(e)}"
 
+    @_locked
     def load_graph(self, uploaded_file):
         try:
-            graph_data = json.load(uploaded_file)
-            G = nx.node_link_graph(graph_data, directed=True)
-            self._autosave(G, push_history=True)
-            return G, f"成功讀取專案：{uploaded_file.name}"
+            G = read_graph(uploaded_file)
+            if self._graph is None:
+                self._commit(G, [], push_history=False)
+            else:
+                # 直接在目前的圖上替換內容，讀檔也能被 Undo
+                ops = [("graph", graph_state(self._graph), graph_state(G))]
+                apply_ops(self._graph, ops)
+                self._commit(self._graph, ops)
+            return self._graph, f"成功讀取專案：{uploaded_file.name}"
         except Exception as e:
             return None, f"讀檔失敗：{str(e)}"
 
-    def process_text_with_ai(self, text, api_key):
-        if api_key.startswith("gsk_"):
-            client = OpenAI(api_key=api_key, base_url="https://api.groq.com/openai/v1")
-            model_name = "llama-3.3-70b-versatile" 
-        else:
-            client = OpenAI(api_key=api_key)
-            model_name = "gpt-4o"
+    def _ai_client(self, api_key, base_url=None, model=None):
+        if base_url is None and api_key.startswith("gsk_"):
+            base_url = "https://api.groq.com/openai/v1"
+            model = model or "llama-3.3-70b-versatile"
+        return get_client(api_key, base_url), model or "gpt-4o"
 
-        system_prompt = """
-        你是一個知識圖譜專家與心理學大師。請從使用者的文本中萃取「實體(Nodes)」與「關係(Edges)」。
-        
-        【任務要求】：
-        1. 簡介 (title)：為每個實體生成一句 15 字以內的角色簡介。請注意，不要萃取地點、物品或金錢等非角色實體。
-        2. 關係顏色 (color)：請精準判斷這段關係的屬性：
-           - 若為明確的敵對、仇恨、對立，請給 "#F44336" (紅色)。
-           - 若為明確的友善、保護、同盟，請給 "#4CAF50" (綠色)。
-           - 若為單純的客觀事件、商業交易、情緒中立，請給 "#9E9E9E" (灰色)。
-
-        務必回傳純 JSON 格式：
-        {
-            "nodes": [{"id": "實體名稱", "title": "角色簡介(AI生成)"}],
-            "edges": [{"source": "實體名稱", "target": "實體名稱", "label": "關係類型", "color": "顏色代碼"}]
-        }
-        """
+    def _extraction_plan(self, text, graph, chunk_size, token_budget):
+        # 給了 graph 就附上段落中提到的既有角色；給了 token_budget (模型的上下文長度) 就依預算換算每段字數
+        known = KnownEntities(graph) if graph is not None and graph.number_of_nodes() else None
+        if token_budget:
+            reserved = estimate_tokens(SYSTEM_PROMPT) + (known.max_tokens if known else 0) + RESPONSE_TOKENS
+            chunk_size = chunk_size_for_budget(text, token_budget, reserved)
+        return chunk_size, known
+
+    def process_text_with_ai(self, text, api_key, base_url=None, model=None, chunk_size=3000, overlap=200,
+                             max_workers=4, rate_limit=None, stream=False, graph=None, token_budget=None):
+        # 長文會切成重疊的段落並行送出 (最多 max_workers 個同時進行、每秒最多 rate_limit 個請求)，結果合併去重；
+        # 用戶端依 (api_key, base_url) 共用，429 / 5xx 會自動退避重試，每次請求的延遲記錄在 llm_stats
+        client, model_name = self._ai_client(api_key, base_url, model)
+        chunk_size, known = self._extraction_plan(text, graph, chunk_size, token_budget)
         try:
-            response = client.chat.completions.create(
-                model=model_name,
-                messages=[{"role": "system", "content": system_prompt}, {"role": "user", "content": text}],
-                response_format={"type": "json_object"}, temperature=0.1
-            )
-            raw = response.choices[0].message.content
-            res = json.loads(raw)
-            return res.get("nodes", []), res.get("edges", []), None
+            return extract_text(client, model_name, text, chunk_size=chunk_size, overlap=overlap,
+                                max_workers=max_workers, rate_limit=rate_limit, cache=self.llm_cache,
+                                stream=stream, stats=self.llm_stats, known=known)
         except Exception as e:
             return [], [], str(e)
 
+    def stream_text_with_ai(self, text, api_key, base_url=None, model=None, chunk_size=3000, overlap=200,
+                            max_workers=4, rate_limit=None, graph=None, token_budget=None):
+        """與 process_text_with_ai 相同，但邊生成邊產生 ("nodes" / "edges" / "error", 內容)，讓介面能逐筆顯示。"""
+        client, model_name = self._ai_client(api_key, base_url, model)
+        chunk_size, known = self._extraction_plan(text, graph, chunk_size, token_budget)
+        try:
+            yield from iter_extract(client, model_name, text, chunk_size=chunk_size, overlap=overlap,
+                                    max_workers=max_workers, rate_limit=rate_limit, cache=self.llm_cache,
+                                    stats=self.llm_stats, known=known)
+        except Exception as e:
+            yield "error", str(e)
+
+    def ingest_book(self, graph, lines, api_key, source, pattern=CHAPTER_PATTERN, start=1, **ai_options):
+        """整本書逐章匯入：依章節標題切開，每章萃取後以該章編號 batch_import，並在完成後記入檢查點。
+
+        每處理完一章就產生一筆進度 {"chapter", "title", "status", "message"}，status 為
+        "skipped" (先前已完成)、"done"、"partial" (部分段落失敗，下次會重跑) 或 "failed" (整章失敗，就此停止)。
+        中斷後以相同的 source、pattern 與 start 對同一張圖重新執行，已完成且內容未變的章節會直接略過；
+        換成另一張圖、重置、讀取專案或復原後進度會清除，可用 reset_ingest 手動清除。
+        """
+        # 先接手這張圖：換成新的圖時會清除舊圖的匯入進度，之後的章節才不會被誤判為已完成
+        with self._lock:
+            if graph is not self._graph:
+                self._commit(graph, [], push_history=False)
+        book = self.checkpoint.key(source, pattern, start)
+        for number, title, text in iter_chapters(lines, pattern, start):
+            digest = chapter_digest(text)
+            event = {"chapter": number, "title": title}
+            if self.checkpoint.is_done(book, number, digest):
+                yield dict(event, status="skipped", message="已完成，略過")
+                continue
+            nodes, edges, error = self.process_text_with_ai(text, api_key, graph=graph, **ai_options) if text else ([], [], None)
+            if error and not nodes and not edges:
+                yield dict(event, status="failed", message=error)
+                return
+            msg = self.batch_import(graph, nodes, edges, chapter=number)
+            if error:
+                yield dict(event, status="partial", message=f"{msg} ({error})")
+                continue
+            # 匯入的變更已寫入日誌，才把這一章記為完成
+            self.checkpoint.mark(book, number, digest)
+            yield dict(event, status="done", message=msg)
+
+    def reset_ingest(self, source, pattern=CHAPTER_PATTERN, start=1):
+        self.checkpoint.reset(self.checkpoint.key(source, pattern, start))
+        return True, f"已清除 '{source}' 的匯入進度"
+
+    @_locked
     def batch_import(self, graph, nodes, edges, chapter=1):
         count_n = 0
         count_e = 0
-        for n in nodes:
-            node_id = n.get("id") or n.get("name")
-            if node_id:
-                if not graph.has_node(node_id):
+        with self.transaction(graph) as tx:
+            # 名稱先經過實體解析 (別名表、正規化比對)，「Harry Potter」與「harry potter」才不會變成兩個角色；
+            # 只是相似的名稱 (「哈利」與「哈利波特」) 不自動合併，留給「合併重複角色」由使用者確認
+            entities = self.entities
+            entities.sync(graph, self.graph_version(graph))
+            new_nodes = {}
+            for n in nodes:
+                node_id = n.get("id") or n.get("name")
+                if node_id and entities.resolve(node_id) is None:
                     attrs = {k: v for k, v in n.items() if k not in ['id', 'name']}
                     attrs['group'] = 1
                     attrs['chapter'] = chapter
-                    graph.add_node(node_id, **attrs)
+                    new_nodes[node_id] = attrs
+                    entities.add(node_id)
                     count_n += 1
-                    
-        for e in edges:
-            source = e.get("source")
-            target = e.get("target")
-            label = e.get("label", "related")
-            color = e.get("color", "#9E9E9E")
-            
-            if source and target:
-                if not graph.has_node(source): graph.add_node(source, title="Auto", type="character", group=1, chapter=chapter)
-                if not graph.has_node(target): graph.add_node(target, title="Auto", type="character", group=1, chapter=chapter)
-                
+
+            new_edges = {}
+            for e in edges:
+                source = e.get("source")
+                target = e.get("target")
+                label = e.get("label", "related")
+                color = e.get("color", "#9E9E9E")
+                if not source or not target:
+                    continue
+                source = entities.resolve(source) or source
+                target = entities.resolve(target) or target
+                for n in (source, target):
+                    if not graph.has_node(n) and n not in new_nodes:
+                        new_nodes[n] = {"title": "Auto", "type": "character", "group": 1, "chapter": chapter}
+                        entities.add(n)
+                count_e += 1
+
                 if graph.has_edge(source, target):
+                    before = edge_state(graph, source, target)
                     edge_data = graph[source][target]
                     if 'timeline' not in edge_data:
                         orig_chap = edge_data.get('chapter', 1)
                         edge_data['timeline'] = {str(orig_chap): {'label': edge_data.get('label'), 'color': edge_data.get('color')}}
-                    
                     edge_data['timeline'][str(chapter)] = {'label': label, 'color': color}
-                    
                     if chapter >= edge_data.get('chapter', 1):
                         edge_data['chapter'] = chapter
                         edge_data['label'] = label
                         edge_data['color'] = color
-                    count_e += 1
+                    # 既有關係是直接修改的，立即記下變更，後面的項目出錯時才能還原
+                    tx.record([("edge", source, target, before, edge_state(graph, source, target))])
                 else:
-                    graph.add_edge(source, target, label=label, color=color, chapter=chapter, timeline={str(chapter): {'label': label, 'color': color}})
-                    count_e += 1
-        
-        self._autosave(graph, push_history=True)
+                    # 同一批中重複出現的關係以最後一筆為準
+                    new_edges[(source, target)] = {'label': label, 'color': color, 'chapter': chapter,
+                                                   'timeline': {str(chapter): {'label': label, 'color': color}}}
+
+            # 新角色與新關係以批次方式加入，變更紀錄先記下，中途失敗也能完整還原
+            tx.record([("node", n, None, copy.deepcopy(attrs)) for n, attrs in new_nodes.items()])
+            graph.add_nodes_from(new_nodes.items())
+            tx.record([("edge", u, v, None, copy.deepcopy(attrs)) for (u, v), attrs in new_edges.items()])
+            graph.add_edges_from((u, v, attrs) for (u, v), attrs in new_edges.items())
         return f"已處理 {count_n} 個新實體，並更新/新增 {count_e} 條關係！"
-    
-    def analyze_centrality(self, graph):
+
+    @_locked
+    def merge_characters(self, graph, target, sources):
+        """將 sources 合併到 target：關係改接到 target (同一對關係的時間軸合併)，缺少的屬性由來源補上，
+        來源名稱記入別名表。整個合併 (包含別名) 是一次變更，可一步復原。"""
+        sources = [s for s in dict.fromkeys(sources) if s != target]
+        if not graph.has_node(target):
+            return False, f"找不到角色 '{target}'。"
+        missing = [s for s in sources if not graph.has_node(s)]
+        if missing:
+            return False, f"找不到角色 '{missing[0]}'。"
+        if not sources:
+            return False, "請選擇要合併的角色。"
+
+        before_target = node_state(graph, target)
+        data = graph.nodes[target]
+        ops = []
+        for s in sources:
+            for k, v in graph.nodes[s].items():
+                if v not in (None, "", "Auto") and data.get(k) in (None, "", "Auto"):
+                    data[k] = v
+            data['chapter'] = min(data.get('chapter', 1), graph.nodes[s].get('chapter', 1))
+            moved = [(u, v, d) for u, v, d in graph.in_edges(s, data=True)]
+            moved += [(u, v, d) for u, v, d in graph.out_edges(s, data=True) if v != s]
+            for u, v, d in moved:
+                u, v = (target if u == s else u), (target if v == s else v)
+                if u == v:
+                    continue
+                before = edge_state(graph, u, v)
+                _merge_edge(graph, u, v, d)
+                ops.append(("edge", u, v, before, edge_state(graph, u, v)))
+            ops.extend(node_removal_ops(graph, s))
+            graph.remove_node(s)
+        ops.append(("node", target, before_target, node_state(graph, target)))
+        # 別名的變更也記入同一個步驟，復原合併時一併撤銷
+        before_aliases = dict(self.aliases.items())
+        for s in sources:
+            self.aliases.add(s, target)
+        after_aliases = dict(self.aliases.items())
+        changed = [("alias", a, before_aliases.get(a), after_aliases.get(a))
+                   for a in before_aliases.keys() | after_aliases.keys() if before_aliases.get(a) != after_aliases.get(a)]
+        # 先刪後設：同一個正規化名稱換了寫法時，復原 (順序反過來) 才不會把還原的別名又刪掉
+        ops += sorted(changed, key=lambda op: (op[3] is not None, str(op[1])))
+        self._commit(graph, ops)
+        return True, f"已將 {'、'.join(map(str, sources))} 合併到 {target}"
+
+    def analyze_centrality(self, graph, metric="degree", k=5):
         if not graph or graph.number_of_nodes() == 0: return []
-        centrality = nx.degree_centrality(graph)
-        return sorted(centrality.items(), key=lambda x: x[1], reverse=True)[:5]
\ No newline at end of file
+        self.analytics.sync(graph, self.graph_version(graph))
+        return self.analytics.top(metric, k)
+
+    def _store_positions(self, graph, pos):
+        ops = []
+        for name, (x, y) in pos.items():
+            before = node_state(graph, name)
+            graph.nodes[name]['x'] = round(float(x), 2)
+            graph.nodes[name]['y'] = round(float(y), 2)
+            ops.append(("node", name, before, node_state(graph, name)))
+        self._commit(graph, ops, push_history=False)
+
+    @_locked
+    def layout_graph(self, graph, iterations=150, seed=None):
+        """在伺服器端計算排版，座標以 x / y 屬性存入角色並隨專案儲存；排版不列入 Undo 歷史。"""
+        if graph.number_of_nodes() == 0:
+            return False, "圖中沒有角色"
+        pos = force_layout(graph, iterations=iterations, seed=seed)
+        self._store_positions(graph, pos)
+        return True, f"已完成 {len(pos)} 個角色的排版"
+
+    @_locked
+    def ensure_layout(self, graph):
+        # 只替缺少座標的角色排版：全部都沒有時整張圖排版，否則只放置新角色，其餘座標不動
+        self.layout.sync(graph, self.graph_version(graph))
+        missing = sorted(self.layout.missing, key=str)
+        if not missing:
+            return False
+        if len(missing) == graph.number_of_nodes():
+            self.layout_graph(graph)
+        else:
+            self._store_positions(graph, place_nodes(graph, missing, index=self.layout))
+        return True
@@ -0,0 +1,180 @@
+from collections import Counter, OrderedDict, defaultdict
+import networkx as nx
+from modules.timeline import DEFAULT_COLOR
+
+CLUSTER_PREFIX = "cluster:"
+
+
+def cluster_node(cid):
+    return f"{CLUSTER_PREFIX}{cid}"
+
+
+class ClusterIndex:
+    """大型圖的細節層級 (LOD)：以社群偵測分群，超過門檻時把群組收合成代表節點。
+
+    分群結果依圖的版本快取，變更時只把新角色歸入鄰居最多的群組，不必重新偵測。
+    """
+
+    def __init__(self, threshold=2000, cache_size=8, seed=0):
+        self.threshold = threshold
+        self.cache_size = cache_size
+        self.seed = seed
+        self._graph = None
+        self._version = None
+        self._membership = None
+        self._members = None
+        self._loners = None   # 孤立角色共用的群組編號
+        self._cache = OrderedDict()
+
+    # --- 同步 ---
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self.rebuild(graph)
+        self._version = version
+
+    def rebuild(self, graph):
+        self._graph = graph
+        self._membership = None
+        self._members = None
+        self._loners = None
+        self._cache.clear()
+
+    def apply_change(self, change):
+        # 供 GraphManager.subscribe 使用：新角色歸入鄰居所屬的群組，刪除的角色直接移除
+        if change.graph is not self._graph or self._version != change.version - 1:
+            return
+        if change.reset:
+            self.rebuild(change.graph)
+        elif self._membership is not None:
+            graph = change.graph
+            for n in change.nodes:
+                if not graph.has_node(n):
+                    cid = self._membership.pop(n, None)
+                    if cid is not None:
+                        self._members[cid].discard(n)
+                elif n not in self._membership:
+                    self._assign(n)
+            self._cache.clear()
+        else:
+            self._cache.clear()
+        self._version = change.version
+
+    # --- 分群 ---
+
+    def _detect(self):
+        graph = self._graph
+        undirected = graph.to_undirected(as_view=True)
+        communities = nx.community.louvain_communities(undirected, seed=self.seed)
+        # 孤立的角色不各自成群，統一收進同一個群組
+        loners = set().union(*[c for c in communities if len(c) == 1]) if communities else set()
+        groups = [set(c) for c in communities if len(c) > 1]
+        if loners:
+            groups.append(loners)
+        groups.sort(key=len, reverse=True)
+
+        self._members = dict(enumerate(groups))
+        self._membership = {n: cid for cid, members in self._members.items() for n in members}
+        self._loners = next((cid for cid, members in self._members.items() if members is loners), None)
+
+    def _assign(self, n):
+        votes = Counter(self._membership[m] for m in nx.all_neighbors(self._graph, n) if m in self._membership)
+        if votes:
+            cid = votes.most_common(1)[0][0]
+        else:
+            # 沒有鄰居的新角色與 _detect 一樣收進孤立角色的群組，不各自成群
+            if self._loners is None:
+                self._loners = max(self._members, default=-1) + 1
+            cid = self._loners
+        self._membership[n] = cid
+        self._members.setdefault(cid, set()).add(n)
+
+    def membership(self):
+        if self._membership is None:
+            self._detect()
+        return self._membership
+
+    def active(self, view=None):
+        graph = self._graph if view is None else view
+        return graph is not None and graph.number_of_nodes() > self.threshold
+
+    def clusters(self):
+        """回傳 [(群組編號, 代表節點名稱, 顯示名稱, 人數), ...]，依人數排序。"""
+        self.membership()
+        result = []
+        for cid, members in self._members.items():
+            if members:
+                result.append((cid, self.node_name(cid), self._label(members), len(members)))
+        return sorted(result, key=lambda c: c[3], reverse=True)
+
+    def node_name(self, cid):
+        """群組代表節點的名稱，通常為「cluster:編號」；與角色名稱相同時在前面再加上前綴，直到不衝突為止。"""
+        name = cluster_node(cid)
+        while self._graph.has_node(name):
+            name = CLUSTER_PREFIX + name
+        return name
+
+    def _label(self, members):
+        hub = max(members, key=lambda n: (self._graph.degree(n), str(n)))
+        return f"{hub} 等 {len(members)} 人"
+
+    # --- 收合 ---
+
+    def collapse(self, view, expanded=(), key=None):
+        """將 view (完整圖或某章節的時間軸子圖) 中未展開的群組收合成代表節點，關係數量彙總到群組之間。
+
+        key 用來區分同一版本的不同子圖 (例如章節)；結果依 (版本, key, 展開的群組) 快取。
+        """
+        if not self.active(view):
+            return view
+        cache_key = (self._version, key, frozenset(expanded))
+        if cache_key in self._cache:
+            self._cache.move_to_end(cache_key)
+            return self._cache[cache_key]
+
+        membership = self.membership()
+        expanded = set(expanded)
+
+        def target(n):
+            cid = membership.get(n)
+            return n if cid is None or cid in expanded else self.node_name(cid)
+
+        G = nx.DiGraph()
+        grouped = defaultdict(list)
+        for n, data in view.nodes(data=True):
+            t = target(n)
+            if t == n:
+                G.add_node(n, **data)
+            else:
+                grouped[t].append((n, data))
+
+        for t, members in grouped.items():
+            names = [n for n, _ in members]
+            attrs = {
+                'label': self._label(names),
+                'title': "、".join(map(str, names[:20])) + (" ⋯" if len(names) > 20 else ""),
+                'value': len(names),
+                'shape': "diamond",
+            }
+            placed = [(d['x'], d['y']) for _, d in members if 'x' in d and 'y' in d]
+            if len(placed) == len(members):
+                # 代表節點放在成員座標的重心，收合與展開時畫面位置一致
+                attrs['x'] = sum(x for x, _ in placed) / len(placed)
+                attrs['y'] = sum(y for _, y in placed) / len(placed)
+            G.add_node(t, **attrs)
+
+        rolled = Counter()
+        for u, v, data in view.edges(data=True):
+            tu, tv = target(u), target(v)
+            if tu == u and tv == v:
+                G.add_edge(u, v, **data)
+            elif tu != tv:
+                rolled[(tu, tv)] += 1
+        for (tu, tv), count in rolled.items():
+            G.add_edge(tu, tv, label=f"{count} 條關係", value=count, color=DEFAULT_COLOR)
+
+        self._cache[cache_key] = G
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return G
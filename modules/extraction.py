@@ -0,0 +1,376 @@
+import json
+import queue
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules.llm_client import complete, stream_completion
+
+SYSTEM_PROMPT = """
+        你是一個知識圖譜專家與心理學大師。請從使用者的文本中萃取「實體(Nodes)」與「關係(Edges)」。
+
+        【任務要求】：
+        1. 簡介 (title)：為每個實體生成一句 15 字以內的角色簡介。請注意，不要萃取地點、物品或金錢等非角色實體。
+        2. 關係顏色 (color)：請精準判斷這段關係的屬性：
+           - 若為明確的敵對、仇恨、對立，請給 "#F44336" (紅色)。
+           - 若為明確的友善、保護、同盟，請給 "#4CAF50" (綠色)。
+           - 若為單純的客觀事件、商業交易、情緒中立，請給 "#9E9E9E" (灰色)。
+
+        務必回傳純 JSON 格式：
+        {
+            "nodes": [{"id": "實體名稱", "title": "角色簡介(AI生成)"}],
+            "edges": [{"source": "實體名稱", "target": "實體名稱", "label": "關係類型", "color": "顏色代碼"}]
+        }
+        """
+
+# 估算每段預算時替模型回應保留的 token 數
+RESPONSE_TOKENS = 2048
+
+KNOWN_PROMPT = """
+        【圖譜中已有的角色】：{names}
+        這些角色已經存在，不要放進 nodes；關係中提到他們時請直接使用上面的名稱。
+        【已知關係】：{edges}
+        以上關係若沒有改變就不要再回傳，只回傳新的關係或屬性有改變的關係。
+        """
+
+# 優先在段落或句子結尾切開，避免把一句話拆到兩段
+_BREAKS = re.compile(r"\n\s*\n|[。！？!?\n]")
+_CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]")
+
+
+def split_text(text, chunk_size=3000, overlap=200):
+    """將長文切成約 chunk_size 字的段落，相鄰段落重疊 overlap 字，跨段落的關係才不會漏掉。"""
+    text = text.strip()
+    if len(text) <= chunk_size:
+        return [text] if text else []
+    overlap = min(overlap, chunk_size // 2)
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        if end < len(text):
+            # 在後半段找最後一個斷句點
+            breaks = [m.end() for m in _BREAKS.finditer(text, start + chunk_size // 2, end)]
+            if breaks:
+                end = breaks[-1]
+        chunks.append(text[start:end])
+        if end >= len(text):
+            break
+        # 重疊部分同樣從斷句點開始，避免下一段從半個詞開頭
+        next_start = end - overlap
+        m = _BREAKS.search(text, next_start, end)
+        start = max(m.end() if m and m.end() < end else next_start, start + 1)
+    return chunks
+
+
+def estimate_tokens(text):
+    """粗估 token 數：中日韓文字約一字一個 token，其他文字約四個字元一個 token。"""
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def chunk_size_for_budget(text, max_tokens, reserved_tokens=0, minimum=500):
+    """依文本實際的字元 / token 比例，換算出扣掉提示與輸出保留量後，每段最多可放幾個字。"""
+    sample = text[:20000]
+    chars_per_token = len(sample) / max(1, estimate_tokens(sample))
+    return max(minimum, int((max_tokens - reserved_tokens) * chars_per_token))
+
+
+class KnownEntities:
+    """圖中既有角色的名稱索引：找出段落裡提到的角色與他們之間已知的關係，附在提示中，讓模型只回報新資訊。
+
+    名稱依前兩個字建立索引，掃描段落時每個位置只需查一次，與圖的大小無關。
+    """
+
+    def __init__(self, graph, max_tokens=400):
+        self.graph = graph
+        self.max_tokens = max_tokens
+        self._index = {}
+        for name in graph.nodes:
+            if isinstance(name, str) and name:
+                self._index.setdefault(name[:2], []).append(name)
+
+    def find(self, chunk):
+        """依出現順序回傳段落中提到的既有角色。"""
+        found = {}
+        for i in range(len(chunk)):
+            for key in {chunk[i:i + 2], chunk[i]}:
+                for name in self._index.get(key, ()):
+                    if name not in found and chunk.startswith(name, i):
+                        found[name] = i
+        return list(found)
+
+    def prompt(self, chunk):
+        """回傳要附加在系統提示後的已知角色與關係 (總長度不超過 max_tokens)；段落中沒有既有角色時回傳空字串。"""
+        names = self.find(chunk)
+        if not names:
+            return ""
+        budget = self.max_tokens - estimate_tokens(KNOWN_PROMPT)
+        listed = []
+        for name in names:
+            budget -= estimate_tokens(name) + 1
+            if budget < 0:
+                break
+            listed.append(name)
+        edges = []
+        present = set(listed)
+        for u in listed:
+            for v, data in self.graph.adj[u].items():
+                if v in present:
+                    line = f"{u}→{v}：{data.get('label', '')}"
+                    budget -= estimate_tokens(line) + 1
+                    if budget < 0:
+                        break
+                    edges.append(line)
+            if budget < 0:
+                break
+        return KNOWN_PROMPT.format(names="、".join(listed), edges="；".join(edges) or "無")
+
+
+class RateLimiter:
+    """限制每秒送出的請求數 (多執行緒共用)；rate 為 None 時不限制。"""
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class PartialJSONItems:
+    """逐段解析模型輸出的 {"nodes": [...], "edges": [...]}，每個物件一完整就立即取出，不必等整份 JSON 收完。"""
+
+    def __init__(self, keys=("nodes", "edges")):
+        self.keys = keys
+        self._text = ""
+        self._pos = 0
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._array = None
+        self._item_start = None
+
+    def feed(self, delta):
+        """加入新收到的文字，回傳這次完成的 [(key, 物件), ...]。"""
+        self._text += delta
+        items = []
+        text = self._text
+        for i in range(self._pos, len(text)):
+            c = text[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+                    if self._depth == 1:
+                        self._last_string = text[self._string_start + 1:i]
+            elif c == '"':
+                self._in_string = True
+                self._string_start = i
+            elif c in "{[":
+                self._depth += 1
+                if c == "[" and self._depth == 2:
+                    self._array = self._last_string if self._last_string in self.keys else None
+                elif c == "{" and self._depth == 3 and self._array is not None:
+                    self._item_start = i
+            elif c in "}]":
+                if c == "}" and self._depth == 3 and self._item_start is not None:
+                    try:
+                        items.append((self._array, json.loads(text[self._item_start:i + 1])))
+                    except ValueError:
+                        pass
+                    self._item_start = None
+                elif c == "]" and self._depth == 2:
+                    self._array = None
+                self._depth -= 1
+        self._pos = len(text)
+        # 已解析完的部分不再需要保留
+        keep = self._item_start if self._item_start is not None else (self._string_start if self._in_string else self._pos)
+        self._text = text[keep:]
+        self._pos -= keep
+        if self._item_start is not None:
+            self._item_start -= keep
+        if self._in_string:
+            self._string_start -= keep
+        return items
+
+
+def parse_response(raw):
+    res = json.loads(raw)
+    return res.get("nodes", []) or [], res.get("edges", []) or []
+
+
+def extract_chunk(client, model, chunk, system_prompt=SYSTEM_PROMPT, stream=False, stats=None):
+    raw = complete(
+        client, model,
+        [{"role": "system", "content": system_prompt}, {"role": "user", "content": chunk}],
+        stream=stream, stats=stats,
+        response_format={"type": "json_object"}, temperature=0.1
+    )
+    return parse_response(raw)
+
+
+def _item_key(kind, item):
+    # 角色以 id (或 name)、關係以 (source, target) 合併；模型偶爾回傳串列或物件當名稱，這類項目直接略過
+    if not isinstance(item, dict):
+        return None
+    if kind == "nodes":
+        key = item.get("id") or item.get("name")
+        if not key:
+            return None
+    else:
+        key = (item.get("source"), item.get("target"))
+        if not all(key):
+            return None
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+def _fill(merged, item):
+    for k, v in item.items():
+        if v and not merged.get(k):
+            merged[k] = v
+
+
+def merge_results(results):
+    """合併各段落的結果：同名角色與同一對關係只保留一筆，缺少的欄位由後面的段落補上。"""
+    merged = {"nodes": {}, "edges": {}}
+    for chunk_nodes, chunk_edges in results:
+        for kind, items in (("nodes", chunk_nodes), ("edges", chunk_edges)):
+            for item in items:
+                key = _item_key(kind, item)
+                if key is not None:
+                    _fill(merged[kind].setdefault(key, {}), item)
+    return list(merged["nodes"].values()), list(merged["edges"].values())
+
+
+def extract_text(client, model, text, chunk_size=3000, overlap=200, max_workers=4, rate_limit=None,
+                 system_prompt=SYSTEM_PROMPT, cache=None, stream=False, stats=None, known=None):
+    """分段並行萃取，回傳 (nodes, edges, error)。
+
+    max_workers 為同時進行的請求數，rate_limit 為每秒最多送出的請求數。
+    部分段落失敗時仍回傳其他段落的結果，error 會說明失敗的段落數。
+    cache (LLMCache) 中已有的段落直接取用，不會呼叫 API，也不受速率限制。
+    stream 與 stats (CompletionStats) 見 modules.llm_client.complete。
+    known (KnownEntities) 會在每段的提示後附上段落中提到的既有角色，模型只需回報新角色與改變的關係。
+    """
+    chunks = split_text(text, chunk_size, overlap)
+    if not chunks:
+        return [], [], None
+    limiter = RateLimiter(rate_limit)
+
+    def run(chunk):
+        prompt = system_prompt + known.prompt(chunk) if known is not None else system_prompt
+        if cache is not None:
+            cached = cache.get(model, prompt, chunk)
+            if cached is not None:
+                return cached["nodes"], cached["edges"]
+        limiter.wait()
+        nodes, edges = extract_chunk(client, model, chunk, prompt, stream=stream, stats=stats)
+        if cache is not None:
+            cache.put(model, prompt, chunk, {"nodes": nodes, "edges": edges})
+        return nodes, edges
+
+    results, errors = [], []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as pool:
+        futures = [pool.submit(run, chunk) for chunk in chunks]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                errors.append(str(e))
+
+    nodes, edges = merge_results(results)
+    if not errors:
+        return nodes, edges, None
+    if len(errors) == len(chunks):
+        return [], [], errors[0]
+    return nodes, edges, f"{len(errors)}/{len(chunks)} 個段落分析失敗：{errors[0]}"
+
+
+def iter_extract(client, model, text, chunk_size=3000, overlap=200, max_workers=4, rate_limit=None,
+                 system_prompt=SYSTEM_PROMPT, cache=None, stats=None, known=None):
+    """串流版的 extract_text：各段落並行以串流方式送出，每解析出一個角色或關係就立即產生。
+
+    產生 ("nodes", 角色)、("edges", 關係) 或 ("error", 訊息)；同名角色與同一對關係只在第一次出現時產生，
+    之後段落補上的欄位會直接寫入先前產生的那個 dict，全部讀完後的結果與 extract_text (merge_results) 相同。
+    """
+    chunks = split_text(text, chunk_size, overlap)
+    if not chunks:
+        return
+    limiter = RateLimiter(rate_limit)
+    events = queue.Queue()
+    done = object()
+
+    def run(chunk):
+        try:
+            prompt = system_prompt + known.prompt(chunk) if known is not None else system_prompt
+            if cache is not None:
+                cached = cache.get(model, prompt, chunk)
+                if cached is not None:
+                    for key in ("nodes", "edges"):
+                        for item in cached[key]:
+                            events.put((key, item))
+                    return
+            limiter.wait()
+            parser = PartialJSONItems()
+            parts = []
+            messages = [{"role": "system", "content": prompt}, {"role": "user", "content": chunk}]
+            for delta in stream_completion(client, model, messages, stats=stats,
+                                           response_format={"type": "json_object"}, temperature=0.1):
+                parts.append(delta)
+                for item in parser.feed(delta):
+                    events.put(item)
+            # 以完整內容再解析一次，補上逐段解析時可能漏掉的項目 (重複的會被略過)
+            nodes, edges = parse_response("".join(parts))
+            for item in nodes:
+                events.put(("nodes", item))
+            for item in edges:
+                events.put(("edges", item))
+            if cache is not None:
+                cache.put(model, prompt, chunk, {"nodes": nodes, "edges": edges})
+        except Exception as e:
+            events.put(("error", str(e)))
+        finally:
+            events.put(done)
+
+    merged = {"nodes": {}, "edges": {}}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks)))) as pool:
+        for chunk in chunks:
+            pool.submit(run, chunk)
+        remaining = len(chunks)
+        while remaining:
+            event = events.get()
+            if event is done:
+                remaining -= 1
+                continue
+            kind, item = event
+            if kind not in merged:
+                yield event
+                continue
+            key = _item_key(kind, item)
+            if key is None:
+                continue
+            target = merged[kind].get(key)
+            if target is None:
+                target = merged[kind][key] = {}
+                _fill(target, item)
+                yield kind, target
+            else:
+                _fill(target, item)
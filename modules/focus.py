@@ -0,0 +1,80 @@
+from collections import OrderedDict
+import networkx as nx
+
+FOCUS_COLOR = "#FFC107"
+
+
+class NeighborhoodIndex:
+    """聚焦模式：以 BFS 取出角色 k 步內 (入邊與出邊皆算) 的鄰域子圖，成本只與鄰域大小有關。
+
+    每個 (角色, 章節) 的 BFS 分層結果依圖的版本快取；加大 k 時從上次的最外層繼續擴展，縮小 k 時直接取前幾層。
+    chapter 不為 None 時只走當時已存在的關係 (由 TimelineIndex 判斷)。
+    """
+
+    def __init__(self, timeline, cache_size=32):
+        self.timeline = timeline
+        self.cache_size = cache_size
+        self._graph = None
+        self._version = None
+        self._frontiers = OrderedDict()   # (角色, 章節) -> [第 0 層, 第 1 層, ...]
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self._graph = graph
+        self._version = version
+        self._frontiers.clear()
+
+    def _active(self, u, v, chapter):
+        return chapter is None or self.timeline.edge_state(u, v, chapter) is not None
+
+    def layers(self, center, k, chapter=None):
+        """回傳 BFS 分層 [{center}, 距離 1 的角色, ...]，最多 k + 1 層 (鄰域已走完時會較少)。"""
+        key = (center, chapter)
+        layers = self._frontiers.get(key)
+        if layers is None:
+            layers = self._frontiers[key] = [{center}]
+            while len(self._frontiers) > self.cache_size:
+                self._frontiers.popitem(last=False)
+        else:
+            self._frontiers.move_to_end(key)
+        graph = self._graph
+        while len(layers) <= k and layers[-1]:
+            seen = layers[-2] | layers[-1] if len(layers) > 1 else layers[-1]
+            frontier = set()
+            for u in layers[-1]:
+                for v in graph.succ[u]:
+                    if v not in seen and self._active(u, v, chapter):
+                        frontier.add(v)
+                for v in graph.pred[u]:
+                    if v not in seen and self._active(v, u, chapter):
+                        frontier.add(v)
+            layers.append(frontier)
+        return [layer for layer in layers[:k + 1] if layer]
+
+    def subgraph(self, center, k=2, chapter=None):
+        """回傳聚焦用的子圖：鄰域內的角色與他們之間 (當時存在) 的關係，中心角色以醒目顏色標示。"""
+        G = nx.DiGraph()
+        graph = self._graph
+        if center not in graph:
+            return G
+        nodes = set().union(*self.layers(center, k, chapter))
+        for n in nodes:
+            data = graph.nodes[n]
+            if chapter is None or self.timeline.node_chapter(n) <= chapter or n == center:
+                G.add_node(n, **data)
+            else:
+                # 因關係而提前出現的角色只沿用座標，與 TimelineIndex.graph_at 一致
+                G.add_node(n, **{key: data[key] for key in ('x', 'y') if key in data})
+        for u in nodes:
+            for v, data in graph.succ[u].items():
+                if v not in nodes:
+                    continue
+                if chapter is None:
+                    G.add_edge(u, v, label=data.get('label'), color=data.get('color'))
+                else:
+                    state = self.timeline.edge_state(u, v, chapter)
+                    if state is not None:
+                        G.add_edge(u, v, label=state[0], color=state[1])
+        G.nodes[center].update(color=FOCUS_COLOR, size=30)
+        return G
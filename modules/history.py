@@ -0,0 +1,164 @@
+import copy
+import json
+from collections import namedtuple
+import networkx as nx
+
+# 每一筆變更 (op) 都同時記錄「變更前」與「變更後」的狀態，因此可以直接反向套用：
+#   ("node", name, before, after)     -> 角色屬性；None 代表不存在
+#   ("edge", u, v, before, after)     -> 關係屬性；None 代表不存在
+#   ("graph", before, after)          -> 整張圖的 node_link_data (重置 / 讀檔)
+#   ("alias", alias, before, after)   -> 別名表中 alias 對應的正式名稱；None 代表沒有這個別名 (不影響圖)
+
+
+# 通知訂閱者的變更摘要；reset 為 True 代表整張圖被替換，訂閱者應整個重建
+GraphChange = namedtuple("GraphChange", ["graph", "version", "nodes", "edges", "ops", "reset"])
+
+
+def touched(ops):
+    nodes, edges, reset = set(), set(), False
+    for op in ops:
+        if op[0] == "node":
+            nodes.add(op[1])
+        elif op[0] == "edge":
+            edges.add((op[1], op[2]))
+        elif op[0] == "graph":
+            reset = True
+    return nodes, edges, reset
+
+
+def node_state(graph, name):
+    if not graph.has_node(name):
+        return None
+    return copy.deepcopy(graph.nodes[name])
+
+
+def edge_state(graph, u, v):
+    if not graph.has_edge(u, v):
+        return None
+    return copy.deepcopy(graph[u][v])
+
+
+def graph_state(graph):
+    if graph is None:
+        return nx.node_link_data(nx.DiGraph())
+    return copy.deepcopy(nx.node_link_data(graph))
+
+
+def node_removal_ops(graph, name):
+    # 刪除角色時相連的關係也會消失，必須一併記錄才能完整復原
+    ops = [("edge", u, v, copy.deepcopy(d), None) for u, v, d in graph.in_edges(name, data=True)]
+    ops += [("edge", u, v, copy.deepcopy(d), None) for u, v, d in graph.out_edges(name, data=True) if v != name]
+    ops.append(("node", name, node_state(graph, name), None))
+    return ops
+
+
+def apply_ops(graph, ops, aliases=None):
+    # aliases 為 AliasTable 時一併套用別名的變更；重播日誌時別名表已另外存檔，不需傳入
+    for op in ops:
+        kind = op[0]
+        if kind == "node":
+            _, name, _, after = op
+            if after is None:
+                if graph.has_node(name):
+                    graph.remove_node(name)
+            else:
+                if graph.has_node(name):
+                    graph.nodes[name].clear()
+                graph.add_node(name, **copy.deepcopy(after))
+        elif kind == "edge":
+            _, u, v, _, after = op
+            if after is None:
+                if graph.has_edge(u, v):
+                    graph.remove_edge(u, v)
+            else:
+                if graph.has_edge(u, v):
+                    graph[u][v].clear()
+                graph.add_edge(u, v, **copy.deepcopy(after))
+        elif kind == "graph":
+            restored = nx.node_link_graph(copy.deepcopy(op[2]), directed=True)
+            graph.clear()
+            graph.graph.update(restored.graph)
+            graph.add_nodes_from(restored.nodes(data=True))
+            graph.add_edges_from(restored.edges(data=True))
+        elif kind == "alias":
+            if aliases is not None:
+                aliases.set(op[1], op[3])
+        else:
+            raise ValueError(f"未知的變更類型：{kind}")
+
+
+def invert_ops(ops):
+    # 反向順序 + 交換 before / after，即為復原所需的變更
+    return [tuple(op[:-2]) + (op[-1], op[-2]) for op in reversed(ops)]
+
+
+def estimate_size(ops):
+    # 以 JSON 長度估計一個步驟占用的記憶體，「graph」步驟帶著整張圖，會比一般步驟大得多
+    return sum(len(json.dumps(op, ensure_ascii=False, default=str)) for op in ops)
+
+
+class HistoryLog:
+    """以變更紀錄 (delta) 保存 Undo/Redo 歷史；步驟數超過 limit 或估計大小超過 max_bytes 時捨棄最舊的步驟。
+
+    Undo/Redo 只在目前的圖上套用一個步驟的變更，不需要重播，因此不保存整張圖的檢查點。
+    """
+
+    def __init__(self, limit=200, max_bytes=50_000_000):
+        self.limit = limit
+        self.max_bytes = max_bytes
+        self.clear()
+
+    def clear(self):
+        self.steps = []
+        self.sizes = []        # 每個步驟的估計大小
+        self.size = 0
+        self.cursor = 0        # 目前已套用的步驟數
+        self.offset = 0        # 因超過上限而被捨棄的最舊步驟數
+
+    @property
+    def position(self):
+        return self.offset + self.cursor
+
+    def can_undo(self):
+        return self.cursor > 0
+
+    def can_redo(self):
+        return self.cursor < len(self.steps)
+
+    def record(self, ops):
+        if not ops:
+            return
+        del self.steps[self.cursor:]
+        self.size -= sum(self.sizes[self.cursor:])
+        del self.sizes[self.cursor:]
+        self.steps.append(list(ops))
+        self.sizes.append(estimate_size(ops))
+        self.size += self.sizes[-1]
+        self.cursor += 1
+
+        # 至少保留最新的一步，單一步驟超過 max_bytes 時仍可復原
+        overflow = 0
+        size = self.size
+        while len(self.steps) - overflow > 1 and (len(self.steps) - overflow > self.limit
+                                                  or (self.max_bytes and size > self.max_bytes)):
+            size -= self.sizes[overflow]
+            overflow += 1
+        if overflow > 0:
+            del self.steps[:overflow]
+            del self.sizes[:overflow]
+            self.size = size
+            self.cursor -= overflow
+            self.offset += overflow
+
+    def undo_ops(self):
+        if not self.can_undo():
+            return None
+        self.cursor -= 1
+        return invert_ops(self.steps[self.cursor])
+
+    def redo_ops(self):
+        if not self.can_redo():
+            return None
+        ops = self.steps[self.cursor]
+        self.cursor += 1
+        return ops
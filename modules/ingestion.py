@@ -0,0 +1,94 @@
+import hashlib
+import io
+import json
+import os
+import re
+import threading
+from modules.autosave import atomic_write
+
+# 預設的章節標題：「第十二章」、「第3回」、「Chapter 5」、「CHAPTER IV」等獨立成行的標題
+CHAPTER_PATTERN = r"^\s*(第[0-9０-９一二三四五六七八九十百千零〇兩]+[章回節卷]|(?i:chapter)\s+[0-9A-Za-z]+)\b.*$"
+
+
+def open_text(source, encoding="utf-8-sig"):
+    """將路徑、二進位檔案 (例如上傳的檔案) 或文字檔案統一成逐行讀取的文字串流，不會一次載入整本書。"""
+    if isinstance(source, (str, os.PathLike)):
+        return open(source, "r", encoding=encoding, errors="replace")
+    if isinstance(source, io.TextIOBase):
+        return source
+    return io.TextIOWrapper(source, encoding=encoding, errors="replace")
+
+
+def iter_chapters(lines, pattern=CHAPTER_PATTERN, start=1):
+    """逐行讀取並依章節標題切開，產生 (章節編號, 標題, 內文)；編號依出現順序從 start 起算。
+
+    第一個標題前若有內容 (序言等)，併入第一章，不另佔章節編號；整份文字都沒有標題時視為一章。每次只保留一章的內容在記憶體中。
+    """
+    marker = re.compile(pattern)
+    number, title, buffer = start, "", []
+    for line in lines:
+        if marker.match(line):
+            if title:
+                yield number, title, "".join(buffer).strip()
+                number += 1
+                buffer = []
+            title = line.strip()
+        else:
+            buffer.append(line)
+    text = "".join(buffer).strip()
+    if text or title:
+        yield number, title, text
+
+
+def count_chapters(lines, pattern=CHAPTER_PATTERN):
+    # 只比對標題、不保留內文，用來事先估計進度條的總數
+    marker = re.compile(pattern)
+    return sum(1 for line in lines if marker.match(line))
+
+
+def chapter_digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+
+class IngestCheckpoint:
+    """記錄每本書已完成匯入的章節 (章節編號 -> 內文雜湊)，中斷後重新執行會略過內容未變的已完成章節。"""
+
+    def __init__(self, path="data/ingest_checkpoint.json"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._books = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self._books = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Checkpoint load failed: {e}")
+
+    @staticmethod
+    def key(source, pattern=CHAPTER_PATTERN, start=1):
+        return f"{source}\0{pattern}\0{start}"
+
+    def is_done(self, book, number, digest):
+        return self._books.get(book, {}).get(str(number)) == digest
+
+    def mark(self, book, number, digest):
+        with self._lock:
+            self._books.setdefault(book, {})[str(number)] = digest
+            if self.path:
+                atomic_write(self.path, json.dumps(self._books, ensure_ascii=False))
+
+    def completed(self, book):
+        return len(self._books.get(book, {}))
+
+    def reset(self, book):
+        with self._lock:
+            if self._books.pop(book, None) is not None and self.path:
+                atomic_write(self.path, json.dumps(self._books, ensure_ascii=False))
+
+    def clear(self):
+        # 圖被替換、重置或復原後，已記錄的章節不一定還在圖上，全部重新匯入 (有 LLM 快取，重跑的成本很低)
+        with self._lock:
+            if self._books:
+                self._books = {}
+                if self.path:
+                    atomic_write(self.path, json.dumps(self._books, ensure_ascii=False))
@@ -0,0 +1,280 @@
+from collections import defaultdict
+import networkx as nx
+import numpy as np
+
+# 與 visualization.py 中 vis.js 的 springLength 一致，讓預先計算的座標與原本的視覺間距相近
+EDGE_LENGTH = 150.0
+
+
+def _pairwise(P, Q, weight=None, block=1024):
+    # P 中每個點受到 Q 中所有點的斥力 (強度與距離成反比)；x、y 分開計算以減少暫存陣列
+    force = np.empty_like(P)
+    qx, qy = Q[:, 0], Q[:, 1]
+    for start in range(0, len(P), block):
+        dx = P[start:start + block, 0, None] - qx
+        dy = P[start:start + block, 1, None] - qy
+        inv = dx * dx
+        inv += dy * dy
+        inv += 1e-9
+        np.reciprocal(inv, out=inv)
+        if weight is not None:
+            inv *= weight
+        force[start:start + block, 0] = np.einsum("ij,ij->i", dx, inv)
+        force[start:start + block, 1] = np.einsum("ij,ij->i", dy, inv)
+    return force
+
+
+def _repulsion(P, exact_limit, grid):
+    n = len(P)
+    if n <= exact_limit:
+        return _pairwise(P, P)
+
+    # Barnes–Hut 式近似：其他格子的節點以格子質心代替，同一格內才逐一計算
+    lo, hi = P.min(0), P.max(0)
+    cell = np.maximum((hi - lo) / grid, 1e-9)
+    ij = np.minimum(((P - lo) / cell).astype(np.int64), grid - 1)
+    cid = ij[:, 0] * grid + ij[:, 1]
+    count = np.bincount(cid, minlength=grid * grid).astype(float)
+    occupied = np.nonzero(count)[0]
+    centroid = np.stack([
+        np.bincount(cid, weights=P[:, 0], minlength=grid * grid)[occupied],
+        np.bincount(cid, weights=P[:, 1], minlength=grid * grid)[occupied],
+    ], axis=1) / count[occupied, None]
+    force = _pairwise(P, centroid, weight=count[occupied])
+
+    # 扣掉自己所在格子的質心貢獻，改以同格節點兩兩精確計算 (配對數為各格節點數平方和)
+    slot = np.full(grid * grid, -1)
+    slot[occupied] = np.arange(len(occupied))
+    own = centroid[slot[cid]]
+    delta = P - own
+    force -= delta * (count[cid] / ((delta ** 2).sum(-1) + 1e-9))[:, None]
+
+    order = np.argsort(cid, kind="stable")
+    sizes = count[cid[order]].astype(np.int64)
+    starts = np.searchsorted(cid[order], cid[order])
+    ii = np.repeat(np.arange(n), sizes)
+    jj = np.repeat(starts, sizes) + np.arange(ii.size) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    a, b = order[ii], order[jj]
+    delta = P[a] - P[b]
+    near = delta / ((delta ** 2).sum(-1) + 1e-9)[:, None]
+    force[:, 0] += np.bincount(a, weights=near[:, 0], minlength=n)
+    force[:, 1] += np.bincount(a, weights=near[:, 1], minlength=n)
+    return force
+
+
+def force_layout(graph, pos=None, fixed=None, nodes=None, iterations=150, gravity=1.0,
+                 exact_limit=1500, temperature=None, seed=None):
+    """力導向排版 (Fruchterman–Reingold 力模型 + Barnes–Hut 式格點近似，NumPy 向量化)。
+
+    pos 為初始座標 {名稱: (x, y)}，fixed 中的節點不會移動，nodes 可限制只處理部分節點。
+    temperature 為第一輪的最大位移 (以關係長度為單位)，預設依節點數決定。
+    回傳 {名稱: (x, y)}，單位與 vis.js 畫布相同。
+    """
+    names = list(graph.nodes()) if nodes is None else list(nodes)
+    n = len(names)
+    if n == 0:
+        return {}
+    index = {name: i for i, name in enumerate(names)}
+    pos = pos or {}
+    fixed = fixed or set()
+    rng = np.random.default_rng(seed)
+
+    # 以 EDGE_LENGTH 為一單位計算，理想的關係長度即為 1
+    P = rng.uniform(-0.5, 0.5, size=(n, 2)) * np.sqrt(n)
+    known = np.array([name in pos for name in names])
+    for i, name in enumerate(names):
+        if known[i]:
+            P[i] = np.asarray(pos[name], dtype=float) / EDGE_LENGTH
+    movable = np.array([name not in fixed for name in names])
+    if not movable.any():
+        return {name: tuple(map(float, P[i] * EDGE_LENGTH)) for i, name in enumerate(names)}
+
+    edges = [(index[u], index[v]) for u, v in graph.edges(names) if v in index and u != v]
+    src = np.array([u for u, _ in edges], dtype=np.int64)
+    dst = np.array([v for _, v in edges], dtype=np.int64)
+    center = P.mean(0)
+    grid = int(np.clip(2 * n ** 0.25, 4, 64))
+    if temperature is None:
+        temperature = max(1.0, np.sqrt(n) / 4)
+
+    for it in range(iterations):
+        F = _repulsion(P, exact_limit, grid)
+        if len(edges):
+            delta = P[dst] - P[src]
+            pull = delta * np.linalg.norm(delta, axis=1, keepdims=True)
+            for axis in (0, 1):
+                F[:, axis] += np.bincount(src, weights=pull[:, axis], minlength=n)
+                F[:, axis] -= np.bincount(dst, weights=pull[:, axis], minlength=n)
+        F -= gravity * (P - center)
+
+        # 降溫：每輪位移上限逐漸縮小，讓排版收斂
+        limit = temperature * (1.0 - it / iterations) + 0.01
+        norm = np.linalg.norm(F, axis=1, keepdims=True) + 1e-9
+        move = F * np.minimum(1.0, limit / norm)
+        P[movable] += move[movable]
+
+    return {name: (float(x * EDGE_LENGTH), float(y * EDGE_LENGTH)) for name, (x, y) in zip(names, P)}
+
+
+def has_layout(graph, nodes=None):
+    nodes = graph.nodes if nodes is None else nodes
+    return all('x' in graph.nodes[n] and 'y' in graph.nodes[n] for n in nodes)
+
+
+class LayoutIndex:
+    """已定位角色的空間格點索引：格子邊長為 2 * EDGE_LENGTH，並維護座標總和與範圍，以及尚未定位的角色。
+
+    增量排版只需查看新角色附近的格子，不必走訪整張圖；可透過 GraphManager.subscribe 隨編輯增量更新。
+    """
+
+    def __init__(self, cell=2 * EDGE_LENGTH):
+        self.cell = cell
+        self._graph = None
+        self._version = None
+        self._pos = {}                   # 角色 -> (x, y)
+        self._cells = defaultdict(set)   # (格子 x, 格子 y) -> 角色
+        self._sum = np.zeros(2)
+        self._lo = None
+        self._hi = None
+        self.missing = set()             # 沒有座標的角色
+
+    def __len__(self):
+        return len(self._pos)
+
+    # --- 同步 ---
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self.rebuild(graph)
+        self._version = version
+
+    def rebuild(self, graph):
+        self._graph = graph
+        self._pos.clear()
+        self._cells.clear()
+        self._sum = np.zeros(2)
+        self._lo = self._hi = None
+        self.missing.clear()
+        for n, data in graph.nodes(data=True):
+            self._set(n, data)
+
+    def apply_change(self, change):
+        # 供 GraphManager.subscribe 使用：只更新這次變更碰到的角色
+        if change.graph is not self._graph or self._version != change.version - 1:
+            return
+        if change.reset:
+            self.rebuild(change.graph)
+        else:
+            graph = change.graph
+            for n in change.nodes:
+                self._set(n, graph.nodes[n] if graph.has_node(n) else None)
+        self._version = change.version
+
+    def _key(self, x, y):
+        return int(np.floor(x / self.cell)), int(np.floor(y / self.cell))
+
+    def _set(self, name, data):
+        old = self._pos.pop(name, None)
+        if old is not None:
+            cell = self._cells[self._key(*old)]
+            cell.discard(name)
+            if not cell:
+                del self._cells[self._key(*old)]
+            self._sum -= old
+        self.missing.discard(name)
+        if data is None:
+            return
+        if 'x' not in data or 'y' not in data:
+            self.missing.add(name)
+            return
+        p = (float(data['x']), float(data['y']))
+        self._pos[name] = p
+        self._cells[self._key(*p)].add(name)
+        self._sum += p
+        # 範圍只會擴大：刪除角色後外圍略大一些，不影響放置的結果
+        self._lo = np.minimum(self._lo, p) if self._lo is not None else np.array(p)
+        self._hi = np.maximum(self._hi, p) if self._hi is not None else np.array(p)
+
+    # --- 查詢 ---
+
+    def position(self, name):
+        return self._pos.get(name)
+
+    def centroid(self):
+        return self._sum / len(self._pos)
+
+    def radius(self):
+        center = self.centroid()
+        return float(np.max(np.maximum(self._hi - center, center - self._lo))) + EDGE_LENGTH
+
+    def near(self, points, distance=2 * EDGE_LENGTH):
+        """回傳與任一點的 x、y 距離都小於 distance 的已定位角色，只查看這些點附近的格子。"""
+        reach = int(np.ceil(distance / self.cell))
+        found = set()
+        for x, y in points:
+            cx, cy = self._key(x, y)
+            for i in range(cx - reach, cx + reach + 1):
+                for j in range(cy - reach, cy + reach + 1):
+                    for n in self._cells.get((i, j), ()):
+                        px, py = self._pos[n]
+                        if abs(px - x) < distance and abs(py - y) < distance:
+                            found.add(n)
+        return found
+
+
+def place_nodes(graph, new_nodes, iterations=50, seed=None, index=None):
+    """增量排版：既有座標固定不動，新角色先放在已定位鄰居的重心，再只對附近區域做短暫鬆弛。
+
+    index 為與 graph 同步的 LayoutIndex；未提供時會臨時建立一個 (需走訪整張圖一次)。
+    回傳新角色的 {名稱: (x, y)}；有 index 時計算量只與新角色及其周圍的角色數有關。
+    """
+    rng = np.random.default_rng(seed)
+    new_nodes = [n for n in new_nodes if graph.has_node(n)]
+    new_set = set(new_nodes)
+    if not new_nodes:
+        return {}
+    if index is None:
+        index = LayoutIndex()
+        index.rebuild(graph)
+    if len(index) == sum(1 for n in new_nodes if index.position(n) is not None):
+        return force_layout(graph, nodes=new_nodes, seed=seed)
+
+    pos = {}
+
+    def locate(n):
+        return pos.get(n) or (index.position(n) if n not in new_set else None)
+
+    center = index.centroid()
+    radius = index.radius()
+
+    # 依序放置：鄰居已定位者先放，放好的新角色也能成為後續角色的參考點
+    pending = list(new_nodes)
+    while pending:
+        waiting = []
+        for n in pending:
+            placed = [p for p in map(locate, nx.all_neighbors(graph, n)) if p is not None]
+            if placed:
+                jitter = rng.normal(scale=0.3, size=2) * EDGE_LENGTH
+                pos[n] = tuple(np.mean(placed, axis=0) + jitter)
+            else:
+                waiting.append(n)
+        if len(waiting) == len(pending):
+            # 與已定位角色都不相連：放在圖的外圍
+            for n in waiting:
+                angle = rng.uniform(0, 2 * np.pi)
+                pos[n] = tuple(center + radius * np.array([np.cos(angle), np.sin(angle)]))
+            break
+        pending = waiting
+
+    # 鬆弛範圍：新角色、其鄰居，以及落在新角色附近的既有角色 (避免重疊，以格點索引查詢)
+    region = set(new_nodes)
+    for n in new_nodes:
+        region.update(nx.all_neighbors(graph, n))
+    region.update(index.near(pos[n] for n in new_nodes))
+
+    fixed = region - new_set
+    known = {n: p for n, p in ((n, locate(n)) for n in region) if p is not None}
+    result = force_layout(graph, pos=known, fixed=fixed, nodes=list(region), iterations=iterations,
+                          gravity=0.1, temperature=1.0, seed=seed)
+    return {n: result[n] for n in new_nodes}
@@ -0,0 +1,110 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from modules.autosave import atomic_write
+
+
+def _digest(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """AI 萃取結果的磁碟快取：以 (模型, 系統提示雜湊, 段落雜湊) 定址，超過容量時淘汰最久未使用的項目。
+
+    每筆結果存成 directory/<前兩碼>/<雜湊>.json；最近使用時間記錄在檔案的 mtime，重新啟動後仍能延續 LRU 順序。
+    """
+
+    def __init__(self, directory="data/llm_cache", max_bytes=50 * 1024 * 1024, max_entries=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = None  # key -> 檔案大小，依最近使用排序
+        self._size = 0
+
+    @staticmethod
+    def key(model, system_prompt, chunk):
+        return _digest(f"{model}\0{_digest(system_prompt)}\0{_digest(chunk)}")
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _index(self):
+        # 第一次使用時才掃描目錄，依 mtime 排出 LRU 順序
+        if self._entries is None:
+            found = []
+            if os.path.isdir(self.directory):
+                for root, _, files in os.walk(self.directory):
+                    for name in files:
+                        if name.endswith(".json"):
+                            st = os.stat(os.path.join(root, name))
+                            found.append((st.st_mtime, name[:-5], st.st_size))
+            found.sort()
+            self._entries = OrderedDict((key, size) for _, key, size in found)
+            self._size = sum(self._entries.values())
+        return self._entries
+
+    def get(self, model, system_prompt, chunk):
+        key = self.key(model, system_prompt, chunk)
+        with self._lock:
+            entries = self._index()
+            if key in entries:
+                try:
+                    with open(self._path(key), "r", encoding="utf-8") as f:
+                        value = json.load(f)
+                    os.utime(self._path(key))
+                    entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                except (OSError, ValueError):
+                    self._size -= entries.pop(key)
+            self.misses += 1
+            return None
+
+    def put(self, model, system_prompt, chunk, value):
+        key = self.key(model, system_prompt, chunk)
+        payload = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        with self._lock:
+            entries = self._index()
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            atomic_write(path, payload)
+            self._size += len(payload) - entries.pop(key, 0)
+            entries[key] = len(payload)
+            self._evict()
+
+    def _evict(self):
+        entries = self._entries
+        while entries and (self._size > self.max_bytes or
+                           (self.max_entries is not None and len(entries) > self.max_entries)):
+            key, size = entries.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._index()):
+                try:
+                    os.remove(self._path(key))
+                except OSError:
+                    pass
+            self._entries.clear()
+            self._size = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self):
+        with self._lock:
+            entries = self._index()
+            return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hit_rate,
+                    "entries": len(entries), "bytes": self._size}
@@ -0,0 +1,150 @@
+import random
+import threading
+import time
+from collections import deque
+import openai
+from openai import OpenAI
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(api_key, base_url=None):
+    """同一組 (api_key, base_url) 在整個程式中共用一個 OpenAI 用戶端與其連線池。"""
+    key = (api_key, base_url)
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            # 重試改由 with_retry 處理，避免與 SDK 內建的重試疊加
+            client = OpenAI(api_key=api_key, base_url=base_url, max_retries=0)
+            _clients[key] = client
+        return client
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def is_retryable(error):
+    if isinstance(error, (openai.APIConnectionError, openai.APITimeoutError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code in RETRYABLE_STATUS
+
+
+def with_retry(call, retries=4, base_delay=0.5, max_delay=8.0, sleep=time.sleep):
+    """遇到 429 / 5xx 或連線錯誤時以指數退避 + 隨機抖動重試；伺服器給了 Retry-After 就照它等待。"""
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = _retry_after(e)
+            if delay is None:
+                delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.0)
+            sleep(delay)
+
+
+class CompletionStats:
+    """記錄每次請求的延遲與產出速度 (保留最近 limit 筆)。"""
+
+    def __init__(self, limit=200):
+        self._records = deque(maxlen=limit)
+        self._lock = threading.Lock()
+
+    def record(self, model, latency, duration, chars, tokens=None, attempts=1):
+        with self._lock:
+            self._records.append({
+                "model": model,
+                "latency": latency,      # 送出到收到第一段內容的秒數
+                "duration": duration,    # 送出到完整收完的秒數
+                "chars": chars,
+                "tokens": tokens,
+                "attempts": attempts,
+            })
+
+    @property
+    def records(self):
+        with self._lock:
+            return list(self._records)
+
+    def summary(self):
+        records = self.records
+        if not records:
+            return {"requests": 0}
+        duration = sum(r["duration"] for r in records)
+        return {
+            "requests": len(records),
+            "avg_latency": sum(r["latency"] for r in records) / len(records),
+            "avg_duration": duration / len(records),
+            "chars_per_second": sum(r["chars"] for r in records) / duration if duration else 0.0,
+            "retries": sum(r["attempts"] - 1 for r in records),
+        }
+
+
+def _deltas(stream):
+    for chunk in stream:
+        delta = chunk.choices[0].delta.content if chunk.choices else None
+        if delta:
+            yield delta
+
+
+def stream_completion(client, model, messages, stats=None, retries=4, base_delay=0.5, **kwargs):
+    """逐段產生回應文字。已經產生內容後就無法收回，因此只有在收到第一段內容之前失敗才會重試。"""
+    attempts = 0
+    started = None
+
+    def open_stream():
+        nonlocal attempts, started
+        attempts += 1
+        started = time.monotonic()
+        deltas = _deltas(client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs))
+        return next(deltas, None), deltas
+
+    first, deltas = with_retry(open_stream, retries=retries, base_delay=base_delay)
+    latency = time.monotonic() - started
+    chars = 0
+    if first is not None:
+        chars += len(first)
+        yield first
+        for delta in deltas:
+            chars += len(delta)
+            yield delta
+    if stats is not None:
+        stats.record(model, latency, time.monotonic() - started, chars, None, attempts)
+
+
+def complete(client, model, messages, stream=False, stats=None, retries=4, base_delay=0.5, **kwargs):
+    """送出一次 chat completion 並回傳文字內容；stream=True 時逐段接收，可量測第一段內容的延遲。"""
+    attempts = 0
+
+    def call():
+        nonlocal attempts
+        attempts += 1
+        started = time.monotonic()
+        if not stream:
+            response = client.chat.completions.create(model=model, messages=messages, **kwargs)
+            elapsed = time.monotonic() - started
+            usage = getattr(response, "usage", None)
+            content = response.choices[0].message.content or ""
+            return content, elapsed, elapsed, getattr(usage, "completion_tokens", None)
+
+        parts, first = [], None
+        for delta in _deltas(client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs)):
+            if first is None:
+                first = time.monotonic() - started
+            parts.append(delta)
+        elapsed = time.monotonic() - started
+        return "".join(parts), first if first is not None else elapsed, elapsed, None
+
+    content, latency, duration, tokens = with_retry(call, retries=retries, base_delay=base_delay)
+    if stats is not None:
+        stats.record(model, latency, duration, len(content), tokens, attempts)
+    return content
@@ -0,0 +1,179 @@
+import heapq
+from collections import OrderedDict
+from modules.timeline import DEFAULT_COLOR
+
+PATH_COLOR = "#00BCD4"
+# 可用來篩選路徑的關係顏色 (與 AI 萃取的顏色規則一致)
+RELATION_COLORS = {"#4CAF50": "🟢 友善", "#F44336": "🔴 敵對", "#9E9E9E": "⚪ 中立"}
+
+
+class PathIndex:
+    """兩個角色之間的關係路徑查詢：雙向 BFS 找最短路徑，Yen 演算法找前 k 短的路徑。
+
+    可限定章節 (只走當時已存在的關係，由 TimelineIndex 判斷) 與關係顏色 (例如只走綠色的友善關係)；
+    directed=False 時不考慮關係的方向。查詢結果依圖的版本快取。
+    """
+
+    def __init__(self, timeline, cache_size=32):
+        self.timeline = timeline
+        self.cache_size = cache_size
+        self._graph = None
+        self._version = None
+        self._cache = OrderedDict()
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self._graph = graph
+        self._version = version
+        self._cache.clear()
+
+    # --- 關係篩選 ---
+
+    def edge_state(self, u, v, chapter=None):
+        """回傳 (標籤, 顏色)；chapter 不為 None 時為該章節的狀態，關係當時不存在則回傳 None。"""
+        if chapter is not None:
+            return self.timeline.edge_state(u, v, chapter)
+        data = self._graph[u][v]
+        return data.get('label'), data.get('color') or DEFAULT_COLOR
+
+    def _allowed(self, u, v, chapter, colors):
+        state = self.edge_state(u, v, chapter)
+        return state is not None and (colors is None or (state[1] or DEFAULT_COLOR) in colors)
+
+    def _forward(self, u, chapter, colors, directed):
+        graph = self._graph
+        for v in graph.succ[u]:
+            if self._allowed(u, v, chapter, colors):
+                yield v
+        if not directed:
+            for v in graph.pred[u]:
+                if self._allowed(v, u, chapter, colors):
+                    yield v
+
+    def _backward(self, u, chapter, colors, directed):
+        graph = self._graph
+        for v in graph.pred[u]:
+            if self._allowed(v, u, chapter, colors):
+                yield v
+        if not directed:
+            for v in graph.succ[u]:
+                if self._allowed(u, v, chapter, colors):
+                    yield v
+
+    # --- 搜尋 ---
+
+    def _bidirectional(self, source, target, chapter, colors, directed, banned_nodes=(), banned_edges=()):
+        # 兩端同時展開，每次擴展較小的一側；兩側相遇時即為最短路徑
+        if source == target:
+            return [source]
+        pred, succ = {source: None}, {target: None}
+        forward, backward = [source], [target]
+        while forward and backward:
+            if len(forward) <= len(backward):
+                frontier, forward = forward, []
+                for u in frontier:
+                    for v in self._forward(u, chapter, colors, directed):
+                        if v in pred or v in banned_nodes or (u, v) in banned_edges:
+                            continue
+                        pred[v] = u
+                        if v in succ:
+                            return _join(v, pred, succ)
+                        forward.append(v)
+            else:
+                frontier, backward = backward, []
+                for u in frontier:
+                    for v in self._backward(u, chapter, colors, directed):
+                        if v in succ or v in banned_nodes or (v, u) in banned_edges:
+                            continue
+                        succ[v] = u
+                        if v in pred:
+                            return _join(v, pred, succ)
+                        backward.append(v)
+        return None
+
+    def paths(self, source, target, k=1, chapter=None, colors=None, directed=False):
+        """回傳 source 到 target 前 k 短的路徑 (每條為角色名稱的串列，由短到長)；不相連時回傳空串列。"""
+        graph = self._graph
+        if graph is None or source not in graph or target not in graph:
+            return []
+        colors = frozenset(colors) if colors else None
+        key = (source, target, k, chapter, colors, directed)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        found = []
+        first = self._bidirectional(source, target, chapter, colors, directed)
+        if first is not None:
+            found.append(first)
+        candidates, queued = [], {tuple(first)} if first else set()
+        # Yen 演算法：依序把前一條路徑上的每個角色當作分岔點，封鎖已用過的下一步後重新搜尋
+        while found and len(found) < k:
+            previous = found[-1]
+            for i in range(len(previous) - 1):
+                root = previous[:i + 1]
+                banned_edges = set()
+                for path in found:
+                    if path[:i + 1] == root and len(path) > i + 1:
+                        banned_edges.add((path[i], path[i + 1]))
+                        if not directed:
+                            banned_edges.add((path[i + 1], path[i]))
+                spur = self._bidirectional(root[-1], target, chapter, colors, directed,
+                                           banned_nodes=set(root[:-1]), banned_edges=banned_edges)
+                if spur is not None:
+                    candidate = root[:-1] + spur
+                    if tuple(candidate) not in queued:
+                        queued.add(tuple(candidate))
+                        heapq.heappush(candidates, (len(candidate), candidate))
+            if not candidates:
+                break
+            found.append(heapq.heappop(candidates)[1])
+
+        self._cache[key] = found
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return found
+
+    def describe(self, path, chapter=None):
+        """路徑的文字說明，例如「A —朋友→ B ←敵人— C」。"""
+        text = str(path[0])
+        for (u, v, label, _), b in zip(self.steps(path, chapter), path[1:]):
+            text += f" —{label}→ {b}" if v == b else f" ←{label}— {b}"
+        return text
+
+    def steps(self, path, chapter=None):
+        """將路徑展開為每一步 (u, v, 標籤, 顏色)；u -> v 為圖中關係實際的方向。"""
+        result = []
+        for a, b in zip(path, path[1:]):
+            u, v = (a, b) if self._graph.has_edge(a, b) and self.edge_state(a, b, chapter) else (b, a)
+            label, color = self.edge_state(u, v, chapter) or (None, None)
+            result.append((u, v, label, color))
+        return result
+
+
+def _join(meet, pred, succ):
+    path = []
+    n = meet
+    while n is not None:
+        path.append(n)
+        n = pred[n]
+    path.reverse()
+    n = succ[meet]
+    while n is not None:
+        path.append(n)
+        n = succ[n]
+    return path
+
+
+def highlight_path(graph, path):
+    """回傳標示出路徑的圖副本 (不修改原圖)：路徑上的角色改用醒目顏色，關係加粗。"""
+    G = graph.copy()
+    for n in path:
+        if n in G:
+            G.nodes[n]['color'] = PATH_COLOR
+    for a, b in zip(path, path[1:]):
+        for u, v in ((a, b), (b, a)):
+            if G.has_edge(u, v):
+                G[u][v]['width'] = 6
+    return G
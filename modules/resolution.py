@@ -0,0 +1,196 @@
+import json
+import os
+import re
+import threading
+import unicodedata
+from collections import Counter, defaultdict
+from modules.autosave import atomic_write
+
+_IGNORED = re.compile(r"[\W_]+")
+
+
+def normalize(name):
+    """比對用的正規化：統一全半形、忽略大小寫，去掉空白與標點。"""
+    return _IGNORED.sub("", unicodedata.normalize("NFKC", str(name)).casefold())
+
+
+def ngrams(key, n=2):
+    if len(key) <= n:
+        return {key} if key else set()
+    return {key[i:i + n] for i in range(len(key) - n + 1)}
+
+
+class AliasTable:
+    """使用者維護的別名表 (別名 -> 正式名稱)；path 為 None 時只存在記憶體中。"""
+
+    def __init__(self, path="data/aliases.json"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._aliases = {}  # normalize(別名) -> (別名, 正式名稱)
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    for alias, canonical in json.load(f).items():
+                        self._aliases[normalize(alias)] = (alias, canonical)
+            except (OSError, ValueError) as e:
+                print(f"Alias table load failed: {e}")
+
+    def _save(self):
+        if self.path:
+            payload = json.dumps(dict(self._aliases.values()), ensure_ascii=False, indent=2)
+            atomic_write(self.path, payload)
+
+    def get(self, name):
+        entry = self._aliases.get(normalize(name))
+        return entry[1] if entry else None
+
+    def add(self, alias, canonical):
+        key = normalize(alias)
+        if not key or key == normalize(canonical):
+            return False
+        with self._lock:
+            # 原本指向 alias 的別名改指向新的正式名稱，避免出現別名鏈
+            for k, (a, c) in list(self._aliases.items()):
+                if c == alias:
+                    self._aliases[k] = (a, canonical)
+            self._aliases[key] = (alias, canonical)
+            self._save()
+        return True
+
+    def set(self, alias, canonical):
+        """直接設定 alias 的正式名稱 (None 代表刪除)，不調整其他別名；供復原合併時還原別名表。"""
+        with self._lock:
+            if canonical is None:
+                if self._aliases.pop(normalize(alias), None) is None:
+                    return
+            else:
+                self._aliases[normalize(alias)] = (alias, canonical)
+            self._save()
+
+    def remove(self, alias):
+        with self._lock:
+            if self._aliases.pop(normalize(alias), None) is None:
+                return False
+            self._save()
+        return True
+
+    def items(self):
+        return sorted(self._aliases.values())
+
+
+class EntityIndex:
+    """角色名稱的 n-gram 倒排索引，用來找出可能是同一人的角色 (例如「哈利」與「哈利波特」)。
+
+    查詢只走訪與名稱共有 n-gram 的角色，與圖的大小無關；出現在超過 max_postings 個名稱中的 n-gram 太常見，不參與比對。
+    """
+
+    def __init__(self, aliases=None, max_postings=1000):
+        self.aliases = aliases if aliases is not None else AliasTable(None)
+        self.max_postings = max_postings
+        self._graph = None
+        self._version = None
+        self._keys = {}                  # 角色 -> (正規化名稱, n-gram 數)
+        self._exact = defaultdict(set)   # 正規化名稱 -> 角色
+        self._postings = defaultdict(set)
+
+    # --- 同步 ---
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self.rebuild(graph)
+        self._version = version
+
+    def rebuild(self, graph):
+        self._graph = graph
+        self._keys.clear()
+        self._exact.clear()
+        self._postings.clear()
+        for n in graph.nodes:
+            self.add(n)
+
+    def invalidate(self):
+        # 索引可能與圖不一致時呼叫，下次 sync 會整個重建
+        self._graph = None
+        self._version = None
+
+    def apply_change(self, change):
+        # 供 GraphManager.subscribe 使用：只更新新增或刪除的角色
+        if change.graph is not self._graph or self._version != change.version - 1:
+            return
+        if change.reset:
+            self.rebuild(change.graph)
+        else:
+            for n in change.nodes:
+                if change.graph.has_node(n):
+                    self.add(n)
+                else:
+                    self.remove(n)
+        self._version = change.version
+
+    def add(self, name):
+        if name in self._keys:
+            return
+        key = normalize(name)
+        grams = ngrams(key)
+        self._keys[name] = (key, len(grams))
+        self._exact[key].add(name)
+        for g in grams:
+            self._postings[g].add(name)
+
+    def remove(self, name):
+        entry = self._keys.pop(name, None)
+        if entry is None:
+            return
+        key = entry[0]
+        self._exact[key].discard(name)
+        if not self._exact[key]:
+            del self._exact[key]
+        for g in ngrams(key):
+            self._postings[g].discard(name)
+            if not self._postings[g]:
+                del self._postings[g]
+
+    # --- 查詢 ---
+
+    def candidates(self, name, limit=5, min_score=0.5):
+        """回傳可能與 name 為同一人的既有角色 [(角色, 分數)]，分數高的在前；別名表與正規化後完全相同的名稱為 1.0。"""
+        key = normalize(name)
+        scores = {}
+        canonical = self.aliases.get(name)
+        if canonical in self._keys and canonical != name:
+            scores[canonical] = 1.0
+        for other in self._exact.get(key, ()):
+            if other != name:
+                scores[other] = 1.0
+        grams = ngrams(key)
+        shared = Counter()
+        for g in grams:
+            posting = self._postings.get(g)
+            if posting and len(posting) <= self.max_postings:
+                shared.update(posting)
+        for other, count in shared.items():
+            if other == name or other in scores:
+                continue
+            size = self._keys[other][1]
+            # Dice 係數與重疊係數的平均：簡稱 (「哈利」之於「哈利波特」) 也能得到足夠的分數
+            score = (2 * count / (len(grams) + size) + count / min(len(grams), size)) / 2
+            if score >= min_score:
+                scores[other] = score
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], str(item[0])))
+        return ranked[:limit]
+
+    def resolve(self, name):
+        """將名稱對應到既有角色：完全相同、別名表，或正規化後相同 (且只有一個)；找不到時回傳 None。
+
+        只是相似或互為包含的名稱 (「張三」與「張三豐」) 不會自動對應，請以 candidates() 列出後由使用者確認合併。
+        """
+        if name in self._keys:
+            return name
+        canonical = self.aliases.get(name)
+        if canonical in self._keys:
+            return canonical
+        exact = self._exact.get(normalize(name))
+        if exact and len(exact) == 1:
+            return next(iter(exact))
+        return None
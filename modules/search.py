@@ -0,0 +1,152 @@
+from collections import OrderedDict, defaultdict
+from modules.resolution import ngrams, normalize
+
+# 命中欄位的權重：名稱比簡介或關係標籤重要
+FIELD_WEIGHTS = {"name": 3.0, "title": 1.0, "label": 1.0}
+
+
+class SearchIndex:
+    """角色名稱、簡介與關係標籤的全文檢索：以字元二元組 (bigram) 建立倒排索引，中文不需斷詞。
+
+    查詢只需走訪查詢字串中最短的那條倒排串列，再逐筆確認確實包含查詢字串；排序後的結果依圖的版本快取，翻頁不必重算。
+    倒排串列只存整數編號並只做附加，修改或刪除時舊編號留著、查詢時略過，累積過多時才整個重建。
+    """
+
+    def __init__(self, cache_size=16):
+        self.cache_size = cache_size
+        self._graph = None
+        self._version = None
+        self._ids = {}                        # ("node", 名稱) / ("edge", u, v) -> 編號
+        self._docs = {}                       # 編號 -> (文件, {欄位: 正規化文字})
+        self._next_id = 0
+        self._stale = 0
+        self._postings = defaultdict(list)    # bigram -> 編號
+        self._char_grams = defaultdict(set)   # 單字 -> 含有此字的 bigram，供單字查詢使用
+        self._cache = OrderedDict()
+
+    # --- 同步 ---
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self.rebuild(graph)
+        self._version = version
+
+    def rebuild(self, graph):
+        self._graph = graph
+        self._ids.clear()
+        self._docs.clear()
+        self._stale = 0
+        self._postings.clear()
+        self._char_grams.clear()
+        self._cache.clear()
+        for n, data in graph.nodes(data=True):
+            self._add(("node", n), {"name": n, "title": data.get("title")})
+        for u, v, data in graph.edges(data=True):
+            self._add(("edge", u, v), {"label": data.get("label")})
+
+    def apply_change(self, change):
+        # 供 GraphManager.subscribe 使用：只重新索引這次變更碰到的角色與關係
+        if change.graph is not self._graph or self._version != change.version - 1:
+            return
+        if change.reset:
+            self.rebuild(change.graph)
+        else:
+            graph = change.graph
+            for n in change.nodes:
+                self._remove(("node", n))
+                if graph.has_node(n):
+                    self._add(("node", n), {"name": n, "title": graph.nodes[n].get("title")})
+            for u, v in change.edges:
+                self._remove(("edge", u, v))
+                if graph.has_edge(u, v):
+                    self._add(("edge", u, v), {"label": graph[u][v].get("label")})
+            self._cache.clear()
+            if self._stale > max(1000, len(self._docs)):
+                self.rebuild(graph)
+        self._version = change.version
+
+    def _add(self, doc, fields):
+        texts = {field: normalize(text) for field, text in fields.items() if text not in (None, "")}
+        texts = {field: text for field, text in texts.items() if text}
+        if not texts:
+            return
+        doc_id = self._next_id
+        self._next_id += 1
+        self._ids[doc] = doc_id
+        self._docs[doc_id] = (doc, texts)
+        for g in set().union(*(ngrams(text) for text in texts.values())):
+            posting = self._postings[g]
+            if not posting:
+                for c in g:
+                    self._char_grams[c].add(g)
+            posting.append(doc_id)
+
+    def _remove(self, doc):
+        doc_id = self._ids.pop(doc, None)
+        if doc_id is not None:
+            del self._docs[doc_id]
+            self._stale += 1
+
+    # --- 查詢 ---
+
+    def _candidates(self, query):
+        if len(query) == 1:
+            ids = set()
+            for g in self._char_grams.get(query, ()):
+                ids.update(self._postings.get(g, ()))
+            return ids
+        # 包含查詢字串的文件一定出現在每一條 bigram 串列中，取最短的一條即可，其餘由逐筆確認過濾
+        return set(min((self._postings.get(g, ()) for g in ngrams(query)), key=len))
+
+    def _rank(self, query, prefix):
+        hits = []
+        for doc_id in self._candidates(query):
+            entry = self._docs.get(doc_id)
+            if entry is None:
+                continue
+            doc, texts = entry
+            best = None
+            for field, text in texts.items():
+                if prefix:
+                    if not text.startswith(query):
+                        continue
+                elif query not in text:
+                    continue
+                # 完全相同 > 開頭相同 > 包含；同等級時較短的文字較相關
+                match = 3.0 if text == query else 2.0 if text.startswith(query) else 1.0
+                score = FIELD_WEIGHTS[field] * match + len(query) / len(text)
+                if best is None or score > best[0]:
+                    best = (score, field)
+            if best is not None:
+                hits.append((best[0], doc, best[1]))
+        hits.sort(key=lambda hit: (-hit[0], str(hit[1])))
+        return hits
+
+    def search(self, query, prefix=False, page=0, page_size=20):
+        """查詢包含 (prefix=True 時為開頭符合) query 的角色與關係，回傳 (這一頁的結果, 總筆數)。
+
+        每筆結果為 {"kind": "node" / "edge", "id": 名稱或 (u, v), "field": 命中欄位, "text": 原始文字, "score": 分數}。
+        """
+        query = normalize(query)
+        if not query or self._graph is None:
+            return [], 0
+        key = (query, prefix)
+        hits = self._cache.get(key)
+        if hits is None:
+            hits = self._rank(query, prefix)
+            self._cache[key] = hits
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        else:
+            self._cache.move_to_end(key)
+        results = []
+        for score, doc, field in hits[page * page_size:(page + 1) * page_size]:
+            if doc[0] == "node":
+                ident = doc[1]
+                text = ident if field == "name" else self._graph.nodes[ident].get(field)
+            else:
+                ident = (doc[1], doc[2])
+                text = self._graph[doc[1]][doc[2]].get(field)
+            results.append({"kind": doc[0], "id": ident, "field": field, "text": str(text), "score": score})
+        return results, len(hits)
@@ -0,0 +1,331 @@
+import json
+import mmap
+import os
+import struct
+import sys
+import networkx as nx
+from modules.autosave import atomic_write
+
+# .nxg 二進位專案格式 (little-endian)
+#
+#   Header      固定長度，記錄各區段的位置與筆數
+#   Strings     (n_strings + 1) 個 uint32 位移 + UTF-8 字串區；名稱、標籤、顏色等都只存一次
+#   Nodes       固定長度紀錄：名稱、title、type、group、chapter、其餘屬性 (JSON 字串)
+#   Edges       固定長度紀錄：來源/目標的節點索引、label、color、chapter、timeline 區段
+#   Timeline    固定長度紀錄：章節、label、color、其餘內容
+#
+# 只有型別相符的常用欄位會放進固定欄位，其餘屬性一律以 JSON 字串保存，因此與 JSON 可以無損互轉。
+
+MAGIC = b"NXG1"
+VERSION = 1
+NONE = 0xFFFFFFFF
+
+HEADER = struct.Struct("<4sHHIIIIQQQQQI")
+NODE = struct.Struct("<IIIiiIH")
+EDGE = struct.Struct("<IIIIiIIIH")
+TIMELINE = struct.Struct("<iIIIIH")
+OFFSET = struct.Struct("<I")
+
+# Node flags
+N_TITLE, N_TYPE, N_GROUP, N_CHAPTER, N_NAME_JSON = 1, 2, 4, 8, 16
+# Edge flags
+E_LABEL, E_COLOR, E_CHAPTER, E_TIMELINE = 1, 2, 4, 8
+# Timeline flags
+T_LABEL, T_COLOR, T_KEY_INT, T_RAW = 1, 2, 4, 8
+
+INT_MIN, INT_MAX = -2 ** 31, 2 ** 31 - 1
+
+
+def _is_int32(value):
+    return type(value) is int and INT_MIN <= value <= INT_MAX
+
+
+def _dumps(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+class _StringTable:
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def intern(self, value):
+        sid = self.ids.get(value)
+        if sid is None:
+            sid = self.ids[value] = len(self.strings)
+            self.strings.append(value)
+        return sid
+
+    def extra(self, attrs):
+        return self.intern(_dumps(attrs)) if attrs else NONE
+
+
+def _take_str(attrs, key, flag, strings):
+    value = attrs.get(key)
+    if isinstance(value, str):
+        del attrs[key]
+        return strings.intern(value), flag
+    return NONE, 0
+
+
+def _take_int(attrs, key, flag):
+    value = attrs.get(key)
+    if _is_int32(value):
+        del attrs[key]
+        return value, flag
+    return 0, 0
+
+
+def dumps(graph):
+    strings = _StringTable()
+    index = {}
+    node_records, edge_records, timeline_records = [], [], []
+
+    for i, (name, data) in enumerate(graph.nodes(data=True)):
+        index[name] = i
+        attrs = dict(data)
+        flags = 0
+        if isinstance(name, str):
+            name_sid = strings.intern(name)
+        else:
+            name_sid = strings.intern(_dumps(name))
+            flags |= N_NAME_JSON
+        title, f1 = _take_str(attrs, "title", N_TITLE, strings)
+        kind, f2 = _take_str(attrs, "type", N_TYPE, strings)
+        group, f3 = _take_int(attrs, "group", N_GROUP)
+        chapter, f4 = _take_int(attrs, "chapter", N_CHAPTER)
+        flags |= f1 | f2 | f3 | f4
+        node_records.append(NODE.pack(name_sid, title, kind, group, chapter, strings.extra(attrs), flags))
+
+    for u, v, data in graph.edges(data=True):
+        attrs = dict(data)
+        label, f1 = _take_str(attrs, "label", E_LABEL, strings)
+        color, f2 = _take_str(attrs, "color", E_COLOR, strings)
+        chapter, f3 = _take_int(attrs, "chapter", E_CHAPTER)
+        flags = f1 | f2 | f3
+
+        tl_start, tl_count = len(timeline_records), 0
+        timeline = attrs.get("timeline")
+        if isinstance(timeline, dict):
+            del attrs["timeline"]
+            flags |= E_TIMELINE
+            for key, state in timeline.items():
+                tflags = 0
+                key_chapter, key_sid = 0, NONE
+                if isinstance(key, str) and key.lstrip("-").isdigit() and str(int(key)) == key and _is_int32(int(key)):
+                    key_chapter, tflags = int(key), T_KEY_INT
+                else:
+                    key_sid = strings.intern(key)
+                if isinstance(state, dict):
+                    state = dict(state)
+                    t_label, g1 = _take_str(state, "label", T_LABEL, strings)
+                    t_color, g2 = _take_str(state, "color", T_COLOR, strings)
+                    tflags |= g1 | g2
+                    t_extra = strings.extra(state)
+                else:
+                    t_label = t_color = NONE
+                    t_extra = strings.intern(_dumps(state))
+                    tflags |= T_RAW
+                timeline_records.append(TIMELINE.pack(key_chapter, key_sid, t_label, t_color, t_extra, tflags))
+                tl_count += 1
+
+        edge_records.append(EDGE.pack(index[u], index[v], label, color, chapter, tl_start, tl_count, strings.extra(attrs), flags))
+
+    meta_sid = strings.extra(dict(graph.graph))
+    encoded = [s.encode("utf-8") for s in strings.strings]
+    offsets, pos = [0], 0
+    for b in encoded:
+        pos += len(b)
+        offsets.append(pos)
+
+    strings_off = HEADER.size
+    blob_off = strings_off + OFFSET.size * len(offsets)
+    nodes_off = blob_off + pos
+    edges_off = nodes_off + NODE.size * len(node_records)
+    timeline_off = edges_off + EDGE.size * len(edge_records)
+
+    header = HEADER.pack(
+        MAGIC, VERSION, 0, len(encoded), len(node_records), len(edge_records), len(timeline_records),
+        strings_off, blob_off, nodes_off, edges_off, timeline_off, meta_sid
+    )
+    return b"".join([
+        header,
+        struct.pack(f"<{len(offsets)}I", *offsets),
+        b"".join(encoded),
+        b"".join(node_records),
+        b"".join(edge_records),
+        b"".join(timeline_records),
+    ])
+
+
+class BinaryGraph:
+    """.nxg 檔案的唯讀檢視：只解析 header，字串與紀錄在用到時才解碼。"""
+
+    def __init__(self, buffer, closer=None):
+        self._buf = buffer
+        self._closer = closer
+        self._strings = {}
+        (magic, version, _, self.n_strings, self.n_nodes, self.n_edges, self.n_timeline,
+         self._strings_off, self._blob_off, self._nodes_off, self._edges_off, self._timeline_off,
+         self._meta_sid) = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("不是有效的 .nxg 檔案")
+        if version != VERSION:
+            raise ValueError(f"不支援的 .nxg 版本：{version}")
+
+    @classmethod
+    def open(cls, path):
+        f = open(path, "rb")
+        try:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            f.close()
+            raise
+
+        def closer():
+            mm.close()
+            f.close()
+        return cls(mm, closer)
+
+    def close(self):
+        if self._closer is not None:
+            self._closer()
+            self._closer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def string(self, sid):
+        value = self._strings.get(sid)
+        if value is None:
+            if sid == NONE:
+                return None
+            start, end = struct.unpack_from("<II", self._buf, self._strings_off + OFFSET.size * sid)
+            value = self._strings[sid] = bytes(self._buf[self._blob_off + start:self._blob_off + end]).decode("utf-8")
+        return value
+
+    def _extra(self, sid):
+        return json.loads(self.string(sid)) if sid != NONE else {}
+
+    def _section(self, layout, offset, count):
+        return layout.iter_unpack(self._buf[offset:offset + layout.size * count])
+
+    def _name(self, record):
+        name = self.string(record[0])
+        return json.loads(name) if record[-1] & N_NAME_JSON else name
+
+    def _node_attrs(self, record):
+        _, title, kind, group, chapter, extra, flags = record
+        attrs = {}
+        if flags & N_TITLE:
+            attrs["title"] = self.string(title)
+        if flags & N_TYPE:
+            attrs["type"] = self.string(kind)
+        if flags & N_GROUP:
+            attrs["group"] = group
+        if flags & N_CHAPTER:
+            attrs["chapter"] = chapter
+        attrs.update(self._extra(extra))
+        return attrs
+
+    def _timeline(self, records):
+        timeline = {}
+        string = self.string
+        for key_chapter, key_sid, label, color, extra, flags in records:
+            key = str(key_chapter) if flags & T_KEY_INT else string(key_sid)
+            if flags & T_RAW:
+                timeline[key] = json.loads(string(extra))
+                continue
+            state = {}
+            if flags & T_LABEL:
+                state["label"] = string(label)
+            if flags & T_COLOR:
+                state["color"] = string(color)
+            if extra != NONE:
+                state.update(json.loads(string(extra)))
+            timeline[key] = state
+        return timeline
+
+    def _edge_attrs(self, record, timeline_records=None):
+        _, _, label, color, chapter, tl_start, tl_count, extra, flags = record
+        attrs = {}
+        if flags & E_LABEL:
+            attrs["label"] = self.string(label)
+        if flags & E_COLOR:
+            attrs["color"] = self.string(color)
+        if flags & E_CHAPTER:
+            attrs["chapter"] = chapter
+        if flags & E_TIMELINE:
+            if timeline_records is None:
+                records = self._section(TIMELINE, self._timeline_off + TIMELINE.size * tl_start, tl_count)
+            else:
+                records = timeline_records[tl_start:tl_start + tl_count]
+            attrs["timeline"] = self._timeline(records)
+        attrs.update(self._extra(extra))
+        return attrs
+
+    def node_name(self, i):
+        return self._name(NODE.unpack_from(self._buf, self._nodes_off + NODE.size * i))
+
+    def node(self, i):
+        record = NODE.unpack_from(self._buf, self._nodes_off + NODE.size * i)
+        return self._name(record), self._node_attrs(record)
+
+    def edge(self, i):
+        record = EDGE.unpack_from(self._buf, self._edges_off + EDGE.size * i)
+        return self.node_name(record[0]), self.node_name(record[1]), self._edge_attrs(record)
+
+    def nodes(self):
+        for record in self._section(NODE, self._nodes_off, self.n_nodes):
+            yield self._name(record), self._node_attrs(record)
+
+    def edges(self):
+        names = [self._name(record) for record in self._section(NODE, self._nodes_off, self.n_nodes)]
+        timeline_records = list(self._section(TIMELINE, self._timeline_off, self.n_timeline))
+        for record in self._section(EDGE, self._edges_off, self.n_edges):
+            yield names[record[0]], names[record[1]], self._edge_attrs(record, timeline_records)
+
+    def to_graph(self):
+        G = nx.DiGraph()
+        G.graph.update(self._extra(self._meta_sid))
+        G.add_nodes_from(self.nodes())
+        G.add_edges_from(self.edges())
+        return G
+
+
+def is_binary(name):
+    return os.path.splitext(name)[1].lower() == ".nxg"
+
+
+def write_graph(graph, path):
+    if is_binary(path):
+        atomic_write(path, dumps(graph))
+    else:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(nx.node_link_data(graph), f, ensure_ascii=False, indent=4)
+
+
+def read_graph(source):
+    # source 可以是檔案路徑，或帶有 name 屬性的檔案物件 (例如 Streamlit 上傳的檔案)
+    if isinstance(source, (str, os.PathLike)):
+        if is_binary(os.fspath(source)):
+            with BinaryGraph.open(source) as bg:
+                return bg.to_graph()
+        with open(source, "r", encoding="utf-8") as f:
+            return nx.node_link_graph(json.load(f), directed=True)
+    if is_binary(getattr(source, "name", "")):
+        return BinaryGraph(source.read()).to_graph()
+    return nx.node_link_graph(json.load(source), directed=True)
+
+
+def convert(src_path, dst_path):
+    write_graph(read_graph(src_path), dst_path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("用法：python -m modules.storage <來源檔> <目標檔>  (依副檔名 .json / .nxg 判斷格式)")
+    convert(sys.argv[1], sys.argv[2])
@@ -0,0 +1,148 @@
+from bisect import bisect_right
+from collections import Counter, OrderedDict
+import networkx as nx
+
+DEFAULT_COLOR = "#9E9E9E"
+
+
+def edge_timeline(data):
+    # 回傳依章節排序的 (章節, label, color)；舊資料沒有 timeline 時以 chapter 欄位代替
+    orig_chap = data.get('chapter', 1)
+    timeline = data.get('timeline', {str(orig_chap): {'label': data.get('label'), 'color': data.get('color', DEFAULT_COLOR)}})
+    entries = [(int(c), state.get('label', ''), state.get('color', DEFAULT_COLOR)) for c, state in timeline.items()]
+    return sorted(entries, key=lambda entry: entry[0])
+
+
+class TimelineIndex:
+    """時間軸索引：每條關係的章節以排序陣列保存，查詢某章節的狀態只需二分搜尋。"""
+
+    def __init__(self, cache_size=8):
+        self.cache_size = cache_size
+        self._graph = None
+        self._version = None
+        self._cache = OrderedDict()
+        self._node_chapters = {}
+        self._edge_chapters = {}
+        self._edge_states = {}
+        self._edge_added = {}
+        self._chapter_counts = Counter()
+        self._max_chapter = 1
+
+    def sync(self, graph, version):
+        if graph is self._graph and version == self._version:
+            return
+        self.rebuild(graph)
+        self._version = version
+
+    def apply_change(self, change):
+        # 供 GraphManager.subscribe 使用：只更新這次變更碰到的角色與關係
+        if change.graph is not self._graph or self._version != change.version - 1:
+            return
+        if change.reset:
+            self.rebuild(change.graph)
+        else:
+            graph = change.graph
+            for n in change.nodes:
+                if graph.has_node(n):
+                    self.update_node(n, graph.nodes[n])
+                else:
+                    self.remove_node(n)
+            for u, v in change.edges:
+                if graph.has_edge(u, v):
+                    self.update_edge(u, v, graph[u][v])
+                else:
+                    self.remove_edge(u, v)
+        self._version = change.version
+
+    def rebuild(self, graph):
+        self._graph = graph
+        self._cache.clear()
+        self._node_chapters.clear()
+        self._edge_chapters.clear()
+        self._edge_states.clear()
+        self._edge_added.clear()
+        self._chapter_counts.clear()
+        self._max_chapter = 1
+        for n, data in graph.nodes(data=True):
+            self.update_node(n, data)
+        for u, v, data in graph.edges(data=True):
+            self.update_edge(u, v, data)
+
+    # --- 增量維護 ---
+
+    def _count(self, chapter, delta):
+        self._chapter_counts[chapter] += delta
+        if delta > 0:
+            self._max_chapter = max(self._max_chapter, chapter)
+        elif self._chapter_counts[chapter] <= 0:
+            del self._chapter_counts[chapter]
+            if chapter >= self._max_chapter:
+                self._max_chapter = max(max(self._chapter_counts, default=1), 1)
+
+    def update_node(self, n, data):
+        self.remove_node(n)
+        chapter = data.get('chapter', 1)
+        self._node_chapters[n] = chapter
+        self._count(chapter, 1)
+        self._cache.clear()
+
+    def remove_node(self, n):
+        if n in self._node_chapters:
+            self._count(self._node_chapters.pop(n), -1)
+            self._cache.clear()
+
+    def update_edge(self, u, v, data):
+        self.remove_edge(u, v)
+        entries = edge_timeline(data)
+        self._edge_chapters[(u, v)] = [c for c, _, _ in entries]
+        self._edge_states[(u, v)] = [(label, color) for _, label, color in entries]
+        self._edge_added[(u, v)] = data.get('chapter', 1)
+        self._count(self._edge_added[(u, v)], 1)
+        self._cache.clear()
+
+    def remove_edge(self, u, v):
+        if (u, v) in self._edge_chapters:
+            del self._edge_chapters[(u, v)]
+            del self._edge_states[(u, v)]
+            self._count(self._edge_added.pop((u, v)), -1)
+            self._cache.clear()
+
+    # --- 查詢 ---
+
+    @property
+    def max_chapter(self):
+        return self._max_chapter
+
+    def node_chapter(self, n):
+        return self._node_chapters.get(n, 1)
+
+    def edge_state(self, u, v, chapter):
+        chapters = self._edge_chapters.get((u, v))
+        if not chapters:
+            return None
+        i = bisect_right(chapters, chapter)
+        return self._edge_states[(u, v)][i - 1] if i else None
+
+    def graph_at(self, chapter):
+        key = (self._version, chapter)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        G = nx.DiGraph()
+        for n, data in self._graph.nodes(data=True):
+            if self.node_chapter(n) <= chapter:
+                G.add_node(n, **data)
+        for u, v in self._graph.edges():
+            state = self.edge_state(u, v, chapter)
+            if state is not None:
+                G.add_edge(u, v, label=state[0], color=state[1])
+        for n, data in G.nodes(data=True):
+            # 因關係而提前出現的角色沿用已排好的座標
+            if not data and self._graph.has_node(n):
+                data.update({k: self._graph.nodes[n][k] for k in ('x', 'y') if k in self._graph.nodes[n]})
+
+        self._cache[key] = G
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return G
@@ -2,7 +2,11 @@ import streamlit as st
 import streamlit.components.v1 as components
 import os
 import json
+import re
 import networkx as nx
+from modules.analytics import METRICS
+from modules.ingestion import CHAPTER_PATTERN, count_chapters, open_text
+from modules.search import SearchIndex
 
 def render_sidebar():
     with st.sidebar:
@@ -46,7 +50,7 @@ def render_sidebar():
         with c1:
             if st.button("↩️ Undo", use_container_width=True):
                 new_graph, msg = st.session_state['manager'].undo()
-                if new_graph:
+                if new_graph is not None:
                     st.session_state['graph'] = new_graph
                     st.toast(msg)
                     st.rerun()
@@ -55,7 +59,7 @@ def render_sidebar():
         with c2:
             if st.button("↪️ Redo", use_container_width=True):
                 new_graph, msg = st.session_state['manager'].redo()
-                if new_graph: 
+                if new_graph is not None:
                     st.session_state['graph'] = new_graph
                     st.toast(msg)
                     st.rerun()
@@ -91,7 +95,7 @@ def render_sidebar():
         with st.expander("💾 專案管理", expanded=True):
             col_save_1, col_save_2 = st.columns([2, 1])
             with col_save_1:
-                project_name = st.text_input("專案檔名", value="my_story", label_visibility="collapsed")
+                project_name = st.text_input("專案檔名", value="my_story", label_visibility="collapsed", help="輸入 .nxg 副檔名 (例如 my_story.nxg) 可儲存為二進位格式，適合大型圖譜")
             with col_save_2:
                 if st.button("Save", width='stretch'): 
                     success, msg = st.session_state['manager'].save_graph(st.session_state['graph'], project_name)
@@ -99,11 +103,11 @@ def render_sidebar():
                     else: st.error(msg)
             
             st.caption("載入專案")
-            uploaded_file = st.file_uploader("選擇 JSON 檔案", type="json", label_visibility="collapsed")
+            uploaded_file = st.file_uploader("選擇 JSON / NXG 檔案", type=["json", "nxg"], label_visibility="collapsed")
             if uploaded_file is not None: 
                 if st.button("Load Project", width='stretch'):
                     new_graph, msg = st.session_state['manager'].load_graph(uploaded_file)
-                    if new_graph: 
+                    if new_graph is not None:
                         st.session_state['graph'] = new_graph
                         components.html("<script>localStorage.removeItem('nexus_graph_positions'); window.parent.location.reload();</script>", height=0)
                         st.toast(msg, icon="📂")
@@ -132,8 +136,49 @@ def render_sidebar():
 
         st.markdown("---")
         st.header("👀 檢視設定")
-        all_nodes = list(st.session_state['graph'].nodes())
-        st.session_state['search_target'] = st.selectbox("🔍 搜尋並聚焦角色", ["顯示全部"] + all_nodes)
+        # 以倒排索引搜尋角色名稱、簡介與關係標籤，只列出目前這一頁的結果，不必每次列出所有角色
+        if 'search_index' not in st.session_state:
+            st.session_state['search_index'] = SearchIndex()
+            st.session_state['manager'].subscribe(st.session_state['search_index'].apply_change)
+        search_index = st.session_state['search_index']
+        graph = st.session_state['graph']
+        search_index.sync(graph, st.session_state['manager'].graph_version(graph))
+        query = st.text_input("🔍 搜尋角色、簡介或關係", key="search_query", placeholder="輸入名稱或關鍵字...")
+        target = "顯示全部"
+        if query:
+            prefix = st.toggle("只比對開頭", key="search_prefix")
+            page_size = 20
+            _, total = search_index.search(query, prefix=prefix, page_size=page_size)
+            pages = max(1, -(-total // page_size))
+            # 元件使用固定的 key，換了查詢或頁數時清掉舊的選擇，session_state 才不會每次查詢都多一筆
+            last = st.session_state.get('search_state')
+            if last is None or last[:2] != (query, prefix):
+                st.session_state.pop('search_page', None)
+            page = st.number_input(f"頁數 (共 {total} 筆)", min_value=1, max_value=pages, value=1, key="search_page") if pages > 1 else 1
+            if last != (query, prefix, page):
+                st.session_state.pop('search_choice', None)
+            st.session_state['search_state'] = (query, prefix, page)
+            hits, _ = search_index.search(query, prefix=prefix, page=page - 1, page_size=page_size)
+            options = {"顯示全部": "顯示全部"}
+            for hit in hits:
+                if hit['kind'] == "node":
+                    text = hit['id'] if hit['field'] == "name" else f"{hit['id']}｜{hit['text']}"
+                    options.setdefault(text, hit['id'])
+                else:
+                    u, v = hit['id']
+                    options.setdefault(f"{u} → {v}｜{hit['text']}", u)
+            if total == 0: st.caption("找不到符合的角色或關係")
+            # 預設停在「顯示全部」，使用者選了結果才進入聚焦模式
+            choice = st.selectbox("搜尋結果", list(options), index=0, key="search_choice")
+            target = options[choice]
+        st.session_state['search_target'] = target
+
+        st.number_input("群組化門檻 (角色數)", min_value=100, value=2000, step=100, key="lod_threshold",
+                        help="角色數超過此值時，圖表會將社群收合為群組節點以維持瀏覽器流暢")
+        if st.button("🧭 重新排版", use_container_width=True):
+            success, msg = st.session_state['manager'].layout_graph(st.session_state['graph'])
+            if success: st.toast(msg, icon="🧭")
+            else: st.toast(msg, icon="⚠️")
         
         if st.button("⚠️ Reset", type="primary", use_container_width=True):
             success, msg = st.session_state['manager'].reset_graph(st.session_state['graph'])
@@ -151,7 +196,10 @@ def render_sidebar():
         
         if hasattr(st.session_state['manager'], 'analyze_centrality'):
             if st.session_state['graph'].number_of_nodes() > 0:
-                top_nodes = st.session_state['manager'].analyze_centrality(st.session_state['graph'])
+                metric = st.selectbox("分析指標", options=list(METRICS), format_func=METRICS.get, key="centrality_metric")
+                top_nodes = st.session_state['manager'].analyze_centrality(st.session_state['graph'], metric=metric)
+                if not top_nodes:
+                    st.caption("此指標無法收斂，請改用其他指標")
                 for rank, (name, score) in enumerate(top_nodes, 1):
                     st.write(f"**#{rank} {name}**")
                     safe_score = max(0.0, min(1.0, float(score))) # 防護網
@@ -198,22 +246,86 @@ def render_main_tabs():
 
     with tab_ai: 
         st.caption("支援 OpenAI 與 Groq")
+        cache_stats = st.session_state['manager'].llm_cache.stats()
+        if cache_stats['hits'] or cache_stats['misses']:
+            st.caption(f"♻️ 分析快取：命中率 {cache_stats['hit_rate']:.0%} ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']} 段)，已保存 {cache_stats['entries']} 筆")
+        llm_summary = st.session_state['manager'].llm_stats.summary()
+        if llm_summary['requests']:
+            st.caption(f"⏱️ 最近 {llm_summary['requests']} 次請求：平均首字延遲 {llm_summary['avg_latency']:.1f} 秒、平均耗時 {llm_summary['avg_duration']:.1f} 秒，重試 {llm_summary['retries']} 次")
         source_text = st.text_area("故事文本", height=150, placeholder="請貼上一段內容...")
         api_key = st.session_state.get('api_key', '')
+        token_budget = st.number_input("模型上下文長度 (token，0 = 固定每段 3000 字)", min_value=0, value=0, step=1000, key="token_budget",
+                                       help="設定後會依此預算決定每段的長度，盡量填滿模型的上下文")
 
         if st.button("開始分析", width='stretch'):
             if not source_text: st.warning("⚠️ 請先貼上內容！")
             elif not api_key: st.error("❌ 尚未設定 API Key！")
             else:
-                with st.spinner("🤖 AI 正在分析關係..."):
-                    ai_nodes, ai_edges, error = st.session_state['manager'].process_text_with_ai(source_text, api_key)
-                    if not ai_nodes and not ai_edges and not error:
-                        st.warning("🤔 AI 未發現內容。")
-                    elif error:
-                        st.error(f"AI 呼叫失敗：{error}")
-                    else: 
-                        st.session_state['ai_result'] = {"nodes": ai_nodes, "edges": ai_edges}
-                        st.toast("分析完成！", icon="✅")
+                # 邊生成邊顯示：每解析出一個角色或關係就更新預覽表格
+                status = st.empty()
+                nodes_preview, edges_preview = st.empty(), st.empty()
+                ai_nodes, ai_edges, errors = [], [], []
+                status.info("🤖 AI 正在分析關係...")
+                for kind, item in st.session_state['manager'].stream_text_with_ai(
+                        source_text, api_key, graph=st.session_state['graph'], token_budget=token_budget or None):
+                    if kind == "error":
+                        errors.append(item)
+                    elif kind == "nodes":
+                        ai_nodes.append(item)
+                        nodes_preview.dataframe(ai_nodes, width='stretch')
+                    else:
+                        ai_edges.append(item)
+                        edges_preview.dataframe(ai_edges, width='stretch')
+                    status.info(f"🤖 AI 正在分析關係... 已找到 {len(ai_nodes)} 個角色、{len(ai_edges)} 條關係")
+                for placeholder in (status, nodes_preview, edges_preview):
+                    placeholder.empty()
+                error = f"{len(errors)} 個段落分析失敗：{errors[0]}" if errors else None
+                if not ai_nodes and not ai_edges and not error:
+                    st.warning("🤔 AI 未發現內容。")
+                elif error and not ai_nodes and not ai_edges:
+                    st.error(f"AI 呼叫失敗：{errors[0]}")
+                else: 
+                    if error: st.warning(f"⚠️ {error}")
+                    st.session_state['ai_result'] = {"nodes": ai_nodes, "edges": ai_edges}
+                    st.toast("分析完成！", icon="✅")
+
+        with st.expander("📚 整本書匯入", expanded=False):
+            book = st.file_uploader("上傳純文字檔 (.txt)", type=["txt"], key="book_file")
+            pattern = st.text_input("章節標題 (正規表示式)", value=CHAPTER_PATTERN, key="book_pattern",
+                                    help="符合的行視為新章節的開始，章節編號依出現順序自動遞增")
+            start_chapter = st.number_input("第一章的編號", min_value=1, value=1, key="book_start")
+            if st.button("開始匯入", width='stretch', disabled=book is None):
+                if not api_key: st.error("❌ 尚未設定 API Key！")
+                else:
+                    try:
+                        re.compile(pattern)
+                    except re.error as e:
+                        st.error(f"章節標題格式錯誤：{e}")
+                    else:
+                        reader = open_text(book)
+                        total = max(1, count_chapters(reader, pattern))
+                        reader.detach()  # 保留上傳的檔案不被關閉，重新從頭讀取
+                        book.seek(0)
+                        progress = st.progress(0.0, text="準備中...")
+                        log = st.empty()
+                        lines = []
+                        events = st.session_state['manager'].ingest_book(
+                            st.session_state['graph'], open_text(book), api_key, source=book.name,
+                            pattern=pattern, start=start_chapter, token_budget=token_budget or None)
+                        for i, event in enumerate(events, 1):
+                            icon = {"skipped": "⏭️", "done": "✅", "partial": "⚠️", "failed": "❌"}[event['status']]
+                            lines.append(f"{icon} 第 {event['chapter']} 章 {event['title']}：{event['message']}")
+                            progress.progress(min(1.0, i / total), text=f"已處理 {i}/{total} 章")
+                            log.caption("\n\n".join(lines[-5:]))
+                        if lines and lines[-1].startswith("❌"):
+                            st.error("匯入中斷，修正後再按一次「開始匯入」會從中斷的章節繼續。")
+                        elif lines and all(line.startswith("⏭️") for line in lines):
+                            st.info("所有章節先前都已匯入，圖沒有變動；如需重新匯入，請先按「清除匯入進度」。")
+                        else:
+                            st.toast("整本書匯入完成！", icon="📚")
+            if st.button("清除匯入進度", width='stretch', disabled=book is None, key="book_reset"):
+                success, msg = st.session_state['manager'].reset_ingest(book.name, pattern, start_chapter)
+                st.toast(msg, icon="🧹")
 
         if 'ai_result' in st.session_state:
             res = st.session_state['ai_result']
@@ -263,6 +375,42 @@ def render_main_tabs():
                         if success: st.toast(msg, icon="🗑️"); st.rerun()
                         else: st.error(msg)
 
+        with st.expander("🧬 合併重複角色", expanded=False):
+            manager = st.session_state['manager']
+            graph = st.session_state['graph']
+            # 不列出整張圖的角色：輸入名稱後以實體索引解析，並列出相似的角色供確認
+            merge_query = st.text_input("保留的角色", placeholder="輸入角色名稱或別名", key="merge_target")
+            manager.entities.sync(graph, manager.graph_version(graph))
+            merge_target = manager.entities.resolve(merge_query) if merge_query else None
+            if merge_query and merge_target is None:
+                st.warning(f"找不到角色 '{merge_query}'。")
+            elif merge_target is not None:
+                suggested = [n for n, _ in manager.entities.candidates(merge_target, limit=20)]
+                if suggested: st.caption(f"💡 可能是同一人：{'、'.join(map(str, suggested))}")
+                else: st.caption("沒有找到相似的角色，可直接輸入其他要併入的角色。")
+                merge_sources = st.multiselect("併入的角色", options=suggested, default=suggested,
+                                               key=f"merge_sources_{merge_target}")
+                extra = st.text_input("其他要併入的角色 (以逗號分隔)", key=f"merge_extra_{merge_target}")
+                for name in (n.strip() for n in extra.replace("，", ",").split(",")):
+                    resolved = manager.entities.resolve(name) if name else None
+                    if name and resolved is None:
+                        st.warning(f"找不到角色 '{name}'。")
+                    elif resolved is not None and resolved != merge_target and resolved not in merge_sources:
+                        merge_sources.append(resolved)
+                if st.button("確認合併", type="primary", width='stretch', disabled=not merge_sources):
+                    success, msg = manager.merge_characters(graph, merge_target, merge_sources)
+                    if success: st.toast(msg, icon="🧬"); st.rerun()
+                    else: st.error(msg)
+            st.markdown("**別名表**")
+            a1, a2 = st.columns(2)
+            alias = a1.text_input("別名", placeholder="例如 Harry Potter", key="alias_name")
+            canonical = a2.text_input("對應的角色", placeholder="例如 哈利波特", key="alias_target")
+            if st.button("新增別名", width='stretch', disabled=not (alias and canonical)):
+                if manager.aliases.add(alias, canonical): st.toast(f"已新增別名：{alias} → {canonical}", icon="🏷️")
+                else: st.error("別名與角色名稱相同。")
+            if manager.aliases.items():
+                st.dataframe([{"別名": a, "角色": c} for a, c in manager.aliases.items()], width='stretch')
+
         with st.expander("✏️ 修改資料", expanded=False):
             edit_type = st.radio("欲修改的項目", ["角色描述", "關係標籤"], horizontal=True)
             if edit_type == "角色描述":
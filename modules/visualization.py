@@ -1,15 +1,54 @@
 import streamlit as st
 import streamlit.components.v1 as components
-from pyvis.network import Network
-import tempfile
-import os
+from collections import OrderedDict
 import json
+import os
+import re
+import weakref
+from modules.assets import inline_json, minify, publish, read_asset
+from modules.layout import has_layout
+
+HTML_CACHE_SIZE = 8
+
+COMPONENT_DIR = os.path.join(os.path.dirname(__file__), os.pardir, "assets", "graph_component")
+
+# (呼叫端提供的 key, 選項) -> (圖的弱參照, 匯出用的 HTML)；同一個畫面重新執行時不必再序列化整張圖
+_html_cache = OrderedDict()
 
-def render_interactive_graph(nx_graph):
-    net = Network(height="700px", width="100%", bgcolor="#222831", font_color="white", directed=True)
-    net.from_nx(nx_graph)
-    
-    options = {
+# 匯出用的單一 HTML：vis-network 與資料全部內嵌，離線也能開啟
+EXPORT_TEMPLATE = minify("""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <meta charset="utf-8">
+        <title>Nexus Graph</title>
+        <style>__VIS_CSS__</style>
+        <style>
+            html, body { margin: 0; padding: 0; background-color: #222831; overflow: hidden; }
+            #graph { width: 100vw; height: 100vh; }
+        </style>
+        <script>__VIS_JS__</script>
+    </head>
+    <body>
+        <div id="graph"></div>
+        <script>
+            var data = __DATA__;
+            var network = new vis.Network(document.getElementById("graph"), {
+                nodes: new vis.DataSet(data.nodes),
+                edges: new vis.DataSet(data.edges)
+            }, data.options);
+            network.on("doubleClick", function (params) {
+                if (params.nodes.length === 0) network.fit({ animation: true });
+            });
+        </script>
+    </body>
+    </html>
+""")
+
+
+def graph_options(server_layout=False):
+    # 伺服器端已算好座標 (x / y) 時直接使用，瀏覽器不必再跑物理模擬
+    return {
         "nodes": {
             "borderWidth": 2,
             "color": { "highlight": { "border": "#00ADB5", "background": "#393E46" } },
@@ -34,7 +73,7 @@ def render_interactive_graph(nx_graph):
             "smooth": { "type": "dynamic" }
         },
         "physics": {
-            "enabled": True,
+            "enabled": not server_layout,
             "barnesHut": {
                 "gravitationalConstant": -3000, 
                 "centralGravity": 0.1,            
@@ -54,124 +93,133 @@ def render_interactive_graph(nx_graph):
             "dragNodes": True, "dragView": True, "zoomView": True, "hover": True
         }
     }
-    
-    net.set_options(f"var options = {json.dumps(options)}")
-    
-    try:
-        html_data = net.generate_html()
-    except AttributeError:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".html") as tmp:
-            net.save_graph(tmp.name)
-            with open(tmp.name, "r", encoding="utf-8") as f:
-                html_data = f.read()
-            os.unlink(tmp.name)
-
-    js_injection = """
-    <script type="text/javascript">
-        var isFirstLoad = true;
-
-        network.on("afterDrawing", function (ctx) {
-            if (!isFirstLoad) return;
-            isFirstLoad = false;
-
-            var savedPositions = localStorage.getItem("nexus_graph_positions");
-            var currentNodes = nodes.getIds();
-            var existingNodeIds = new Set();
-
-            if (savedPositions) {
-                var positions = JSON.parse(savedPositions);
-                currentNodes.forEach(function(nodeId) {
-                    if (positions[nodeId]) {
-                        network.body.nodes[nodeId].x = positions[nodeId].x;
-                        network.body.nodes[nodeId].y = positions[nodeId].y;
-                        existingNodeIds.add(nodeId);
-                    }
-                });
-            } else {
-                var center = network.getViewPosition();
-                currentNodes.forEach(function(nodeId) {
-                     var off = (Math.random() - 0.5) * 20; 
-                     network.moveNode(nodeId, center.x + off, center.y + off);
-                });
-            }
 
-            var savedCamera = localStorage.getItem("nexus_graph_camera");
-            if (savedCamera) {
-                var cameraState = JSON.parse(savedCamera);
-                network.moveTo({
-                    position: cameraState.position,
-                    scale: cameraState.scale,
-                    animation: false
-                });
-                
-                var centerPos = network.getViewPosition();
-                currentNodes.forEach(function(nodeId) {
-                    if (!existingNodeIds.has(nodeId)) {
-                        var offsetX = (Math.random() - 0.5) * 50;
-                        var offsetY = (Math.random() - 0.5) * 50;
-                        network.moveNode(nodeId, centerPos.x + offsetX, centerPos.y + offsetY);
-                    }
-                });
-            } else {
-                network.fit({animation: false}); 
-            }
-            
-            saveNodePositions();
-
-            setTimeout(function() { network.startSimulation(); }, 100);
-            setTimeout(function() { saveNodePositions(); }, 3000);
-        });
-
-        network.on("dragEnd", function (params) {
-            if (params.nodes.length > 0) saveNodePositions();
-            saveCameraState();
-        });
-        
-        network.on("zoom", function() { saveCameraState(); });
-        network.on("dragView", function() { saveCameraState(); });
-        network.on("stabilizationIterationsDone", function() { saveNodePositions(); });
-
-        function saveNodePositions() {
-            var allPositions = network.getPositions();
-            var oldData = localStorage.getItem("nexus_graph_positions");
-            var savedData = oldData ? JSON.parse(oldData) : {};
-            
-            for (var nodeId in allPositions) {
-                savedData[nodeId] = allPositions[nodeId];
-            }
-            localStorage.setItem("nexus_graph_positions", JSON.stringify(savedData));
-        }
 
-        function saveCameraState() {
-            var scale = network.getScale();
-            var position = network.getViewPosition();
-            var cameraState = { scale: scale, position: position };
-            localStorage.setItem("nexus_graph_camera", JSON.stringify(cameraState));
-        }
+NODE_FIELDS = ("label", "title", "x", "y", "shape", "value", "group", "color", "size")
+EDGE_FIELDS = ("label", "title", "color", "value", "width")
+
+
+def vis_node(n, data):
+    node = {k: data[k] for k in NODE_FIELDS if k in data}
+    node["id"] = n
+    node.setdefault("label", str(n))
+    return node
+
+
+def vis_edge(u, v, data):
+    edge = {k: data[k] for k in EDGE_FIELDS if k in data}
+    edge.update({"id": json.dumps([u, v], ensure_ascii=False), "from": u, "to": v})
+    return edge
+
+
+def build_graph_html(nx_graph, cache_key=None):
+    """產生可離線開啟的單一 HTML 檔。cache_key 應能唯一代表圖的內容 (例如 (版本, 章節))，提供時結果會被快取。"""
+    server_layout = nx_graph.number_of_nodes() > 0 and has_layout(nx_graph)
+
+    options = graph_options(server_layout)
+    options_json = json.dumps(options)
+
+    key = None if cache_key is None else (cache_key, options_json)
+    if key is not None and key in _html_cache:
+        ref, html_data = _html_cache[key]
+        # 不同的圖可能有相同的版本號，必須是同一個物件才算命中
+        if ref() is nx_graph:
+            _html_cache.move_to_end(key)
+            return html_data
+
+    data = {
+        "nodes": [vis_node(n, d) for n, d in nx_graph.nodes(data=True)],
+        "edges": [vis_edge(u, v, d) for u, v, d in nx_graph.edges(data=True)],
+        "options": options,
+    }
+    parts = {
+        "VIS_CSS": read_asset("css")[0],
+        "VIS_JS": read_asset("js")[0],
+        "DATA": inline_json(json.dumps(data, ensure_ascii=False, separators=(",", ":"))),
+    }
+    # 一次替換所有佔位字串，避免資料內容剛好含有佔位字串時被再次替換
+    html_data = re.sub(r"__(VIS_CSS|VIS_JS|DATA)__", lambda m: parts[m.group(1)], EXPORT_TEMPLATE)
+
+    if key is not None:
+        _html_cache[key] = (weakref.ref(nx_graph), html_data)
+        _html_cache.move_to_end(key)
+        if len(_html_cache) > HTML_CACHE_SIZE:
+            _html_cache.popitem(last=False)
+    return html_data
+
+
+class GraphView:
+    """瀏覽器端圖表的同步狀態：記住上次送出的節點與關係，之後每次只送出新增、刪除與變更的部分。"""
+
+    def __init__(self, assets=None):
+        # assets 為前端元件目錄中 vis-network 的檔名 (見 modules.assets.publish)，隨完整資料送出
+        self.assets = assets or {}
+        self.revision = 0
+        self._ref = None
+        self._options = None
+        self._nodes = {}
+        self._edges = {}
+        self._args = None
+
+    def update(self, nx_graph, client_state=None):
+        """回傳要交給前端元件的參數；client_state 為元件回傳的值，要求重送時改送完整資料。"""
+        resync = isinstance(client_state, dict) and client_state.get("resync") == self.revision
+        options = graph_options(nx_graph.number_of_nodes() > 0 and has_layout(nx_graph))
+        if self._args is not None and not resync and self._ref() is nx_graph and options == self._options:
+            return self._args
+
+        nodes = {n: vis_node(n, data) for n, data in nx_graph.nodes(data=True)}
+        edges = {(u, v): vis_edge(u, v, data) for u, v, data in nx_graph.edges(data=True)}
+        if self._args is None or resync or options != self._options:
+            args = {"revision": self.revision + 1, "base": None, "options": options, "assets": self.assets,
+                    "nodes": list(nodes.values()), "edges": list(edges.values())}
+        else:
+            changed_nodes = [_with_dropped(node, self._nodes.get(n)) for n, node in nodes.items()
+                             if self._nodes.get(n) != node]
+            changed_edges = [_with_dropped(edge, self._edges.get(e)) for e, edge in edges.items()
+                             if self._edges.get(e) != edge]
+            removed_nodes = [n for n in self._nodes if n not in nodes]
+            removed_edges = [edge["id"] for e, edge in self._edges.items() if e not in edges]
+            if changed_nodes or changed_edges or removed_nodes or removed_edges:
+                args = {"revision": self.revision + 1, "base": self.revision,
+                        "nodes": changed_nodes, "edges": changed_edges,
+                        "removed_nodes": removed_nodes, "removed_edges": removed_edges}
+            else:
+                args = self._args
+
+        if args is not self._args:
+            self.revision = args["revision"]
+            self._args = args
+        self._ref = weakref.ref(nx_graph)
+        self._options = options
+        self._nodes = nodes
+        self._edges = edges
+        return args
+
+
+def _with_dropped(item, previous):
+    # 瀏覽器端的 DataSet.update 會與原本的資料合併，上次有、這次沒有的欄位 (例如聚焦或路徑的顏色) 要明確送出 null 才會清掉
+    if not previous:
+        return item
+    return {**item, **{key: None for key in previous if key not in item}}
+
+
+_graph_component = components.declare_component("nexus_graph", path=COMPONENT_DIR)
+
 
-        network.on("doubleClick", function(params) {
-             if (params.nodes.length === 0) {
-                network.fit({animation: true});
-                setTimeout(saveCameraState, 1000);
-             }
-        });
-    </script>
-    """
-    
-    html_data = html_data.replace('</body>', f'{js_injection}</body>')
-    components.html(html_data, height=710, scrolling=False)
+def render_interactive_graph(nx_graph, cache_key=None):
+    # 圖表元件常駐在頁面上，重新執行時只把差異送到瀏覽器，不必重建整個 vis.js 網路
+    if 'graph_view' not in st.session_state:
+        st.session_state['graph_view'] = GraphView(assets=publish(COMPONENT_DIR))
+    args = st.session_state['graph_view'].update(nx_graph, st.session_state.get('graph_view_component'))
+    _graph_component(**args, key="graph_view_component", default=None)
 
     st.caption("💡 提示：雙擊空白處可自動置中 (Fit)")
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".html") as tmp:
-        net.save_graph(tmp.name)
-        with open(tmp.name, "rb") as f:
-            html_bytes = f.read()
-        
-        st.download_button(
-            label="🌏 下載此圖表 (HTML)",
-            data=html_bytes,
-            file_name="knowledge_graph.html",
-            mime="text/html",
-            key="download_graph_html" 
-        )
-        os.unlink(tmp.name)
\ No newline at end of file
+    # 下載用的完整 HTML 只在使用者按下按鈕時才產生，並沿用同一份快取
+    st.download_button(
+        label="🌏 下載此圖表 (HTML)",
+        data=lambda: build_graph_html(nx_graph, cache_key).encode("utf-8"),
+        file_name="knowledge_graph.html",
+        mime="text/html",
+        key="download_graph_html"
+    )
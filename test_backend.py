@@ -1,7 +1,35 @@
 # test_backend.py
+import gc
+import json
+import os
+import re
+import threading
+import time
+import weakref
 import pytest
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 import networkx as nx
+import numpy as np
+from modules import sparse
+from modules.assets import publish
+from modules.autosave import AutosaveWriter
 from modules.backend import GraphManager
+from modules.clustering import ClusterIndex, cluster_node
+from modules.extraction import (KnownEntities, PartialJSONItems, chunk_size_for_budget, estimate_tokens,
+                               iter_extract, merge_results, split_text)
+from modules.focus import FOCUS_COLOR, NeighborhoodIndex
+from modules.llm_cache import LLMCache
+from modules import llm_client
+from modules.ingestion import IngestCheckpoint, count_chapters, iter_chapters, open_text
+from modules.layout import force_layout, has_layout, place_nodes
+from modules.paths import PATH_COLOR, PathIndex, highlight_path
+from modules.resolution import AliasTable, EntityIndex
+from modules.search import SearchIndex
+from modules.sparse import SparseGraph
+from modules.storage import BinaryGraph, convert, read_graph
+from modules.timeline import TimelineIndex
+from modules import visualization
 
 # --- Fixtures ---
 
@@ -90,4 +118,1134 @@ def test_edit_relationship_label(manager, empty_graph):
     success, msg = manager.edit_relationship_label(empty_graph, "A", "B", "Love")
     
     assert success is True
-    assert empty_graph["A"]["B"]["label"] == "Love"
\ No newline at end of file
+    assert empty_graph["A"]["B"]["label"] == "Love"
+# --- Undo / Redo ---
+
+def test_undo_redo_in_place(manager, empty_graph):
+    """測試：Undo/Redo 直接作用於同一張圖"""
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "Friend")
+    manager.delete_character(empty_graph, "B")
+
+    graph, msg = manager.undo()
+    assert graph is empty_graph
+    assert empty_graph.has_edge("A", "B")
+    assert empty_graph["A"]["B"]["label"] == "Friend"
+
+    manager.undo()
+    assert not empty_graph.has_edge("A", "B")
+
+    manager.redo()
+    manager.redo()
+    assert "B" not in empty_graph.nodes
+
+    graph, msg = manager.redo()
+    assert graph is None
+
+def test_undo_restores_edited_timeline(manager, empty_graph):
+    """測試：復原修改後，巢狀的 timeline 也要回到原本的內容"""
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "Hate")
+    manager.edit_relationship_label(empty_graph, "A", "B", "Love")
+
+    manager.undo()
+    assert empty_graph["A"]["B"]["label"] == "Hate"
+    assert empty_graph["A"]["B"]["timeline"]["1"]["label"] == "Hate"
+
+def test_history_limit_by_steps_and_size(empty_graph):
+    """測試：歷史紀錄依步驟數與估計大小設有上限，捨棄最舊的步驟後仍可復原較新的步驟"""
+    manager = GraphManager(history_limit=5)
+    for i in range(8):
+        manager.add_character(empty_graph, f"C{i}", "")
+    assert len(manager.history.steps) == 5 and manager.history.offset == 3
+
+    manager = GraphManager(history_bytes=2000)
+    manager.add_character(empty_graph, "Small", "")
+    manager.add_character(empty_graph, "Big", "x" * 1500)
+    manager.add_character(empty_graph, "Huge", "x" * 5000)
+    assert len(manager.history.steps) == 1  # 單一步驟超過上限時只保留這一步
+    assert manager.history.size == sum(manager.history.sizes) > 2000
+    manager.undo()
+    assert "Huge" not in empty_graph and "Big" in empty_graph
+
+# --- 自動存檔 ---
+
+def test_autosave_coalesces_and_flushes(tmp_path, empty_graph):
+    """測試：連續變更合併為一次寫入，flush 後檔案內容為最新狀態"""
+    path = tmp_path / "autosave.json"
+    writer = AutosaveWriter(str(path), delay=60)
+    for i in range(20):
+        empty_graph.add_node(f"C{i}")
+        writer.schedule(empty_graph)
+
+    assert writer.flush(timeout=5)
+    assert writer.writes == 1
+    data = json.loads(path.read_text(encoding="utf-8"))
+    assert len(data["nodes"]) == 20
+    assert os.listdir(tmp_path) == ["autosave.json"]
+    writer.close()
+
+def test_autosave_thread_exits_when_idle(tmp_path, empty_graph):
+    """測試：閒置後背景執行緒自行結束、下次存檔時再啟動，且結束後 writer 與圖可被回收"""
+    path = tmp_path / "autosave.json"
+    writer = AutosaveWriter(str(path), delay=0, idle_timeout=0.05)
+    empty_graph.add_node("A")
+    writer.schedule(empty_graph)
+    assert writer.flush(timeout=5)
+    deadline = time.monotonic() + 5
+    while writer._thread is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert writer._thread is None
+
+    empty_graph.add_node("B")
+    writer.schedule(empty_graph)
+    assert writer.flush(timeout=5)
+    assert writer.writes == 2 and len(json.loads(path.read_text(encoding="utf-8"))["nodes"]) == 2
+    while writer._thread is not None and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    ref = weakref.ref(writer)
+    del writer
+    gc.collect()
+    assert ref() is None
+
+def test_journal_recovers_after_crash(tmp_path, monkeypatch):
+    """測試：未寫入快照前當機，重新啟動時仍能從日誌還原"""
+    monkeypatch.chdir(tmp_path)
+    manager = GraphManager(autosave_delay=60)
+    graph = manager.get_initial_graph()
+    manager.add_character(graph, "A", "")
+    manager.add_relationship(graph, "A", "榮恩", "Friend")
+    manager.edit_character_description(graph, "A", "New")
+    manager.undo()
+
+    # 模擬當機：不 flush，直接由新的 manager 讀取
+    restored = GraphManager().get_initial_graph()
+    assert restored.has_edge("A", "榮恩")
+    assert restored.nodes["A"]["title"] == ""
+
+def test_journal_repairs_torn_tail(tmp_path, monkeypatch):
+    """測試：日誌最後一行只寫了一半時，重新啟動會截掉殘行，之後新增的變更在下次啟動仍能還原"""
+    monkeypatch.chdir(tmp_path)
+    manager = GraphManager(autosave_delay=60)
+    graph = manager.get_initial_graph()
+    manager.add_character(graph, "A", "")
+    manager.flush(timeout=5)
+    manager.add_character(graph, "B", "")
+    with open("data/autosave.journal", "ab") as f:
+        f.write(b'{"epoch":"x","seq":99,"ops":[["node","X"')
+
+    manager = GraphManager(autosave_delay=60)
+    graph = manager.get_initial_graph()
+    assert "B" in graph
+    manager.add_character(graph, "C", "")
+    manager.add_character(graph, "D", "")
+
+    restored = GraphManager().get_initial_graph()
+    assert {"A", "B", "C", "D"} <= set(restored.nodes)
+    assert "X" not in restored
+
+def test_journal_compaction(tmp_path, monkeypatch):
+    """測試：日誌超過門檻後自動壓縮進快照"""
+    monkeypatch.chdir(tmp_path)
+    manager = GraphManager(journal_limit=500)
+    graph = manager.get_initial_graph()
+    for i in range(20):
+        manager.add_character(graph, f"C{i}", "description")
+    manager.flush(timeout=5)
+
+    assert os.path.getsize("data/autosave.journal") < 500
+    restored = GraphManager().get_initial_graph()
+    assert sorted(restored.nodes) == sorted(graph.nodes)
+
+# --- 專案格式 ---
+
+def _story_graph():
+    G = nx.DiGraph()
+    G.add_node("哈利波特", title="存活下來的男孩", type="character", group=1, chapter=1)
+    G.add_node("榮恩", title=None, chapter=2, extra={"house": "葛來分多"})
+    G.add_node(7, title="數字名稱")
+    G.add_edge("哈利波特", "榮恩", label="摯友", color="#4CAF50", chapter=3,
+               timeline={"1": {"label": "同學", "color": "#9E9E9E"}, "3": {"label": "摯友", "color": "#4CAF50", "note": "x"}, "末章": "raw"})
+    G.add_edge("榮恩", 7, weight=0.5)
+    return G
+
+def test_binary_format_roundtrip(tmp_path):
+    """測試：JSON 與 .nxg 互轉不遺失任何資料"""
+    G = _story_graph()
+    with open(tmp_path / "story.json", "w", encoding="utf-8") as f:
+        json.dump(nx.node_link_data(G), f, ensure_ascii=False)
+
+    convert(str(tmp_path / "story.json"), str(tmp_path / "story.nxg"))
+    convert(str(tmp_path / "story.nxg"), str(tmp_path / "back.json"))
+
+    for path in ("story.nxg", "back.json"):
+        H = read_graph(str(tmp_path / path))
+        assert dict(H.nodes(data=True)) == dict(G.nodes(data=True))
+        assert {(u, v): d for u, v, d in H.edges(data=True)} == {(u, v): d for u, v, d in G.edges(data=True)}
+
+    with BinaryGraph.open(str(tmp_path / "story.nxg")) as bg:
+        assert bg.n_nodes == 3 and bg.n_edges == 2
+        assert bg.node_name(1) == "榮恩"
+
+def test_save_and_load_binary_project(manager, empty_graph):
+    """測試：以 .nxg 副檔名存檔並重新讀取"""
+    manager.add_character(empty_graph, "A", "desc", chapter=2)
+    success, msg = manager.save_graph(empty_graph, "pytest_binary.nxg")
+    assert success is True
+
+    with open("data/pytest_binary.nxg", "rb") as f:
+        graph, msg = GraphManager().load_graph(f)
+    os.remove("data/pytest_binary.nxg")
+    assert graph.nodes["A"] == {"title": "desc", "type": "character", "group": 1, "chapter": 2}
+
+# --- 時間軸 ---
+
+def test_timeline_index_state_at_chapter(manager, empty_graph):
+    """測試：時間軸索引能重現各章節當時的關係狀態"""
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "", chapter=3)
+    manager.batch_import(empty_graph, [], [{"source": "A", "target": "B", "label": "敵人", "color": "#F44336"}], chapter=2)
+    manager.batch_import(empty_graph, [], [{"source": "A", "target": "B", "label": "摯友", "color": "#4CAF50"}], chapter=10)
+
+    index = TimelineIndex()
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    assert index.max_chapter == 10
+
+    assert "B" not in index.graph_at(1).nodes
+    assert index.graph_at(9)["A"]["B"]["label"] == "敵人"
+    assert index.graph_at(10)["A"]["B"] == {"label": "摯友", "color": "#4CAF50"}
+    assert index.graph_at(10) is index.graph_at(10)
+
+    manager.delete_relationship(empty_graph, "A", "B")
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    assert index.max_chapter == 3
+    assert not index.graph_at(10).has_edge("A", "B")
+
+def test_change_hooks_and_versions(manager, empty_graph):
+    """測試：每次變更都會遞增版本，並通知碰到的角色與關係"""
+    changes = []
+    unsubscribe = manager.subscribe(changes.append)
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "Friend")
+    manager.delete_character(empty_graph, "B")
+    manager.undo()
+
+    assert manager.graph_version(empty_graph) == 5
+    assert [c.version for c in changes] == [1, 2, 3, 4, 5]
+    assert changes[3].nodes == {"B"} and changes[3].edges == {("A", "B")}
+    assert changes[4].edges == {("A", "B")}
+
+    unsubscribe()
+    manager.add_character(empty_graph, "C", "")
+    assert len(changes) == 5
+
+def test_timeline_index_follows_change_hooks(manager, empty_graph, monkeypatch):
+    """測試：訂閱變更後，時間軸索引只做增量更新"""
+    index = TimelineIndex()
+    manager.subscribe(index.apply_change)
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    monkeypatch.setattr(index, "rebuild", lambda graph: pytest.fail("不應整個重建"))
+
+    manager.add_character(empty_graph, "A", "", chapter=4)
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "Friend", chapter=6)
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    assert index.max_chapter == 6
+    assert index.graph_at(6).has_edge("A", "B")
+
+    manager.undo()
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    assert index.max_chapter == 4
+
+# --- 中心性分析 ---
+
+def test_centrality_incremental_matches_networkx(manager, empty_graph):
+    """測試：增量維護的連結數結果與 NetworkX 一致"""
+    for name in "ABCDE":
+        manager.add_character(empty_graph, name, "")
+    assert manager.analyze_centrality(empty_graph)[0][1] == 0
+
+    for u, v in [("A", "B"), ("A", "C"), ("B", "C"), ("D", "A")]:
+        manager.add_relationship(empty_graph, u, v, "x")
+    manager.delete_character(empty_graph, "E")
+    manager.delete_relationship(empty_graph, "B", "C")
+
+    expected = sorted(nx.degree_centrality(empty_graph).items(), key=lambda x: x[1], reverse=True)[:5]
+    assert manager.analyze_centrality(empty_graph) == expected
+    assert dict(manager.analyze_centrality(empty_graph, metric="in_degree", k=10)) == nx.in_degree_centrality(empty_graph)
+
+def test_centrality_metrics_are_cached(manager, empty_graph, monkeypatch):
+    """測試：切換指標不會重算其他指標，圖未變更時直接使用快取"""
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "x")
+    pagerank = manager.analyze_centrality(empty_graph, metric="pagerank")
+    assert pagerank[0][0] == "B"
+
+    monkeypatch.setattr(nx, "pagerank", lambda graph: pytest.fail("不應重算"))
+    manager.analyze_centrality(empty_graph, metric="betweenness")
+    assert manager.analyze_centrality(empty_graph, metric="pagerank") == pagerank
+
+def test_sparse_backend_matches_networkx():
+    """測試：稀疏矩陣版本的 PageRank、Eigenvector 與 Betweenness 與 NetworkX 一致"""
+    G = nx.gnp_random_graph(60, 0.08, seed=1, directed=True)
+    sg = SparseGraph(G)
+
+    pr = sg.to_dict(sparse.pagerank(sg))
+    expected = nx.pagerank(G)
+    assert all(abs(pr[n] - expected[n]) < 1e-4 for n in G)
+
+    ev = sg.to_dict(sparse.eigenvector(sg))
+    expected = nx.eigenvector_centrality(G, max_iter=1000)
+    assert all(abs(ev[n] - expected[n]) < 1e-3 for n in G)
+
+    exact = sparse.betweenness(sg, k=len(sg))
+    expected = nx.betweenness_centrality(G)
+    assert all(abs(v - expected[n]) < 1e-9 for n, v in sg.to_dict(exact).items())
+
+    approx = sparse.betweenness(sg, k=30, seed=0)
+    assert np.abs(approx - exact).max() < 0.1
+    assert [n for n, _ in sg.ranked(exact, k=3)] == [n for n, _ in sorted(expected.items(), key=lambda x: x[1], reverse=True)[:3]]
+
+def test_large_graph_uses_sparse_backend(manager, empty_graph):
+    """測試：大型圖自動改用稀疏矩陣後端"""
+    manager.analytics.sparse_threshold = 1
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "x")
+    top = manager.analyze_centrality(empty_graph, metric="pagerank")
+    assert top[0][0] == "B"
+    assert manager.analytics._matrix is not None
+
+# --- 排版 ---
+
+def test_force_layout_places_neighbors_closer():
+    """測試：排版結果有限且相連的角色比平均距離更近 (含格點近似路徑)"""
+    G = nx.connected_caveman_graph(6, 8).to_directed()
+    for exact_limit in (1000, 10):
+        pos = force_layout(G, seed=0, exact_limit=exact_limit)
+        P = np.array([pos[n] for n in G])
+        assert np.isfinite(P).all()
+        dist = lambda u, v: np.hypot(pos[u][0] - pos[v][0], pos[u][1] - pos[v][1])
+        linked = np.mean([dist(u, v) for u, v in G.edges()])
+        overall = np.mean([dist(u, v) for u in G for v in G if u != v])
+        assert linked < overall / 2
+
+def test_layout_is_saved_with_project(manager, empty_graph):
+    """測試：座標存為角色屬性並隨專案儲存，且不佔用 Undo 歷史"""
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "x")
+    steps = len(manager.history.steps)
+
+    assert manager.ensure_layout(empty_graph) is True
+    assert has_layout(empty_graph)
+    assert len(manager.history.steps) == steps
+    assert manager.ensure_layout(empty_graph) is False
+
+    manager.save_graph(empty_graph, "pytest_layout.nxg")
+    graph = read_graph("data/pytest_layout.nxg")
+    os.remove("data/pytest_layout.nxg")
+    assert graph.nodes["A"]["x"] == empty_graph.nodes["A"]["x"]
+    assert graph.nodes["B"]["y"] == empty_graph.nodes["B"]["y"]
+
+def test_incremental_layout_only_places_new_nodes(manager, empty_graph, monkeypatch):
+    """測試：批次匯入後只放置新角色，既有座標不變且新角色落在鄰居附近"""
+    for name in "ABCD":
+        manager.add_character(empty_graph, name, "")
+    manager.batch_import(empty_graph, [], [{"source": "A", "target": "B"}, {"source": "B", "target": "C"}, {"source": "C", "target": "D"}])
+    manager.layout_graph(empty_graph, seed=0)
+    before = {n: (d["x"], d["y"]) for n, d in empty_graph.nodes(data=True)}
+
+    def full_layout(*args, **kwargs):
+        raise AssertionError("不應重新排版整張圖")
+    monkeypatch.setattr(manager, "layout_graph", full_layout)
+    manager.batch_import(empty_graph, [], [{"source": "E", "target": "A"}])
+    assert manager.ensure_layout(empty_graph) is True
+
+    assert {n: (d["x"], d["y"]) for n, d in empty_graph.nodes(data=True) if n != "E"} == before
+    e, a = empty_graph.nodes["E"], empty_graph.nodes["A"]
+    spread = max(np.hypot(x - before["A"][0], y - before["A"][1]) for x, y in before.values())
+    assert np.hypot(e["x"] - a["x"], e["y"] - a["y"]) < max(spread, 300)
+
+def test_place_nodes_without_neighbors():
+    """測試：與既有角色無關的新角色放在外圍，且不影響其他角色"""
+    G = nx.DiGraph()
+    G.add_node("A", x=0.0, y=0.0)
+    G.add_node("B", x=150.0, y=0.0)
+    G.add_edge("A", "B")
+    G.add_node("C")
+    pos = place_nodes(G, ["C"], seed=0)
+    assert list(pos) == ["C"]
+    assert np.hypot(*pos["C"]) > 100
+
+def test_layout_index_tracks_positions_incrementally(manager, empty_graph):
+    """測試：格點索引隨編輯更新座標、重心與未定位角色，只回傳新角色附近格子中的角色"""
+    for i in range(20):
+        for j in range(20):
+            empty_graph.add_node(f"P{i}_{j}", x=i * 1000.0, y=j * 1000.0)
+    manager.add_character(empty_graph, "N", "")
+    index = manager.layout
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    assert index.missing == {"N"} and len(index) == 400
+    assert tuple(index.centroid()) == (9500.0, 9500.0)
+    assert index.near([(10.0, -20.0)]) == {"P0_0"}
+
+    manager.add_relationship(empty_graph, "N", "P0_0", "鄰居")
+    assert manager.ensure_layout(empty_graph) is True
+    assert index.missing == set() and len(index) == 401
+    n = empty_graph.nodes["N"]
+    assert np.hypot(n["x"], n["y"]) < 1000
+    assert index.position("N") == (n["x"], n["y"])
+
+    manager.delete_character(empty_graph, "P0_0")
+    assert "P0_0" not in index.near([(0.0, 0.0)])
+    assert index.position("P0_0") is None and len(index) == 400
+
+# --- 細節層級 (LOD) ---
+
+def _two_cliques(manager, graph):
+    for group in ("ab", "xy"):
+        names = [f"{group}{i}" for i in range(5)]
+        edges = [{"source": u, "target": v} for u in names for v in names if u < v]
+        manager.batch_import(graph, [], edges)
+    manager.batch_import(graph, [], [{"source": "ab0", "target": "xy0"}, {"source": "ab1", "target": "xy1"}])
+
+def test_cluster_collapse_rolls_up_edges(manager, empty_graph):
+    """測試：超過門檻時社群收合成群組節點，群組間的關係數量彙總，並可展開單一群組"""
+    _two_cliques(manager, empty_graph)
+    index = ClusterIndex(threshold=5)
+    manager.subscribe(index.apply_change)
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+
+    clusters = index.clusters()
+    assert [size for *_, size in clusters] == [5, 5]
+    ab = next(cid for cid, *_ in clusters if index.membership()["ab0"] == cid)
+    xy = next(cid for cid, *_ in clusters if cid != ab)
+
+    view = index.collapse(empty_graph)
+    assert set(view.nodes) == {cluster_node(ab), cluster_node(xy)}
+    assert view[cluster_node(ab)][cluster_node(xy)]["value"] == 2
+    assert index.collapse(empty_graph) is view
+
+    opened = index.collapse(empty_graph, expanded=[ab])
+    assert {f"ab{i}" for i in range(5)} <= set(opened.nodes)
+    assert opened["ab0"][cluster_node(xy)]["value"] == 1
+    assert opened["ab0"]["ab1"] == empty_graph["ab0"]["ab1"]
+
+    # 新角色直接歸入鄰居所在的群組，不重新偵測
+    manager.batch_import(empty_graph, [], [{"source": "xy9", "target": "xy0"}])
+    assert index.membership()["xy9"] == xy
+    assert index.collapse(empty_graph).nodes[cluster_node(xy)]["value"] == 6
+
+def test_cluster_isolated_nodes_match_full_recompute(manager, empty_graph):
+    """測試：增量加入的孤立角色與重新偵測一樣收進同一個群組，不會各自成群"""
+    _two_cliques(manager, empty_graph)
+    manager.add_character(empty_graph, "路人甲", "")
+    index = ClusterIndex(threshold=5)
+    manager.subscribe(index.apply_change)
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    index.membership()
+    for name in ("路人乙", "路人丙", "路人丁"):
+        manager.add_character(empty_graph, name, "")
+
+    def groups(ix):
+        found = defaultdict(set)
+        for n, cid in ix.membership().items():
+            found[cid].add(n)
+        return {frozenset(members) for members in found.values()}
+
+    full = ClusterIndex(threshold=5)
+    full.sync(empty_graph, manager.graph_version(empty_graph))
+    assert groups(index) == groups(full)
+    assert [size for *_, size in index.clusters()] == [5, 5, 4]
+
+def test_cluster_node_names_avoid_character_names(manager, empty_graph):
+    """測試：角色剛好叫做「cluster:0」時，群組代表節點改用不衝突的名稱"""
+    _two_cliques(manager, empty_graph)
+    manager.batch_import(empty_graph, [], [{"source": "cluster:0", "target": "ab0"}, {"source": "cluster:1", "target": "xy0"}])
+    index = ClusterIndex(threshold=5)
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    names = [name for _, name, *_ in index.clusters()]
+    assert len(names) == 2 and not set(names) & set(empty_graph.nodes)
+    view = index.collapse(empty_graph)
+    assert set(view.nodes) == set(names)
+    assert sum(d["value"] for _, d in view.nodes(data=True)) == 12
+
+def test_cluster_collapse_below_threshold_is_noop(manager, empty_graph):
+    """測試：未超過門檻時直接回傳原圖"""
+    _two_cliques(manager, empty_graph)
+    index = ClusterIndex(threshold=100)
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+    assert index.collapse(empty_graph) is empty_graph
+
+# --- 圖表 HTML 快取 ---
+
+def test_graph_html_is_cached_per_view(manager, empty_graph, monkeypatch):
+    """測試：同一個圖與 key 只產生一次 HTML，不同的圖即使 key 相同也會重新產生"""
+    manager.add_character(empty_graph, "A", "")
+    built = []
+    original = visualization.read_asset
+    monkeypatch.setattr(visualization, "read_asset", lambda kind: built.append(kind) or original(kind))
+
+    key = (manager.graph_version(empty_graph), 1)
+    html = visualization.build_graph_html(empty_graph, cache_key=key)
+    assert visualization.build_graph_html(empty_graph, cache_key=key) is html
+    assert len(built) == 2 and '"A"' in html
+
+    other = nx.DiGraph()
+    other.add_node("B")
+    assert '"B"' in visualization.build_graph_html(other, cache_key=key)
+    assert len(built) == 4
+
+def test_graph_view_sends_only_diffs():
+    """測試：圖表元件第一次收到完整資料，之後只收到新增、刪除與變更的部分"""
+    G = nx.DiGraph()
+    G.add_node("A", title="a", x=0.0, y=0.0)
+    G.add_node("B", title="b", x=1.0, y=0.0)
+    G.add_edge("A", "B", label="x", timeline={"1": {"label": "x"}})
+    view = visualization.GraphView()
+
+    first = view.update(G)
+    assert first["base"] is None and len(first["nodes"]) == 2
+    assert "timeline" not in first["edges"][0]
+    assert view.update(G) is first
+
+    H = G.copy()
+    H.nodes["A"]["title"] = "changed"
+    H.remove_node("B")
+    H.add_node("C", x=2.0, y=2.0)
+    H.add_edge("A", "C", label="y")
+    diff = view.update(H)
+    assert diff["base"] == first["revision"] and diff["revision"] == first["revision"] + 1
+    assert {n["id"] for n in diff["nodes"]} == {"A", "C"}
+    assert diff["removed_nodes"] == ["B"]
+    assert diff["removed_edges"] == [json.dumps(["A", "B"])]
+    assert [e["to"] for e in diff["edges"]] == ["C"]
+
+    # 瀏覽器端對不上版本時改送完整資料
+    full = view.update(H, {"resync": diff["revision"]})
+    assert full["base"] is None and {n["id"] for n in full["nodes"]} == {"A", "C"}
+
+def test_graph_view_clears_removed_fields():
+    """測試：聚焦或路徑標示取消後，上次送出、這次已移除的欄位以 null 送出，瀏覽器端才不會留著舊的顏色與粗細"""
+    G = nx.DiGraph()
+    G.add_node("A", x=0.0, y=0.0)
+    G.add_node("B", x=1.0, y=0.0)
+    G.add_edge("A", "B", label="x")
+    view = visualization.GraphView()
+    view.update(G)
+
+    H = G.copy()
+    H.nodes["A"].update(color="#FFC107", size=30)
+    H["A"]["B"]["width"] = 6
+    view.update(H)
+
+    diff = view.update(G.copy())
+    assert diff["nodes"] == [{"id": "A", "label": "A", "x": 0.0, "y": 0.0, "color": None, "size": None}]
+    assert diff["edges"][0]["width"] is None and diff["edges"][0]["label"] == "x"
+    assert view.update(G.copy())["nodes"] == diff["nodes"]  # 沒有新變更時沿用上次的參數
+
+def test_exported_html_is_offline(tmp_path):
+    """測試：匯出的 HTML 內嵌 vis-network 與資料，不引用任何外部資源"""
+    G = nx.DiGraph()
+    G.add_node("A", title="</script><b>x</b>", x=0.0, y=0.0)
+    G.add_edge("A", "A", label="__DATA__")
+    html = visualization.build_graph_html(G)
+    assert "<script src=" not in html and "<link" not in html
+    assert "vis-network" in html and "</script><b>" not in html
+    assert html.count("__DATA__") == 1
+
+def test_publish_assets_by_content_hash(tmp_path):
+    """測試：前端元件的 vis-network 檔名帶內容雜湊，已存在時不重寫並清除舊檔"""
+    (tmp_path / "vis-network.old.js").write_text("old")
+    names = publish(str(tmp_path))
+    assert sorted(os.listdir(tmp_path)) == sorted(names.values())
+    path = tmp_path / names["js"]
+    mtime = path.stat().st_mtime_ns
+    assert publish(str(tmp_path)) == names
+    assert path.stat().st_mtime_ns == mtime
+
+# --- AI 萃取 (以本機的 OpenAI 相容假伺服器測試) ---
+
+@pytest.fixture
+def llm_server():
+    """啟動一個 OpenAI 相容的假伺服器：文本中的英文單字視為角色，相鄰的單字之間建立關係"""
+    stats = {"requests": 0, "active": 0, "max_active": 0, "prompts": [], "failures": {"FLAKY": 0, "LIMIT": 0}}
+    lock = threading.Lock()
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            text = body["messages"][-1]["content"]
+            with lock:
+                stats["requests"] += 1
+                stats["active"] += 1
+                stats["max_active"] = max(stats["max_active"], stats["active"])
+                stats["prompts"].append(body["messages"])
+            time.sleep(0.05)
+            with lock:
+                stats["active"] -= 1
+
+            words = re.findall(r"[A-Z][a-z]+", text)
+            content = json.dumps({
+                "nodes": [{"id": w, "title": f"{w} 的簡介"} for w in words],
+                "edges": [{"source": a, "target": b, "label": "認識", "color": "#9E9E9E"} for a, b in zip(words, words[1:])],
+            }, ensure_ascii=False)
+            # FLAKY：前兩次回 503；LIMIT：第一次回 429 並附 Retry-After
+            with lock:
+                marker = next((m for m in ("FLAKY", "LIMIT") if m in text), None)
+                flaky = marker is not None and stats["failures"][marker] < (2 if marker == "FLAKY" else 1)
+                if flaky:
+                    stats["failures"][marker] += 1
+            if "FAIL" in text:
+                self.send_response(400)
+                payload = {"error": {"message": "bad chunk", "type": "invalid_request_error"}}
+            elif flaky:
+                self.send_response(429 if "LIMIT" in text else 503)
+                if "LIMIT" in text:
+                    self.send_header("Retry-After", "0")
+                payload = {"error": {"message": "try again", "type": "server_error"}}
+            elif body.get("stream"):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for i in range(0, len(content), 7):
+                    event = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": body["model"],
+                             "choices": [{"index": 0, "delta": {"content": content[i:i + 7]}, "finish_reason": None}]}
+                    self.wfile.write(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+                return
+            else:
+                self.send_response(200)
+                payload = {
+                    "id": "stub", "object": "chat.completion", "created": 0, "model": body["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                }
+            data = json.dumps(payload).encode("utf-8")
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/v1", stats
+    server.shutdown()
+    server.server_close()
+
+def test_split_text_overlaps_at_sentence_breaks():
+    """測試：長文依句子切段，相鄰段落有重疊且涵蓋全文"""
+    text = "".join(f"第{i}句話。" for i in range(200))
+    chunks = split_text(text, chunk_size=100, overlap=20)
+    assert len(chunks) > 1
+    assert all(len(c) <= 100 for c in chunks)
+    assert all(c.endswith("。") for c in chunks[:-1])
+    assert chunks[0] + "".join(c[c.index(p[-10:]) + 10:] for p, c in zip(chunks, chunks[1:])) == text
+
+def test_merge_results_deduplicates():
+    """測試：各段落的同名角色與相同關係只保留一筆，空白欄位由其他段落補上"""
+    nodes, edges = merge_results([
+        ([{"id": "A", "title": ""}], [{"source": "A", "target": "B", "label": "友"}]),
+        ([{"id": "A", "title": "主角"}, {"name": "B"}], [{"source": "A", "target": "B", "label": "敵", "color": "#F44336"}]),
+    ])
+    assert nodes == [{"id": "A", "title": "主角"}, {"name": "B"}]
+    assert edges == [{"source": "A", "target": "B", "label": "友", "color": "#F44336"}]
+
+def test_chunked_extraction_against_stub_server(manager, llm_server, tmp_path):
+    """測試：長文分段並行送出 (不超過並行上限)，結果合併去重"""
+    url, stats = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path))
+    text = "。".join(f"Alice meets Bob {'x' * 40} and Carol" for _ in range(20))
+    nodes, edges, error = manager.process_text_with_ai(text, "sk-test", base_url=url, chunk_size=200, overlap=50, max_workers=3)
+    assert error is None
+    assert stats["requests"] > 3 and stats["max_active"] <= 3
+    assert sorted(n["id"] for n in nodes) == ["Alice", "Bob", "Carol"]
+    assert {(e["source"], e["target"]) for e in edges} == {("Alice", "Bob"), ("Bob", "Carol"), ("Carol", "Alice")}
+
+def test_chunked_extraction_rate_limit_and_partial_failure(manager, llm_server, tmp_path):
+    """測試：每秒請求數受限；部分段落失敗時仍回傳其他段落的結果"""
+    url, stats = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path))
+    text = "Alice and Bob.\n\n" + "x" * 80 + "\n\nFAIL here.\n\n" + "y" * 80 + "\n\nCarol and Dave."
+    started = time.monotonic()
+    nodes, edges, error = manager.process_text_with_ai(text, "sk-test", base_url=url, chunk_size=100, overlap=0, rate_limit=10)
+    assert time.monotonic() - started >= (stats["requests"] - 1) / 10
+    assert {"Alice", "Carol"} <= {n["id"] for n in nodes}
+    assert error is not None and "失敗" in error
+
+def test_llm_cache_hits_and_eviction(tmp_path):
+    """測試：以 (模型, 提示, 段落) 定址；超過容量時淘汰最久未使用的項目，重新開啟後仍保留"""
+    cache = LLMCache(str(tmp_path), max_entries=2)
+    cache.put("m", "p", "one", {"nodes": [1], "edges": []})
+    cache.put("m", "p", "two", {"nodes": [2], "edges": []})
+    assert cache.get("m", "p", "one") == {"nodes": [1], "edges": []}
+    assert cache.get("other", "p", "one") is None
+    assert cache.get("m", "other", "one") is None
+    cache.put("m", "p", "three", {"nodes": [3], "edges": []})
+
+    assert cache.get("m", "p", "two") is None
+    assert cache.stats()["entries"] == 2
+    assert cache.hits == 1 and cache.misses == 3 and cache.hit_rate == 0.25
+
+    reopened = LLMCache(str(tmp_path), max_bytes=10 ** 6)
+    assert reopened.get("m", "p", "three") == {"nodes": [3], "edges": []}
+    assert reopened.stats()["bytes"] > 0
+
+def test_repeated_extraction_uses_disk_cache(manager, llm_server, tmp_path):
+    """測試：相同文本再次分析時直接取自快取，不再呼叫 API"""
+    url, stats = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path))
+    text = "。".join(f"Alice meets Bob {'x' * 40}" for _ in range(10))
+    first = manager.process_text_with_ai(text, "sk-test", base_url=url, chunk_size=200)
+    requests = stats["requests"]
+    second = manager.process_text_with_ai(text, "sk-test", base_url=url, chunk_size=200)
+    assert second == first
+    assert stats["requests"] == requests
+    assert manager.llm_cache.hit_rate == 0.5
+
+def test_llm_clients_are_pooled():
+    """測試：相同的 (api_key, base_url) 共用同一個用戶端"""
+    a = llm_client.get_client("sk-pool", "http://127.0.0.1:1/v1")
+    assert llm_client.get_client("sk-pool", "http://127.0.0.1:1/v1") is a
+    assert llm_client.get_client("sk-pool", "http://127.0.0.1:2/v1") is not a
+
+def test_llm_retry_with_backoff(llm_server):
+    """測試：503 / 429 會退避重試 (有 Retry-After 時依其等待)，400 不重試"""
+    url, stats = llm_server
+    client = llm_client.get_client("sk-test", url)
+    delays = []
+    record = llm_client.CompletionStats()
+    content = llm_client.with_retry(lambda: llm_client.complete(client, "m", [{"role": "user", "content": "FLAKY Alice"}], retries=0),
+                                    base_delay=0.01, sleep=delays.append)
+    assert json.loads(content)["nodes"][0]["id"] == "Alice"
+    assert len(delays) == 2 and delays[1] > delays[0] * 0.5
+
+    llm_client.complete(client, "m", [{"role": "user", "content": "LIMIT Bob"}], stats=record, base_delay=0.01)
+    assert record.records[-1]["attempts"] == 2
+
+    requests = stats["requests"]
+    with pytest.raises(Exception):
+        llm_client.complete(client, "m", [{"role": "user", "content": "FAIL"}], base_delay=0.01)
+    assert stats["requests"] == requests + 1
+
+def test_streamed_extraction_records_latency(manager, llm_server, tmp_path):
+    """測試：串流模式的結果與一般模式相同，並記錄第一段內容的延遲與產出速度"""
+    url, _ = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path))
+    nodes, edges, error = manager.process_text_with_ai("Alice meets Bob", "sk-test", base_url=url, stream=True)
+    assert error is None and [n["id"] for n in nodes] == ["Alice", "Bob"]
+    record = manager.llm_stats.records[-1]
+    assert 0 < record["latency"] <= record["duration"]
+    assert manager.llm_stats.summary()["chars_per_second"] > 0
+
+def test_partial_json_items_yield_completed_objects():
+    """測試：逐段餵入 JSON，每個物件一完整就取出，字串內的括號與跳脫引號不影響解析"""
+    raw = json.dumps({"nodes": [{"id": 'A"}{', "title": "x [y]"}, {"id": "B"}],
+                      "edges": [{"source": "A", "target": "B", "label": "友"}]}, ensure_ascii=False)
+    for step in (1, 3, 7, len(raw)):
+        parser = PartialJSONItems()
+        items = []
+        for i in range(0, len(raw), step):
+            items.extend(parser.feed(raw[i:i + step]))
+        assert [k for k, _ in items] == ["nodes", "nodes", "edges"]
+        assert items[0][1]["id"] == 'A"}{' and items[2][1]["label"] == "友"
+
+def test_stream_text_with_ai_yields_items_progressively(manager, llm_server, tmp_path):
+    """測試：串流萃取逐筆產生不重複的角色與關係，結果會寫入快取，失敗的段落以 error 事件回報"""
+    url, stats = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path))
+    text = "Alice meets Bob. " * 3 + "\n" + "Bob greets Carol. " * 3 + "\nFAIL here."
+    events = list(manager.stream_text_with_ai(text, "sk-test", base_url=url, chunk_size=60, overlap=10))
+    names = [item["id"] for kind, item in events if kind == "nodes"]
+    assert len(names) == len(set(names)) and {"Alice", "Bob", "Carol"} <= set(names)
+    assert ("Bob", "Carol") in {(e["source"], e["target"]) for kind, e in events if kind == "edges"}
+    assert any(kind == "error" for kind, _ in events)
+
+    requests = stats["requests"]
+    again = list(manager.stream_text_with_ai("Alice meets Bob.", "sk-test", base_url=url))
+    assert stats["requests"] == requests + 1
+    assert list(manager.stream_text_with_ai("Alice meets Bob.", "sk-test", base_url=url)) == again
+    assert stats["requests"] == requests + 1
+
+def test_iter_extract_merges_like_batch_and_skips_unhashable_names():
+    """測試：串流萃取讀完後與 merge_results 結果相同 (後面段落補上缺少的欄位)，名稱為串列或物件的項目直接略過"""
+    text = "Alice " * 20 + "\n" + "Bob " * 20
+    chunks = split_text(text, chunk_size=60, overlap=0)
+    payloads = [
+        ([{"id": "Alice", "title": ""}, {"id": ["Bob"]}, {"name": {"first": "Carol"}}, "Dave"],
+         [{"source": "Alice", "target": "Bob", "label": ""}, {"source": ["Alice"], "target": "Bob"}]),
+        ([{"id": "Alice", "title": "主角"}, {"id": "Bob"}],
+         [{"source": "Alice", "target": "Bob", "label": "朋友", "color": "#4CAF50"}]),
+    ]
+    results = {chunk: payloads[min(i, 1)] for i, chunk in enumerate(chunks)}
+
+    class FixedCache:
+        def get(self, model, prompt, chunk):
+            nodes, edges = results[chunk]
+            return {"nodes": nodes, "edges": edges}
+
+    events = list(iter_extract(None, "test", text, chunk_size=60, overlap=0, cache=FixedCache()))
+    nodes = [item for kind, item in events if kind == "nodes"]
+    edges = [item for kind, item in events if kind == "edges"]
+    expected_nodes, expected_edges = merge_results(results[chunk] for chunk in chunks)
+    assert sorted(nodes, key=lambda n: n["id"]) == sorted(expected_nodes, key=lambda n: n["id"])
+    assert edges == expected_edges == [{"source": "Alice", "target": "Bob", "label": "朋友", "color": "#4CAF50"}]
+    assert {n["id"]: n.get("title") for n in nodes} == {"Alice": "主角", "Bob": None}
+
+def test_known_entities_prompt_lists_mentioned_characters(manager, empty_graph):
+    """測試：只列出段落中提到的既有角色與他們之間的關係，且不超過 token 預算"""
+    for name in ("哈利", "妙麗", "榮恩", "佛地魔", "X"):
+        manager.add_character(empty_graph, name, "")
+    manager.add_relationship(empty_graph, "哈利", "妙麗", "朋友")
+    manager.add_relationship(empty_graph, "哈利", "佛地魔", "敵人")
+    known = KnownEntities(empty_graph)
+    chunk = "妙麗和哈利一起去找X。"
+    assert known.find(chunk) == ["妙麗", "哈利", "X"]
+    prompt = known.prompt(chunk)
+    assert "妙麗、哈利、X" in prompt and "哈利→妙麗：朋友" in prompt
+    assert "榮恩" not in prompt and "佛地魔" not in prompt
+    assert known.prompt("沒有任何角色") == ""
+    assert estimate_tokens(KnownEntities(empty_graph, max_tokens=100).prompt(chunk)) <= 100
+
+def test_token_budget_sets_chunk_size():
+    """測試：中文約一字一 token、英文約四字元一 token，依預算換算每段字數"""
+    assert estimate_tokens("哈利波特") == 4
+    assert estimate_tokens("a" * 40) == 10
+    assert chunk_size_for_budget("哈利" * 100, 8000, reserved_tokens=3000) == 5000
+    assert chunk_size_for_budget("ab" * 100, 8000, reserved_tokens=3000) == 20000
+
+def test_extraction_sends_known_entities(manager, empty_graph, llm_server, tmp_path):
+    """測試：傳入 graph 時，提示中附上段落提到的既有角色，並依 token 預算決定段落數"""
+    url, stats = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path))
+    manager.add_character(empty_graph, "Alice", "")
+    manager.add_character(empty_graph, "Bob", "")
+    manager.add_relationship(empty_graph, "Alice", "Bob", "朋友")
+    nodes, edges, error = manager.process_text_with_ai("Alice meets Carol", "sk-test", base_url=url, graph=empty_graph)
+    assert error is None
+    system = stats["prompts"][-1][0]["content"]
+    assert "Alice" in system and "Bob" not in system
+
+    text = "".join(f"Alice meets Bob {i}. " for i in range(2000))
+    requests = stats["requests"]
+    manager.process_text_with_ai(text, "sk-test", base_url=url, graph=empty_graph, token_budget=5000)
+    small = stats["requests"] - requests
+    manager.llm_cache.clear()
+    requests = stats["requests"]
+    manager.process_text_with_ai(text, "sk-test", base_url=url, graph=empty_graph, token_budget=20000)
+    assert stats["requests"] - requests < small
+
+def test_entity_index_candidates_and_resolve(tmp_path):
+    """測試：n-gram 索引找出相似名稱，別名表與正規化名稱可解析到既有角色，簡稱只列為候選，常見 n-gram 不參與比對"""
+    graph = nx.DiGraph()
+    graph.add_nodes_from(["哈利波特", "妙麗", "Ron Weasley", "哈利法克斯"])
+    aliases = AliasTable(str(tmp_path / "aliases.json"))
+    aliases.add("Harry Potter", "哈利波特")
+    index = EntityIndex(aliases)
+    index.sync(graph, 0)
+    assert index.candidates("哈利")[0][1] >= 0.5
+    assert {n for n, _ in index.candidates("哈利")} == {"哈利波特", "哈利法克斯"}
+    assert index.resolve("哈利") is None  # 兩個名稱都包含「哈利」，不自動合併
+    assert index.resolve("波特") is None  # 只是包含在既有名稱中，列為候選而不自動合併
+    assert index.candidates("波特")[0][0] == "哈利波特"
+    assert index.resolve("harry  potter") == "哈利波特"
+    assert index.resolve("ron weasley") == "Ron Weasley"
+    assert index.resolve("榮恩") is None
+    assert AliasTable(str(tmp_path / "aliases.json")).get("HARRY POTTER") == "哈利波特"
+
+    crowded = EntityIndex(max_postings=1)
+    crowded.sync(graph, 0)
+    assert crowded.candidates("哈利") == []
+
+def test_batch_import_resolves_aliases_and_normalized_names(manager, empty_graph, tmp_path):
+    """測試：匯入時別名「Harry Potter」與大小寫不同的「哈利波特 」對應到既有角色，簡稱「波特」則成為新角色"""
+    manager.aliases = manager.entities.aliases = AliasTable(str(tmp_path / "aliases.json"))
+    manager.aliases.add("Harry Potter", "哈利波特")
+    manager.add_character(empty_graph, "哈利波特", "主角")
+    manager.add_character(empty_graph, "榮恩", "好友")
+    manager.batch_import(empty_graph, [{"id": "波特", "title": "重複"}, {"id": "妙麗", "title": "新角色"}],
+                         [{"source": "Harry Potter", "target": "妙麗", "label": "朋友"},
+                          {"source": " 哈利波特 ", "target": "harry potter", "label": "自己"}], chapter=2)
+    assert set(empty_graph.nodes) == {"哈利波特", "榮恩", "妙麗", "波特"}
+    assert empty_graph.has_edge("哈利波特", "妙麗")
+    # 兩端解析到同一個角色時與原本一樣匯入為自我關係，不會被丟掉
+    assert empty_graph["哈利波特"]["哈利波特"]["label"] == "自己"
+    assert empty_graph.number_of_edges() == 2
+    assert "哈利波特" in [n for n, _ in manager.entities.candidates("波特")]
+
+def test_batch_import_keeps_names_containing_existing_names(manager, empty_graph):
+    """測試：「哈利的媽媽」、「張三豐」不會因包含既有名稱而被併入「哈利」、「張三」，關係也不會被丟掉"""
+    manager.add_character(empty_graph, "哈利", "主角")
+    manager.add_character(empty_graph, "張三", "路人")
+    manager.batch_import(empty_graph, [{"id": "哈利的媽媽", "title": "母親"}],
+                         [{"source": "哈利的媽媽", "target": "哈利", "label": "母子"},
+                          {"source": "張三豐", "target": "張三", "label": "師徒"}])
+    assert set(empty_graph.nodes) == {"哈利", "張三", "哈利的媽媽", "張三豐"}
+    assert empty_graph["哈利的媽媽"]["哈利"]["label"] == "母子"
+    assert empty_graph["張三豐"]["張三"]["label"] == "師徒"
+    assert empty_graph.nodes["哈利的媽媽"]["title"] == "母親"
+
+def test_merge_characters_moves_edges_and_timelines(manager, empty_graph, tmp_path):
+    """測試：合併角色時關係改接、時間軸合併、來源記入別名表，且一步即可復原"""
+    manager.aliases = manager.entities.aliases = AliasTable(str(tmp_path / "aliases.json"))
+    for name in ("哈利波特", "哈利", "Harry", "榮恩", "妙麗"):
+        manager.add_character(empty_graph, name, "")
+    manager.edit_character_description(empty_graph, "哈利", "存活的男孩")
+    manager.add_relationship(empty_graph, "哈利波特", "榮恩", "同學", chapter=1)
+    manager.add_relationship(empty_graph, "哈利", "榮恩", "摯友", chapter=3)
+    manager.add_relationship(empty_graph, "妙麗", "Harry", "朋友", chapter=2)
+    manager.add_relationship(empty_graph, "哈利", "Harry", "同一人")
+    before = nx.node_link_graph(nx.node_link_data(empty_graph), directed=True)
+
+    success, msg = manager.merge_characters(empty_graph, "哈利波特", ["哈利", "Harry"])
+    assert success
+    assert set(empty_graph.nodes) == {"哈利波特", "榮恩", "妙麗"}
+    assert empty_graph.nodes["哈利波特"]["title"] == "存活的男孩"
+    edge = empty_graph["哈利波特"]["榮恩"]
+    assert edge["label"] == "摯友" and set(edge["timeline"]) == {"1", "3"}
+    assert empty_graph.has_edge("妙麗", "哈利波特") and not empty_graph.has_edge("哈利波特", "哈利波特")
+    assert manager.aliases.get("Harry") == "哈利波特"
+    manager.entities.sync(empty_graph, manager.graph_version(empty_graph))
+    assert manager.entities.resolve("哈利") == "哈利波特"
+
+    manager.undo()
+    assert dict(empty_graph.nodes(data=True)) == dict(before.nodes(data=True))
+    assert sorted(empty_graph.edges(data=True), key=str) == sorted(before.edges(data=True), key=str)
+    # 別名也隨合併一起復原，「哈利」不再被解析到「哈利波特」
+    assert manager.aliases.get("Harry") is None and manager.aliases.items() == []
+    manager.entities.sync(empty_graph, manager.graph_version(empty_graph))
+    assert manager.entities.resolve("哈利") == "哈利"
+    assert AliasTable(str(tmp_path / "aliases.json")).items() == []
+
+    manager.redo()
+    assert manager.aliases.get("Harry") == "哈利波特" and "哈利" not in empty_graph
+
+def test_transaction_records_single_undo_step(manager, empty_graph):
+    """測試：交易中的多個操作只存檔、通知一次，並合併為一個 Undo 步驟"""
+    manager.add_character(empty_graph, "A", "")
+    changes = []
+    manager.subscribe(changes.append)
+    steps = len(manager.history.steps)
+    with manager.transaction(empty_graph):
+        manager.add_character(empty_graph, "B", "")
+        with manager.transaction(empty_graph):
+            manager.add_relationship(empty_graph, "A", "B", "朋友")
+        manager.edit_character_description(empty_graph, "A", "改名前")
+        assert changes == []
+    assert len(changes) == 1 and changes[0].nodes == {"A", "B"}
+    assert len(manager.history.steps) == steps + 1
+
+    manager.undo()
+    assert set(empty_graph.nodes) == {"A"} and empty_graph.nodes["A"]["title"] == ""
+
+def test_transaction_rolls_back_on_exception(manager, empty_graph):
+    """測試：交易中發生例外時，已做的變更全部還原且不留下歷史紀錄"""
+    manager.add_character(empty_graph, "A", "舊描述")
+    steps = len(manager.history.steps)
+    with pytest.raises(RuntimeError):
+        with manager.transaction(empty_graph):
+            manager.add_character(empty_graph, "B", "")
+            manager.add_relationship(empty_graph, "A", "B", "朋友")
+            manager.edit_character_description(empty_graph, "A", "新描述")
+            raise RuntimeError("中途失敗")
+    assert set(empty_graph.nodes) == {"A"} and empty_graph.nodes["A"]["title"] == "舊描述"
+    assert len(manager.history.steps) == steps
+    assert manager.batch_import(empty_graph, [{"id": "B"}], []).startswith("已處理 1 個新實體")
+
+def test_batch_import_is_one_undo_step(manager, empty_graph):
+    """測試：批次匯入 (包含更新既有關係) 只留下一個 Undo 步驟，復原後回到匯入前"""
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "同學")
+    steps = len(manager.history.steps)
+    nodes = [{"id": f"N{i}", "title": ""} for i in range(50)]
+    edges = [{"source": "A", "target": f"N{i}", "label": "認識"} for i in range(50)]
+    edges += [{"source": "A", "target": "B", "label": "摯友"}, {"source": "A", "target": "Z", "label": "?"}]
+    manager.batch_import(empty_graph, nodes, edges, chapter=2)
+    assert empty_graph.number_of_nodes() == 53 and empty_graph.nodes["Z"]["title"] == "Auto"
+    assert empty_graph["A"]["B"]["label"] == "摯友" and set(empty_graph["A"]["B"]["timeline"]) == {"1", "2"}
+    assert len(manager.history.steps) == steps + 1
+
+    manager.undo()
+    assert set(empty_graph.nodes) == {"A", "B"}
+    assert empty_graph["A"]["B"]["label"] == "同學" and set(empty_graph["A"]["B"]["timeline"]) == {"1"}
+
+def test_batch_import_rolls_back_updated_edges_on_malformed_item(manager, empty_graph):
+    """測試：批次匯入中途遇到格式錯誤的關係時，已修改的既有關係也一併還原"""
+    manager.add_character(empty_graph, "A", "")
+    manager.add_character(empty_graph, "B", "")
+    manager.add_relationship(empty_graph, "A", "B", "同學")
+    before = json.loads(json.dumps(empty_graph["A"]["B"]))
+    steps = len(manager.history.steps)
+    with pytest.raises(AttributeError):
+        manager.batch_import(empty_graph, [{"id": "C"}],
+                             [{"source": "A", "target": "B", "label": "摯友"}, "不是關係"], chapter=2)
+    assert set(empty_graph.nodes) == {"A", "B"}
+    assert dict(empty_graph["A"]["B"]) == before
+    assert len(manager.history.steps) == steps
+
+def test_iter_chapters_splits_lazily():
+    """測試：依章節標題切開 (序言併入第一章，不另佔編號)，且逐行讀取不需先載入整份文字"""
+    lines = iter(["序言內容\n", "第一章 開始\n", "Alice meets Bob.\n", "\n", "第十二章\n", "第三章節的說明不是標題\n",
+                  "Chapter 3: End\n", "Bob leaves.\n"])
+    chapters = iter_chapters(lines, start=5)
+    assert next(chapters) == (5, "第一章 開始", "序言內容\nAlice meets Bob.")
+    assert next(lines) == "第三章節的說明不是標題\n"  # 只讀到產生第一章所需的行
+    assert list(chapters) == [(6, "第十二章", ""), (7, "Chapter 3: End", "Bob leaves.")]
+    assert list(iter_chapters(["只有內文\n"])) == [(1, "", "只有內文")]
+    assert count_chapters(["第一章\n", "x\n", "CHAPTER IV\n"]) == 2
+
+def test_ingest_book_resumes_from_checkpoint(manager, empty_graph, llm_server, tmp_path):
+    """測試：逐章匯入並記錄檢查點，中斷後重新執行只處理尚未完成的章節"""
+    url, stats = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path / "cache"))
+    manager.checkpoint = IngestCheckpoint(str(tmp_path / "checkpoint.json"))
+    book = tmp_path / "book.txt"
+    book.write_text("第一章\nAlice meets Bob.\n第二章\nBob greets Carol.\n第三章\nFAIL Dave.\n", encoding="utf-8")
+
+    with open_text(str(book)) as f:
+        events = list(manager.ingest_book(empty_graph, f, "sk-test", source="book.txt", base_url=url))
+    assert [e["status"] for e in events] == ["done", "done", "failed"]
+    assert empty_graph["Bob"]["Carol"]["chapter"] == 2 and empty_graph.nodes["Alice"]["chapter"] == 1
+
+    book.write_text("第一章\nAlice meets Bob.\n第二章\nBob greets Carol.\n第三章\nCarol meets Dave.\n", encoding="utf-8")
+    requests = stats["requests"]
+    resumed = IngestCheckpoint(str(tmp_path / "checkpoint.json"))
+    manager.checkpoint = resumed
+    with open_text(str(book)) as f:
+        events = list(manager.ingest_book(empty_graph, f, "sk-test", source="book.txt", base_url=url))
+    assert [e["status"] for e in events] == ["skipped", "skipped", "done"]
+    assert stats["requests"] == requests + 1
+    assert empty_graph["Carol"]["Dave"]["chapter"] == 3
+    assert resumed.completed(resumed.key("book.txt")) == 3
+
+def test_ingest_book_reingests_after_reset(manager, empty_graph, llm_server, tmp_path):
+    """測試：重置圖、換成新的圖、復原或手動清除後，同一本書會重新匯入而不是全部略過"""
+    url, stats = llm_server
+    manager.llm_cache = LLMCache(str(tmp_path / "cache"))
+    manager.checkpoint = IngestCheckpoint(str(tmp_path / "checkpoint.json"))
+    book = ["第一章\n", "Alice meets Bob.\n", "第二章\n", "Bob greets Carol.\n"]
+
+    def ingest(graph, start=1):
+        return [e["status"] for e in manager.ingest_book(graph, iter(book), "sk-test", source="book.txt",
+                                                           start=start, base_url=url)]
+
+    assert ingest(empty_graph) == ["done", "done"]
+    assert ingest(empty_graph) == ["skipped", "skipped"]
+    assert ingest(empty_graph, start=3) == ["done", "done"]  # 章節編號不同，視為另一次匯入
+
+    manager.reset_graph(empty_graph)
+    assert ingest(empty_graph) == ["done", "done"] and empty_graph.has_edge("Bob", "Carol")
+
+    fresh = nx.DiGraph()
+    assert ingest(fresh) == ["done", "done"] and fresh.has_edge("Alice", "Bob")
+
+    manager.undo()
+    assert ingest(fresh) == ["done"] * 2
+
+    manager.reset_ingest("book.txt")
+    assert ingest(fresh) == ["done", "done"]
+
+def test_search_index_ranks_and_paginates(manager, empty_graph):
+    """測試：以 bigram 索引搜尋名稱、簡介與關係標籤，支援子字串與開頭比對、排序與分頁"""
+    manager.add_character(empty_graph, "哈利波特", "存活下來的男孩")
+    manager.add_character(empty_graph, "哈利", "同名的路人")
+    manager.add_character(empty_graph, "莉莉波特", "哈利的母親")
+    manager.add_relationship(empty_graph, "莉莉波特", "哈利波特", "保護哈利")
+    index = SearchIndex()
+    manager.subscribe(index.apply_change)
+    index.sync(empty_graph, manager.graph_version(empty_graph))
+
+    hits, total = index.search("哈利")
+    assert total == 4
+    assert [h["id"] for h in hits[:2]] == ["哈利", "哈利波特"]
+    assert {(h["kind"], h["field"]) for h in hits[2:]} == {("node", "title"), ("edge", "label")}
+    assert [h["id"] for h in index.search("波特")[0]] == ["哈利波特", "莉莉波特"]
+    assert [h["id"] for h in index.search("波特", prefix=True)[0]] == []
+    assert index.search("男")[0][0]["text"] == "存活下來的男孩"
+
+    page, total = index.search("哈利", page=1, page_size=3)
+    assert total == 4 and len(page) == 1
+
+    # 增量更新：修改描述、刪除角色後立即反映
+    manager.edit_character_description(empty_graph, "哈利", "魔法部職員")
+    manager.delete_character(empty_graph, "莉莉波特")
+    assert [h["id"] for h in index.search("哈利")[0]] == ["哈利", "哈利波特"]
+    assert [h["id"] for h in index.search("魔法")[0]] == ["哈利"]
+
+def test_neighborhood_focus_k_hops_and_chapter(manager, empty_graph):
+    """測試：聚焦模式取出 k 步內的入邊與出邊鄰域，可限定章節，BFS 分層依版本快取並可延續擴展"""
+    for name in "ABCDEX":
+        manager.add_character(empty_graph, name, "")
+    manager.add_relationship(empty_graph, "B", "A", "認識", chapter=1)
+    manager.add_relationship(empty_graph, "B", "C", "朋友", chapter=1)
+    manager.add_relationship(empty_graph, "C", "D", "敵人", chapter=3)
+    manager.add_relationship(empty_graph, "D", "E", "同盟", chapter=1)
+    timeline = TimelineIndex()
+    timeline.sync(empty_graph, manager.graph_version(empty_graph))
+    focus = NeighborhoodIndex(timeline)
+    focus.sync(empty_graph, manager.graph_version(empty_graph))
+
+    assert focus.layers("A", 1) == [{"A"}, {"B"}]
+    layers = focus.layers("A", 4)
+    assert layers == [{"A"}, {"B"}, {"C"}, {"D"}, {"E"}]
+    assert focus.layers("A", 2) == layers[:3]
+    sub = focus.subgraph("A", 2)
+    assert set(sub.nodes) == {"A", "B", "C"} and set(sub.edges) == {("B", "A"), ("B", "C")}
+    assert sub.nodes["A"]["color"] == FOCUS_COLOR and "color" not in empty_graph.nodes["A"]
+
+    # 第 2 章時 C -> D 尚未出現，鄰域在 C 停止
+    assert set(focus.subgraph("A", 5, chapter=2).nodes) == {"A", "B", "C"}
+    assert set(focus.subgraph("A", 5, chapter=3).nodes) == {"A", "B", "C", "D", "E"}
+    assert focus.subgraph("A", 5, chapter=3)["C"]["D"]["label"] == "敵人"
+    assert set(focus.subgraph("X", 3).nodes) == {"X"}
+
+def test_path_index_shortest_and_k_shortest(manager, empty_graph):
+    """測試：雙向 BFS 最短路徑、前 k 短路徑、章節限制、顏色篩選與方向，結果依版本快取"""
+    for name in "ABCDEF":
+        manager.add_character(empty_graph, name, "")
+    manager.batch_import(empty_graph, [], [
+        {"source": "A", "target": "B", "label": "朋友", "color": "#4CAF50"},
+        {"source": "B", "target": "D", "label": "朋友", "color": "#4CAF50"},
+        {"source": "A", "target": "C", "label": "敵人", "color": "#F44336"},
+        {"source": "D", "target": "C", "label": "同盟", "color": "#4CAF50"},
+        {"source": "C", "target": "E", "label": "師徒", "color": "#9E9E9E"},
+    ], chapter=1)
+    manager.batch_import(empty_graph, [], [{"source": "A", "target": "E", "label": "重逢", "color": "#4CAF50"}], chapter=3)
+    timeline = TimelineIndex()
+    timeline.sync(empty_graph, manager.graph_version(empty_graph))
+    paths = PathIndex(timeline)
+    paths.sync(empty_graph, manager.graph_version(empty_graph))
+
+    assert paths.paths("A", "E") == [["A", "E"]]
+    assert paths.paths("A", "E", chapter=2) == [["A", "C", "E"]]
+    assert paths.paths("A", "E", k=3, chapter=2) == [["A", "C", "E"], ["A", "B", "D", "C", "E"]]
+    assert paths.paths("A", "D", colors=["#4CAF50"], chapter=2) == [["A", "B", "D"]]
+    assert paths.paths("A", "E", colors=["#4CAF50"], chapter=2) == []
+    assert paths.paths("D", "A", directed=True) == []
+    assert paths.paths("D", "A") == [["D", "B", "A"]] or paths.paths("D", "A") == [["D", "C", "A"]]
+    assert paths.paths("A", "F") == []
+    assert paths.describe(["D", "C", "E"], chapter=2) == "D —同盟→ C —師徒→ E"
+    assert paths.describe(["C", "A"]) == "C ←敵人— A"
+
+    cached = paths.paths("A", "E", k=3, chapter=2)
+    assert paths.paths("A", "E", k=3, chapter=2) is cached
+    manager.delete_relationship(empty_graph, "C", "E")
+    timeline.sync(empty_graph, manager.graph_version(empty_graph))
+    paths.sync(empty_graph, manager.graph_version(empty_graph))
+    assert paths.paths("A", "E", k=3, chapter=2) == []
+
+    highlighted = highlight_path(empty_graph, ["A", "C", "D"])
+    assert highlighted["D"]["C"]["width"] == 6 and highlighted.nodes["A"]["color"] == PATH_COLOR
+    assert "width" not in empty_graph["D"]["C"]
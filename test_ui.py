@@ -60,4 +60,18 @@ def test_api_key_warning():
             has_error = True
             break
             
-    assert has_error, "沒有跳出 API Key 錯誤警告"
\ No newline at end of file
+    assert has_error, "沒有跳出 API Key 錯誤警告"
+def test_search_does_not_focus_until_result_chosen():
+    """測試：輸入搜尋字串時停在「顯示全部」，選擇結果才聚焦，且不會為每個查詢留下新的元件狀態"""
+    at = AppTest.from_file("app.py").run()
+    name = next(n for n in at.session_state["graph"].nodes if isinstance(n, str) and n)
+    get_element_by_label(at.text_input, "搜尋角色").input(name).run()
+    assert not at.exception
+    assert at.session_state["search_target"] == "顯示全部"
+
+    get_element_by_label(at.selectbox, "搜尋結果").select(name).run()
+    assert at.session_state["search_target"] == name
+
+    get_element_by_label(at.text_input, "搜尋角色").input(name + "不存在").run()
+    assert at.session_state["search_target"] == "顯示全部"
+    assert not [key for key in at.session_state if key.startswith(("search_choice_", "search_page_"))]